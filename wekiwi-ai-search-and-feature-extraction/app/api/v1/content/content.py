@@ -2,20 +2,29 @@
 # by digital@work GmbH (2024). This file is part of wekiwi.
 # See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
 
-import time
+import re
 
-from fastapi import APIRouter, HTTPException, Request, BackgroundTasks, Body
+from fastapi import APIRouter, HTTPException, Request, BackgroundTasks, Body, Query
 from pydantic import BaseModel
-from typing import Annotated, Union, List
+from typing import Annotated, Literal, Optional, Union, List
 from loguru import logger
 
 from app.internal.errors import ContentNotFound
-from app.internal.types import ContentValidated, ContentOptional
+from app.internal.jobs import Job
+from app.internal.types import ContentValidated, ContentOptional, ContentCreateItem, ContentCirclesUpdate
 
 from app.internal.milvusdb.handle_db_items import (
     create_content_chunks,
+    create_contents_bulk,
     update_content_chunks,
+    rewrite_content_chunks,
+    update_content_circles_bulk,
 )
+from app.internal.milvusdb import filters
+from app.internal.milvusdb.milvusdb import CONTENT_SCALAR_FIELDS
+from app.internal.milvusdb.rebuild import rebuild_contents
+
+from app.config import BULK_MAX_CONTENTS
 
 
 router = APIRouter()
@@ -27,6 +36,19 @@ class EmbeddingResponse(BaseModel):
 class DeletionResponse(BaseModel):
     message: str
 
+class JobResponse(BaseModel):
+    message: str
+    job_id: str
+
+class TenantStatsResponse(BaseModel):
+    company_id: int
+    chunk_count: int
+    collection_name: str
+
+class CacheInvalidationResponse(BaseModel):
+    message: str
+    invalidated: int
+
 
 @router.post(
     "/v1/content/create",
@@ -64,7 +86,8 @@ async def create_content(
         db_items = await create_content_chunks(request, background_tasks, content, company_id, circle_ids)
 
         # Insert content chunks into milvusdb
-        await request.state.milvusdbclient.insert_data(db_items)
+        async with request.state.milvusdbclient.content_writes([content.content_id]):
+            await request.state.milvusdbclient.insert_data(db_items)
 
         logger.info("Content(s) have been successfully embedded.")
         return {"message": "Content has been successfully embedded."}
@@ -74,6 +97,42 @@ async def create_content(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post(
+    "/v1/content/create/bulk",
+    response_model=JobResponse,
+    status_code=202,
+    summary="Starts a background job that creates content chunks with embeddings for many contents at once and saves them in MilvusDB.",
+)
+async def create_contents(
+    request: Request,
+    items: Annotated[
+        List[ContentCreateItem],
+        Body(embed=True, min_length=1, max_length=BULK_MAX_CONTENTS, description="Contents to be embedded, each with its circle_ids and company_id."),
+    ],
+):
+    try:
+        logger.info(f"Received bulk embedding request with {len(items)} contents.")
+
+        job = Job(kind="bulk_create")
+
+        async def run():
+            background_tasks = BackgroundTasks()  # Title updates, run once the contents are written
+            results = await create_contents_bulk(request, background_tasks, items, job)
+            job.detail["results"] = [result.model_dump() for result in results]
+            await background_tasks()
+            return f"Created {sum(result.status == 'created' for result in results)} of {len(items)} contents."
+
+        # Progress and the per-content results are served by /v1/jobs/{job_id}
+        request.state.jobregistry.start(job, run())
+
+        logger.info(f"Started bulk create job {job.job_id} for {len(items)} contents.")
+        return {"message": f"Bulk create of {len(items)} contents has been started.", "job_id": job.job_id}
+
+    except Exception as e:
+        logger.error(f"Error embedding contents in bulk: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @router.put(
     "/v1/content/update",
     response_model=EmbeddingResponse,
@@ -100,49 +159,53 @@ async def update_content(
         
         logger.info(f"Received embedding update request with content: {content}, company_id: {company_id}, circle_ids: {circle_ids}")
         
-        all_fields = [field["name"] for field in request.state.milvusdbclient.describe_collection("contents")["fields"]]
-
-        content_chunks = await request.state.milvusdbclient.get_data(
-            filter_expr=f"content_id == {content.content_id}",
-            output_fields=all_fields
-        )
-        
-        if len(content_chunks) == 0:
-            raise ContentNotFound(f"Content with ID {content.content_id} not found in MilvusDB.")
-
-        if content.text:
-            # Delete contents from milvusdb
-            await request.state.milvusdbclient.delete_data(filter_expr=f"content_id == {content.content_id}")
+        if content.text and not re.match(r'^\s*$', content.text):
+            # Stored rows without vectors, vectors are only fetched for rows that are re-written
+            content_chunks = await request.state.milvusdbclient.get_data(
+                filter_expr=filters.content_id(content.content_id),
+                output_fields=CONTENT_SCALAR_FIELDS
+            )
+            
+            if len(content_chunks) == 0:
+                raise ContentNotFound(f"Content with ID {content.content_id} not found in MilvusDB.")
 
-            # Construct updated db_items (+re-use existing content_chunks)
-            # TODO: make this more efficient by parallelizing and threading
-            db_items = await update_content_chunks(
+            # Diff the new text chunks against the stored ones, only changed chunks are embedded
+            db_items, delete_ids = await update_content_chunks(
                 request, content, content_chunks, company_id, circle_ids
             )
-            
-            # # DEBUG db_items
-            # for i, item in enumerate(db_items):
-            #     logger.info(f"--- DB Item {i+1} ---")
-            #     for key, value in item.items():
-            #         logger.info(f"{key} (Type: {type(value)})")
 
-            # Insert updated content
-            await request.state.milvusdbclient.insert_data(db_items)
+            # Insert new and re-written chunks before deleting the old ones, so the content never disappears
+            async with request.state.milvusdbclient.content_writes([content.content_id]):
+                if db_items:
+                    await request.state.milvusdbclient.insert_data(db_items)
+                if delete_ids:
+                    await request.state.milvusdbclient.delete_data(primary_ids=delete_ids)
 
         else:
-            # Construct updated db_items (+re-use existing content_chunks)
-            db_items = await update_content_chunks(
-                request, content, content_chunks, company_id, circle_ids
+            # Metadata-only update (circle_ids, topics, keywords, parent_id, dates, ...), no vectors are read up front
+            content_chunks = await request.state.milvusdbclient.get_data(
+                filter_expr=filters.content_id(content.content_id),
+                output_fields=CONTENT_SCALAR_FIELDS
             )
             
-            # # DEBUG db_items
-            # for i, item in enumerate(db_items):
-            #     logger.info(f"--- DB Item {i+1} ---")
-            #     for key, value in item.items():
-            #         logger.info(f"{key} (Type: {type(value)})")
-
-            # Upsert updated content
-            await request.state.milvusdbclient.upsert_data(db_items)
+            if len(content_chunks) == 0:
+                raise ContentNotFound(f"Content with ID {content.content_id} not found in MilvusDB.")
+
+            updates = content.model_dump(exclude_none=True, exclude={"text"})
+            if company_id:
+                updates["company_id"] = company_id
+            if circle_ids:
+                updates["circle_ids"] = circle_ids
+
+            # Only a changed title needs a new embedding
+            title_embedding = None
+            if "title" in updates and updates["title"] != content_chunks[0]["title"]:
+                title_embedding = await (await request.state.textrequestProcessor.process_request(updates["title"], "embed"))
+
+            rewritten = await rewrite_content_chunks(
+                request, content_chunks, lambda row: {**row, **updates}, title_embedding
+            )
+            logger.info(f"Re-wrote {rewritten} of {len(content_chunks)} chunks of content ID {content.content_id}.")
 
         logger.info("Content text embeddings have been successfully updated.")
         return {"message": "Content text embeddings have been successfully updated."}
@@ -152,72 +215,89 @@ async def update_content(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.put(
+    "/v1/content/circles",
+    response_model=JobResponse,
+    status_code=202,
+    summary="Starts a background job that changes the circle_ids of all content chunks of a company matching content_ids and/or a circle, e.g. when a circle is merged or deleted.",
+)
+async def update_content_circles(
+    request: Request,
+    update: Annotated[
+        ContentCirclesUpdate,
+        Body(description="Contents to select and the circle_ids to set, add or remove."),
+    ],
+):
+    try:
+        logger.info(f"Received circle update request {update}")
+
+        job = Job(kind="circle_update")
+
+        async def run():
+            contents, chunks = await update_content_circles_bulk(request, update, job)
+            contents_per_second = job.stages["contents_updated"].per_second
+            skipped = len(job.detail["skipped_content_ids"])
+            return (
+                f"Updated circle_ids of {contents - skipped} contents ({chunks} chunks re-written, {contents_per_second} contents/s), "
+                f"skipped {skipped} contents that would exceed the circle limit."
+            )
+
+        # Progress and the skipped contents are served by /v1/jobs/{job_id}
+        request.state.jobregistry.start(job, run())
+
+        logger.info(f"Started circle update job {job.job_id}.")
+        return {"message": "Circle update has been started.", "job_id": job.job_id}
+
+    except Exception as e:
+        logger.error(f"Error starting content circle update: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @router.delete(
     "/v1/content/rebuild",
-    response_model=EmbeddingResponse,
-    summary="Deletes and re-creates the content collection, pulls all content from Directus and rebuilds MilvusDB content chunks.",
+    response_model=JobResponse,
+    status_code=202,
+    summary="Starts a background job that rebuilds MilvusDB content chunks from Directus into a shadow collection and swaps it in once complete.",
 )
-async def rebuild_milvusdb(request: Request, background_tasks: BackgroundTasks):
-    
-    start_time = time.time()
-    
+async def rebuild_milvusdb(
+    request: Request,
+    resume: Annotated[
+        bool,
+        Body(embed=True, description="Continue an interrupted rebuild from its checkpoint. Defaults to True."),
+    ] = True,
+):
     try:
         logger.warning(f"Received request to rebuild MilvusDB content chunks.")
-        
-        # Recreate the content collection
-        await request.state.milvusdbclient.recreate_collection("contents")
-        
-        logger.info(f"MilvusDB collection 'contents' has been recreated.")
-
-        # Get all content IDs from Directus
-        content_ids = await request.state.directusclient.get_ids_rebuild(collection="contents")
-        
-        logger.debug(f"{len(content_ids)} Contents ids pulled from Directus.")
 
-        # Get each content, and create MilvusDB items
-        db_items = []
-        for content_id_dict in content_ids:
-            content_list = await request.state.directusclient.get_contents_rebuild(
-                [content_id_dict["content_id"]]
-            )
-            
-            logger.debug(f"{len(content_list)} Content items pulled from Directus.")
-            
-            circle_ids = [circle["circle_id"]["circle_id"] for circle in content_list[0]["circle_contents"]]
-            
-            if content_list[0]["company_id"]:
-                company_id = content_list[0]["company_id"]
-            else:
-                company_id = 0
-                logger.warning(f"Company_id not found for {content_id_dict["content_id"]}. Setting to 0.")
-            
-            content = ContentValidated(**content_list[0])
+        running_job = request.state.jobregistry.running("rebuild")
+        if running_job:
+            raise HTTPException(status_code=409, detail=f"Rebuild job {running_job.job_id} is already running.")
 
-            db_items.extend(
-                await create_content_chunks(
-                    request, background_tasks, content, company_id, circle_ids
-                )
-            )
-        
-        # # DEBUG db_items
-        # for i, item in enumerate(db_items):
-        #     logger.info(f"--- DB Item {i+1} ---")
-        #     for key, value in item.items():
-        #         logger.info(f"{key}: (Type: {type(value)})")
-        
-        # Insert items into MilvusDB
-        await request.state.milvusdbclient.insert_data(db_items)
-        
-        time_taken = (time.time() - start_time)/60
+        job = Job(kind="rebuild")
+        request.state.jobregistry.start(job, rebuild_contents(request, job, resume=resume))
 
-        logger.info("MilvusDB content chunks have been successfully rebuilt.")
-        return {"message": f"MilvusDB content chunks have been successfully rebuilt. Time taken: {time_taken:.1f} seconds."}
+        logger.info(f"Started MilvusDB rebuild job {job.job_id}.")
+        return {"message": "MilvusDB rebuild has been started.", "job_id": job.job_id}
 
+    except HTTPException as e:
+        raise e
     except Exception as e:
-        logger.error(f"Error rebuilding MilvusDB items: {e}")
+        logger.error(f"Error starting MilvusDB rebuild: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get(
+    "/v1/content/rebuild/{job_id}",
+    response_model=Job,
+    summary="Returns the status of a MilvusDB rebuild job.",
+)
+async def get_rebuild_status(request: Request, job_id: str):
+    job = request.state.jobregistry.get(job_id)
+    if not job or job.kind != "rebuild":
+        raise HTTPException(status_code=404, detail=f"Rebuild job {job_id} not found.")
+    return job
+
+
 @router.delete(
     "/v1/content/delete",
     response_model=DeletionResponse,
@@ -229,15 +309,73 @@ async def delete_contents(
         List[int],
         Body(description="List of content_ids of content chunks to be deleted"),
     ],
+    company_id: Annotated[
+        Union[int, None],
+        Query(description="Company_id of the contents. Restricts the delete to the partition of the company."),
+    ] = None,
 ):
     try:
         logger.info(f"Received deletion request with content_ids: {content_ids}")
         
-        deletion_result = await request.state.milvusdbclient.delete_data(filter_expr=f"content_id in {content_ids}")
+        async with request.state.milvusdbclient.content_writes(content_ids):
+            deletion_result = await request.state.milvusdbclient.delete_data(
+                filter_expr=filters.content_ids(content_ids), company_id=company_id
+            )
         
         logger.info(f"Deleted {deletion_result["delete_count"]} entities.")
         return {"message": f"Deleted {deletion_result["delete_count"]} entities."}
 
     except Exception as e:
         logger.error(f"Error deleting content(s): {e}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get(
+    "/v1/content/stats/{company_id}",
+    response_model=TenantStatsResponse,
+    summary="Returns the number of content chunks of a company in MilvusDB.",
+    description="A count of the chunks matching company_id, no statistics of the partition the company is hashed to. "
+    "Search is scoped to a company by a leading company_id condition, unchanged from before.",
+)
+async def get_tenant_stats(request: Request, company_id: int):
+    try:
+        return await request.state.milvusdbclient.tenant_stats(company_id)
+
+    except Exception as e:
+        logger.error(f"Error getting stats of company {company_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post(
+    "/v1/content/cache/invalidate",
+    response_model=CacheInvalidationResponse,
+    summary="Drops cached Directus contents or users. To be called by Directus Flows on item updates and deletions.",
+)
+async def invalidate_directus_cache(
+    request: Request,
+    collection: Annotated[
+        Literal["contents", "directus_users"],
+        Body(description="Collection of the changed items ($trigger.collection)."),
+    ],
+    keys: Annotated[
+        Optional[List[Union[int, str]]],
+        Body(description="Ids of the changed items ($trigger.keys). Drops the whole cache of the collection if omitted."),
+    ] = None,
+):
+    try:
+        invalidated = request.state.directusclient.invalidate_cache(collection, keys)
+        return {"message": f"Invalidated {invalidated} cached items of {collection}.", "invalidated": invalidated}
+
+    except ValueError as e:
+        logger.error(f"Invalid cache invalidation: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error invalidating cache of {collection}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get(
+    "/v1/content/cache/stats",
+    summary="Returns size, hits, misses and hit rate of the Directus content and user caches.",
+)
+async def get_directus_cache_stats(request: Request):
+    return request.state.directusclient.cache_stats()
@@ -3,24 +3,24 @@
 # See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
 
 from ast import alias
-from fastapi import APIRouter, BackgroundTasks, UploadFile, Form, HTTPException, status
+from fastapi import APIRouter, UploadFile, Form, HTTPException, status
 from fastapi import File, Query, Depends
 from typing import List, Optional, Union
 from loguru import logger
 import asyncio
 # Removed unused import: from pydantic import conlist
 
-from app.internal.utils.pdf_parser import process_pdf_and_create_content_task
 from app.config import DIRECTUS_URL, DIRECTUS_ADMIN_KEY
 from app.internal.types import DirectPdfUploadRequest
 from app.internal.directus import UserDirectusClient
-from app.internal.utils.throttle import throttled_task
+from app.internal.conversion_queue import ConversionJob
 
 from fastapi import Request
 from fastapi import Header
 from fastapi.responses import JSONResponse
+import uuid
 import zipfile
-from io import BytesIO
+from pathlib import Path
 
 from slowapi import Limiter
 from slowapi.util import get_remote_address
@@ -31,6 +31,77 @@ router = APIRouter(
     tags=["PDF Parsing"],
 )
 limiter = Limiter(key_func=lambda request:getattr(request.state,"user_id","anonymous"))
+
+
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10 MB
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _file_too_large(filename: str, size: int) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"File too large: {filename} is {(size / (1024 * 1024)):.2f}MB, max allowed is {MAX_UPLOAD_SIZE // (1024*1024)}MB",
+    )
+
+
+async def _spool_upload(file: UploadFile, path: Path) -> str:
+    """
+    Copies an upload to `path` in chunks, rejecting it as soon as it exceeds MAX_UPLOAD_SIZE.
+    Returns its type ("pdf" or "docx").
+    """
+    size = 0
+    with open(path, "wb") as spool:
+        while chunk := await file.read(_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_UPLOAD_SIZE:
+                raise _file_too_large(file.filename, size)
+            spool.write(chunk)
+    logger.info(f"File size: {size} bytes ({size / (1024 * 1024):.2f} MB)")
+
+    if size == 0:
+        raise HTTPException(status_code=400, detail=f"Empty file: {file.filename}")
+    with open(path, "rb") as spool:
+        if spool.read(5) == b"%PDF-":
+            return "pdf"
+    if zipfile.is_zipfile(path):
+        return "docx"
+    raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.filename}")
+
+
+async def _spool_uploads(files: List[UploadFile], directory: Path) -> List[tuple[UploadFile, Path, str]]:
+    """Spools all uploads (see `_spool_upload`), if one is rejected the files spooled so far are removed."""
+    spooled, paths = [], []
+    try:
+        for file in files:
+            paths.append(directory / uuid.uuid4().hex)
+            spooled.append((file, paths[-1], await _spool_upload(file, paths[-1])))
+    except BaseException:
+        for path in paths:
+            path.unlink(missing_ok=True)
+        raise
+    return spooled
+
+
+async def _queue_conversion(
+    request: Request,
+    document_path: Path,
+    filename: str,
+    access_token: str,
+    company_id: int,
+    circle_ids: List[int],
+    uses_hub: bool,
+) -> str:
+    """Queues the conversion of an uploaded document, the user's token is kept with the job to create the contents."""
+    return await request.state.conversionqueue.submit(
+        "upload",
+        company_id=company_id,
+        user_key=request.state.user_id,
+        payload={"filename": filename, "directus_token": access_token, "company_id": company_id, "circle_ids": circle_ids},
+        uses_hub=uses_hub,
+        document=document_path,
+    )
+
+
 @router.post(
     "/direct-upload",
     status_code=status.HTTP_202_ACCEPTED,
@@ -58,7 +129,6 @@ limiter = Limiter(key_func=lambda request:getattr(request.state,"user_id","anony
 # async def direct_pdf_upload
 async def direct_document_upload(
     request: Request,
-    background_tasks: BackgroundTasks,
     files: List[UploadFile] = File(..., description="PDF files to upload and process"),
     circle_ids: Optional[str] = Form(
         default=None,
@@ -72,35 +142,13 @@ async def direct_document_upload(
     Requires user's static Directus token for authentication.
     Creates content in Directus after processing PDFs/DOCX files.
     """
-    MAX_SIZE = 10 * 1024 * 1024  # 10 MB
-
-    def validate_file_size(file_data: bytes, filename: str, max_size: int = MAX_SIZE):
-        actual_size = len(file_data)
-        logger.info(f"File size: {actual_size} bytes ({actual_size / (1024 * 1024):.2f} MB)")
-        
-        if not file_data or actual_size == 0:
-            raise HTTPException(status_code=400, detail=f"Empty file: {filename}")
-        if actual_size > max_size:
-            raise HTTPException(status_code=413, detail=f"File too large: {filename} is {(actual_size / (1024 * 1024)):.2f}MB, max allowed is {max_size // (1024*1024)}MB")
-
-    pdf_files = []
-    docx_files = []
-
-
     if not files:
         raise HTTPException(status_code=400, detail="No files provided")
 
-
+    # Reject files whose size is known to be too large before anything else
     for file in files:
-        file_data = await file.read()
-        validate_file_size(file_data, file.filename)
-
-        if file_data.startswith(b"%PDF-"):
-            pdf_files.append((file, file_data))
-        elif zipfile.is_zipfile(BytesIO(file_data)):
-            docx_files.append((file, file_data))
-        else:
-            raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.filename}")
+        if file.size is not None and file.size > MAX_UPLOAD_SIZE:
+            raise _file_too_large(file.filename, file.size)
 
     # Process circle_ids from comma-separated string to list of integers
     # try:
@@ -143,67 +191,75 @@ async def direct_document_upload(
     except Exception as e:
         logger.error(f"Error processing circle_ids or company_id: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Invalid circle_ids or company_id format: {str(e)}")
+
+    # Conversion jobs need both, reject the upload before the files are spooled and queued
+    if company_id is None:
+        raise HTTPException(status_code=400, detail="No company_id found for the user.")
+    if not circle_ids_list:
+        raise HTTPException(status_code=400, detail="No circle_ids provided and none found for the user.")
+
+    # Spool the files to disk in chunks, they are moved into the conversion queue without being held in memory
+    pdf_files = []
+    docx_files = []
+    spooled = await _spool_uploads(files, request.state.conversionqueue.spool_directory)
+    for file, path, kind in spooled:
+        (pdf_files if kind == "pdf" else docx_files).append((file, path))
+
     processed_files = []
+    job_ids = []
 
-    # Process PDF file if provided
-    for pdf_file, pdf_data in pdf_files:
-        try:
-            # Read the file data
-            # pdf_data = await pdf_file.read()
-            # validate_file_size(pdf_data, pdf_file.filename)
-            # if not pdf_data or len(pdf_data) == 0:
-            #     logger.warning(f"Empty file: {pdf_file.filename}. Skipping.")
-            # else:
-                # Schedule the background task for this file with throttling
-                background_tasks.add_task(
-                    throttled_task,
-                    process_pdf_and_create_content_task,
-                    document_data=pdf_data,
-                    filename=pdf_file.filename,
-                    directus_url=DIRECTUS_URL,
-                    directus_token=access_token,
-                    company_id=company_id,
-                    circle_ids=circle_ids_list
-                )
-                
-                # Append the filename to processed_files list
-                processed_files.append(pdf_file.filename)
-                logger.info(f"Scheduled throttled processing for file: {pdf_file.filename}")
-        except HTTPException as e:
-            raise e
-        except Exception as e:
-            logger.error(f"Error processing file {pdf_files.filename}: {str(e)}")
-    
-    # Process DOCX file if provided
-    for docx_file, docx_data in docx_files:
-        try:
-            # Read the file data
-            # docx_data = await docx_file.read()
-            # validate_file_size(docx_data, docx_file.filename)
-            # if not docx_data or len(docx_data) == 0:
-            #     logger.warning(f"Empty file: {docx_file.filename}. Skipping.")
-            # if not zipfile.is_zipfile(BytesIO(docx_data)):
-            #     raise HTTPException(status_code=400, detail="Invalid file format: DOCX(not a ZIP archive)")
-            # else:
-                # Schedule the background task for this file with throttling
-                background_tasks.add_task(
-                    throttled_task,
-                    process_pdf_and_create_content_task,
-                    document_data=docx_data,
-                    filename=docx_file.filename,
-                    directus_url=DIRECTUS_URL,
-                    directus_token=access_token,
-                    company_id=company_id,
-                    circle_ids=circle_ids_list
-                )
-                
-                # Append the filename to processed_files list
-                processed_files.append(docx_file.filename)
-                logger.info(f"Scheduled throttled processing for file: {docx_file.filename}")
-        except HTTPException as e:
-            raise e
-        except Exception as e:
-            logger.error(f"Error processing file {docx_file.filename}: {str(e)}")
+    try:
+        # Process PDF file if provided
+        for pdf_file, pdf_path in pdf_files:
+            try:
+                # Read the file data
+                # pdf_data = await pdf_file.read()
+                # validate_file_size(pdf_data, pdf_file.filename)
+                # if not pdf_data or len(pdf_data) == 0:
+                #     logger.warning(f"Empty file: {pdf_file.filename}. Skipping.")
+                # else:
+                    # Queue the conversion of this file (rate limited per user and for the DAW hub)
+                    job_id = await _queue_conversion(
+                        request, pdf_path, pdf_file.filename, access_token, company_id, circle_ids_list, uses_hub=True
+                    )
+
+                    # Append the filename to processed_files list
+                    processed_files.append(pdf_file.filename)
+                    job_ids.append(job_id)
+                    logger.info(f"Queued conversion job {job_id} for file: {pdf_file.filename}")
+            except HTTPException as e:
+                raise e
+            except Exception as e:
+                logger.error(f"Error processing file {pdf_file.filename}: {str(e)}")
+
+        # Process DOCX file if provided
+        for docx_file, docx_path in docx_files:
+            try:
+                # Read the file data
+                # docx_data = await docx_file.read()
+                # validate_file_size(docx_data, docx_file.filename)
+                # if not docx_data or len(docx_data) == 0:
+                #     logger.warning(f"Empty file: {docx_file.filename}. Skipping.")
+                # if not zipfile.is_zipfile(BytesIO(docx_data)):
+                #     raise HTTPException(status_code=400, detail="Invalid file format: DOCX(not a ZIP archive)")
+                # else:
+                    # Queue the conversion of this file (DOCX is converted locally, only the user's rate applies)
+                    job_id = await _queue_conversion(
+                        request, docx_path, docx_file.filename, access_token, company_id, circle_ids_list, uses_hub=False
+                    )
+
+                    # Append the filename to processed_files list
+                    processed_files.append(docx_file.filename)
+                    job_ids.append(job_id)
+                    logger.info(f"Queued conversion job {job_id} for file: {docx_file.filename}")
+            except HTTPException as e:
+                raise e
+            except Exception as e:
+                logger.error(f"Error processing file {docx_file.filename}: {str(e)}")
+    finally:
+        # Spooled files that were not queued
+        for _, path, _ in spooled:
+            path.unlink(missing_ok=True)
 
     # If no files were processed, raise an error
     if not processed_files:
@@ -213,9 +269,40 @@ async def direct_document_upload(
     return {
         "status": "Document processing initiated",
         "files": processed_files,
+        "job_ids": job_ids,
         "message": "The documents(PDF/DOCX) are being processed and content will be created in Directus"
     }
 
+
+@router.get(
+    "/direct-upload/jobs",
+    response_model=List[ConversionJob],
+    summary="Lists the conversion jobs of your direct uploads, newest first, using your Directus token",
+    responses={
+        401: {"description": "Unauthorized: Missing or invalid token"},
+    },
+)
+async def list_direct_upload_jobs(
+    request: Request,
+    access_token: str = Header(..., description="Your static Directus token for authentication"),
+    limit: int = Query(default=100, ge=1, le=1000),
+):
+    """Lists the conversion jobs of the user owning the Directus token, with their status, stage and attempts."""
+    if not DIRECTUS_URL:
+        logger.error("DIRECTUS_URL not configured in environment/config.")
+        raise HTTPException(status_code=500, detail="Backend configuration error: Directus URL missing.")
+
+    try:
+        user_info = await UserDirectusClient(DIRECTUS_URL, access_token).get_user_info()
+    except Exception as e:
+        logger.error(f"Error getting user info: {str(e)}")
+        raise HTTPException(status_code=500, detail="Backend error: Failed to get user info.")
+    if not user_info:
+        raise HTTPException(status_code=401, detail="Unauthorized: Invalid access token")
+
+    jobs = request.state.conversionqueue.list_by_user(str(user_info.get("id", "anonymous")), limit=limit)
+    return [job for job in jobs if job.kind == "upload"]
+
 # @router.middleware("http")
 # async def rate_limiter(request: Request, call_next):
 #     try:
@@ -0,0 +1,30 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+from fastapi import APIRouter, Body, HTTPException, status
+
+from app.internal.hub_poller import hub_poller
+
+
+router = APIRouter(
+    prefix="/pdf",
+    tags=["PDF Parsing"],
+)
+
+
+@router.post(
+    "/hub-callback/{token}",
+    status_code=status.HTTP_204_NO_CONTENT,
+    summary="Receives the completion of a conversion task pushed by the DAW hub. Only to be used by the DAW hub.",
+    responses={404: {"description": "Unknown, expired or already used callback token"}},
+)
+async def hub_callback(
+    token: str,
+    status_data: dict = Body(..., description="Task status as returned by the hub's task-status endpoint (status 'completed' or 'failed')."),
+):
+    """
+    The unguessable token of the callback URL authenticates the hub, it is valid for one conversion only.
+    """
+    if not hub_poller.push(token, status_data):
+        raise HTTPException(status_code=404, detail="Unknown callback token or task not finished.")
@@ -1,20 +1,16 @@
 # wekiwi-ai-search-and-feature-extraction/app/api/v1/content/parse_and_reply.py
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks, Request
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Query
 # Remove Pydantic imports from here, they should be in types.py
 # from pydantic import BaseModel, Field
-from typing import List, Optional, Any # Keep typing imports
+from typing import List, Literal, Optional, Any # Keep typing imports
 from loguru import logger
 import asyncio
 
-# Import the actual background task function
-# Import the actual background task function
-from app.internal.utils.pdf_parser import process_pdf_and_create_reply_task
 # Import the payload model from the types file
 from app.internal.types import PdfParseTriggerPayload
+from app.internal.conversion_queue import ConversionJob
 # Import specific config variables directly
 from app.config import DIRECTUS_URL, DIRECTUS_ADMIN_KEY
-# Import the throttling utility
-from app.internal.utils.throttle import throttled_task
 
 
 # Remove the local class definition
@@ -34,13 +30,12 @@ router = APIRouter(
 async def trigger_pdf_parse_and_reply(
     payload: PdfParseTriggerPayload,
     request: Request,
-    background_tasks: BackgroundTasks,
     # Add API Key dependency if needed for this specific backend
     # api_key: str = Depends(get_api_key) # Assuming check_authentication in main.py covers this router
 ):
     """
     Receives a trigger from Directus Flow when a PDF document content item is created.
-    Schedules a background task to fetch the PDF, call the external conversion service,
+    Queues a conversion job to fetch the PDF, call the external conversion service,
     poll for results, and create a reply content item in Directus.
     """
     logger.info(f"Received trigger to parse PDF for file_id: {payload.directus_file_id}, parent_id: {payload.parent_content_id}")
@@ -54,20 +49,44 @@ async def trigger_pdf_parse_and_reply(
         logger.error("DIRECTUS_URL or DIRECTUS_ADMIN_KEY not configured in environment/config.")
         raise HTTPException(status_code=500, detail="Backend configuration error: Directus config missing.")
 
-    # Schedule the background task with throttling
+    # Queue the conversion (rate limited per user and for the DAW hub, persisted across restarts)
     try:
-        background_tasks.add_task(
-            throttled_task,
-            process_pdf_and_create_reply_task, # The function to be throttled
-            payload=payload,
-            # Pass necessary config/auth
-            directus_url=directus_url,
-            directus_token=directus_token
+        job_id = await request.state.conversionqueue.submit(
+            "reply",
+            company_id=payload.company_id,
+            user_key=payload.user_created_id,
+            payload=payload.model_dump(),
+            uses_hub=True,
         )
-        logger.info(f"Scheduled throttled background task for file_id: {payload.directus_file_id}")
-    # Remove the ImportError fallback block
+        logger.info(f"Queued conversion job {job_id} for file_id: {payload.directus_file_id}")
     except Exception as e:
-        logger.error(f"Failed to schedule background task: {e}")
+        logger.error(f"Failed to queue conversion job: {e}")
         raise HTTPException(status_code=500, detail="Failed to schedule PDF processing task.")
 
-    return {"status": "PDF processing initiated", "file_id": payload.directus_file_id}
+    return {"status": "PDF processing initiated", "file_id": payload.directus_file_id, "job_id": job_id}
+
+
+@router.get(
+    "/jobs/{job_id}",
+    response_model=ConversionJob,
+    summary="Returns the status, stage and attempts of a document conversion job (trigger-parse or direct-upload).",
+)
+async def get_conversion_job(request: Request, job_id: str):
+    job = request.state.conversionqueue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Conversion job {job_id} not found.")
+    return job
+
+
+@router.get(
+    "/jobs",
+    response_model=List[ConversionJob],
+    summary="Lists the document conversion jobs of a user, newest first.",
+)
+async def list_conversion_jobs(
+    request: Request,
+    user_id: str = Query(..., description="UUID of the Directus user (user_created_id of trigger-parse, the uploading user of direct-upload)"),
+    job_status: Optional[Literal["queued", "running", "completed", "failed"]] = Query(default=None, alias="status"),
+    limit: int = Query(default=100, ge=1, le=1000),
+):
+    return request.state.conversionqueue.list_by_user(user_id, status=job_status, limit=limit)
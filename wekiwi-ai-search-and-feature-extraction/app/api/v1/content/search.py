@@ -2,22 +2,47 @@
 # by digital@work GmbH (2024). This file is part of wekiwi.
 # See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
 
+import json
+
 from fastapi import APIRouter, HTTPException, Request, Body
-from typing import Annotated, List, Union
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, StringConstraints
+from typing import Annotated, List, Optional, Union
 from loguru import logger
 
 from fastapi_cache.decorator import cache
 
-from starlette.concurrency import run_in_threadpool
-
-import polars as pl
-import asyncio
+from app.internal.errors import InvalidFilter
+from app.internal.milvusdb import filters
+from app.internal.search import (
+    search_hierarchies,
+    stream_search_hierarchy,
+    search_hits,
+    rank_search_hits,
+    hydrate_subtrees,
+    Hydration,
+)
+from app.internal.search_sessions import SearchSession, decode_cursor
 
-from app.internal.utils.search_postprocessing import calculate_combined_df, build_hierarchy
+from app.config import SEARCH_BATCH_MAX_QUERIES, SEARCH_SESSION_CANDIDATES, SEARCH_HYDRATION
 
 
 router = APIRouter()
 
+# Shared by the single, batch and session search endpoints
+HydrationBody = Annotated[
+    Hydration,
+    Body(description="Source of the content fields of the results: directus, or milvus (MilvusDB fields and cached user data, text of the best matching chunk, no interaction_id). Defaults to value in config."),
+]
+
+
+class SearchPageResponse(BaseModel):
+    session_id: str
+    results: List[dict]
+    total: int
+    next_cursor: Optional[str] = None
+
 
 @router.post(
     "/v1/content/search",
@@ -42,7 +67,7 @@ async def search(
         Union[None, str],
         Body(
             examples=[None],
-            description="MilvusDB filter expressions, see https://milvus.io/docs/boolean.md"
+            description="MilvusDB filter expressions, see https://milvus.io/docs/boolean.md. Allowed fields: content_id, content_type, parent_id, date_created, date_updated, user_created, user_updated, file_id, circle_ids, topics, keywords."
         ),
     ] = None,
     k_avg: Annotated[
@@ -52,135 +77,202 @@ async def search(
             description="Number of highest scoring chunks with duplicate ids to average. Defaults to 2."
         ),
     ] = 2,
+    stream: Annotated[
+        bool,
+        Body(description="Stream NDJSON lines {stage, results}: the hybrid search ordering first, then the re-ranked ordering (if rerank). Defaults to False."),
+    ] = False,
+    hydration: HydrationBody = SEARCH_HYDRATION,
 ):
     logger.info(f"Entering search function for query: {query}") # Log entry
     try:
         logger.info(f"Received search request with query: {query}")
 
-        # Embed search query with multiple models (Caching disabled due to type errors)
-        async def get_embedded_query(query):
-            # No internal logging needed now
-            try:
-                embedded_query_dense_future, embedded_query_sparse_future = await asyncio.gather(
-                    request.state.textrequestProcessor.process_request(query, "embed"),
-                    request.state.textrequestProcessor1.process_request(query, "embed"),
-                )
-                # Extract and return the actual vector values
-                dense_vector = embedded_query_dense_future.result() if hasattr(embedded_query_dense_future, 'result') and callable(embedded_query_dense_future.result) else embedded_query_dense_future
-                dense_vector = dense_vector.result() if hasattr(dense_vector, 'result') and callable(dense_vector.result) else dense_vector
-
-                sparse_vector = embedded_query_sparse_future.result() if hasattr(embedded_query_sparse_future, 'result') and callable(embedded_query_sparse_future.result) else embedded_query_sparse_future
-                sparse_vector = sparse_vector.result() if hasattr(sparse_vector, 'result') and callable(sparse_vector.result) else sparse_vector
-
-                return dense_vector, sparse_vector
-            except Exception as embed_e:
-                # Log error if embedding fails
-                logger.error(f"Error during query embedding: Type={type(embed_e).__name__}, Message={str(embed_e)}")
-                raise # Re-raise the exception
-
-        dense_vector, sparse_vector = await get_embedded_query(query)
-        # Removed debug logs about return types and preparation
-
-        # Get vector search result
-        # TODO: add support for multiple queries, once directus supports it, also see zero index below
-        # Removed specific try/except around this call, outer one is sufficient
-        search_result = await request.state.milvusdbclient.multi_vector_search(
-            vectors=[
-                dense_vector,
-                dense_vector, # Corrected indentation
-                sparse_vector
-            ],
-            field_names=[
-                "title_embedding_dense",
-                "text_embedding_dense",
-                "text_embedding_sparse"
-            ],
-            filter_expr=f"company_id == {company_id} and ARRAY_CONTAINS_ANY(circle_ids, {circle_ids}) {f'and {filter}' if filter else ''}",
-            offset=offset, # Corrected indentation
-        )
-        logger.debug(f"multi_vector_search completed.") # Corrected indentation
-
-        # Removed specific try/except block
-        # Removed logs about result types
-
-        # If no search results, return empty list
-        if len(search_result[0]) == 0:
-            return []
-
-        query_chunk_pairs = [] # Chunk pairs for possible re-rank and get ids for directus request
-        search_distances = [] # Distances are used later if re-ranking is not enabled
-        ids = [] # IDs to get additional content from Directus
-
-        for hit in search_result[0]: # zero index for zeroth query
-            query_chunk_pairs.append((query, hit.fields["text"]))
-            ids.append(hit.fields["content_id"])
-            search_distances.append(hit.distance)
-        
-        if rerank:
-            # Re-rank chunks (optional) and get additional contents from Directus
-            rerank_tasks = [
-                request.state.textrerankingProcessor.process_request(pair, "rerank")
-                for pair in query_chunk_pairs
-            ]
-
-            contents, *rerank_futures = await asyncio.gather(
-                request.state.directusclient.get_contents(content_ids=ids, company_id=company_id),
-                *rerank_tasks
+        if stream:
+            filters.user_filter(filter) # Reject invalid filters before the response starts
+            return StreamingResponse(
+                _stream_search(request, query, company_id, circle_ids, rerank, offset, page_size, filter, k_avg, hydration),
+                media_type="application/x-ndjson",
             )
-        else:
-            # Only get additional contents from Directus (without re-ranking)
-            contents = await request.state.directusclient.get_contents(content_ids=ids, company_id=company_id)
-        
-        if rerank:
-            # Convert results to float to ensure compatibility with Polars
-            # Note: If future.result() can return None, float() will raise an error.
-            # Consider adding error handling/filtering if None is a possible valid result.
-            try:
-                rerank_results_float = [float(future.result()) for future in rerank_futures]
-            except TypeError as e:
-                logger.error(f"TypeError converting rerank_results to float: {e}. Original results: {rerank_futures}")
-                raise # Re-raise the error to stop processing
-            # Removed debug logs
-            # logger.debug(f"ids: {ids}")
-            # logger.debug(f"rerank_results (float): {rerank_results_float}")
-
-            # Use rerank_results
-            score_lf = pl.LazyFrame({
-                "content_id": ids,
-                "score": rerank_results_float # Use the converted float list
-                })
-        else:
-            # Removed debug logs
-            # logger.debug(f"ids: {ids}")
-            # logger.debug(f"search_distances: {search_distances}")
-
-            # Convert distances to float and use correct key for LazyFrame
-            # Note: If hit.distance can be None, float() will raise an error.
-            try:
-                search_distances_float = [float(dist) for dist in search_distances]
-            except TypeError as e:
-                 logger.error(f"TypeError converting search_distances to float: {e}. Original distances: {search_distances}")
-                 raise # Re-raise the error to stop processing
-            # logger.debug(f"search_distances (float): {search_distances_float}") # Removed debug log
-
-            # Use search_result with corrected key and float types
-            score_lf = pl.LazyFrame({
-                "content_id": ids, # Corrected key from "score_lf"
-                "score": search_distances_float # Use the converted float list
-                 })
-
-        # Removed schema log that caused PerformanceWarning
-        # logger.debug(f"Schema of score_lf before post-processing: {score_lf.schema}")
-
-        combined_df = await run_in_threadpool(calculate_combined_df, score_lf, contents, k_avg)
-        hierarchy = await run_in_threadpool(build_hierarchy, combined_df)
-
-        return hierarchy
 
+        hierarchies = await search_hierarchies(
+            request, [query], company_id, circle_ids, rerank=rerank, offset=offset, page_size=page_size, filter=filter, k_avg=k_avg,
+            hydration=hydration,
+        )
+        return hierarchies[0]
+
+    except InvalidFilter as e:
+        logger.error(f"Invalid search filter: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         # Log type and message separately for safer handling
         logger.error(f"Error in search: Type={type(e).__name__}, Message={str(e)}")
-        # Optionally include traceback for more debugging info (if needed)
-        # import traceback
-        # logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def _stream_search(request: Request, query: str, *args):
+    """Writes the stages of a streamed search as NDJSON lines, errors are sent as a final error line."""
+    try:
+        async for stage, hierarchy in stream_search_hierarchy(request, query, *args):
+            yield json.dumps({"stage": stage, "results": jsonable_encoder(hierarchy)}) + "\n"
+    except Exception as e:
+        logger.error(f"Error in streamed search: Type={type(e).__name__}, Message={str(e)}")
+        yield json.dumps({"stage": "error", "detail": str(e)}) + "\n"
+
+
+@router.post(
+    "/v1/content/search/batch",
+    summary="Receives several queries (e.g. query expansions) and responds with a hierarchy of content items per query."
+)
+async def search_batch(
+    request: Request,
+    queries: Annotated[
+        List[Annotated[str, StringConstraints(min_length=1, max_length=256)]],
+        Body(min_length=1, max_length=SEARCH_BATCH_MAX_QUERIES, description="Text queries"),
+    ],
+    company_id: Annotated[
+        int, Body(ge=0, description="Company_id of the user making the search.")
+    ],
+    circle_ids: Annotated[List[int], Body(description="Circle_id(s) that the user has access to.")],
+    rerank: Annotated[
+        bool, Body(description="Whether to re-rank the search results. Defaults to True.")
+    ] = True,
+    offset: Annotated[int | None, Body(description="Offset content number. Defaults to 0.")] = 0,
+    page_size: Annotated[
+        int, Body(ge=1, description="Number of results per page and query. Defaults to 20.")
+    ] = 20,
+    filter: Annotated[
+        Union[None, str],
+        Body(
+            examples=[None],
+            description="MilvusDB filter expressions applied to all queries, see /v1/content/search."
+        ),
+    ] = None,
+    k_avg: Annotated[
+        int,
+        Body(
+            gt=0,
+            description="Number of highest scoring chunks with duplicate ids to average. Defaults to 2."
+        ),
+    ] = 2,
+    hydration: HydrationBody = SEARCH_HYDRATION,
+):
+    try:
+        logger.info(f"Received batch search request with {len(queries)} queries.")
+
+        # Queries share the embedding batches, one hybrid search and one content fetch
+        return await search_hierarchies(
+            request, queries, company_id, circle_ids, rerank=rerank, offset=offset, page_size=page_size, filter=filter, k_avg=k_avg,
+            hydration=hydration,
+        )
+
+    except InvalidFilter as e:
+        logger.error(f"Invalid search filter: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error in batch search: Type={type(e).__name__}, Message={str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def _search_session_page(request: Request, session: SearchSession, offset: int, page_size: int) -> dict:
+    """Fetches and assembles only the root subtrees of the page."""
+    subtrees, next_cursor = session.page(offset, page_size)
+    results = (await hydrate_subtrees(
+        request, session.company_id, [session.hits], [session.scores], [subtrees], session.k_avg, session.hydration
+    ))[0]
+    return {"session_id": session.session_id, "results": results, "total": len(session.subtrees), "next_cursor": next_cursor}
+
+
+@router.post(
+    "/v1/content/search/session",
+    response_model=SearchPageResponse,
+    summary="Searches once, keeps the scored and ranked hits in a search session and responds with the first page and a cursor for the next.",
+)
+async def search_session(
+    request: Request,
+    query: Annotated[str, Body(min_length=1, max_length=256, description="Text query")],
+    company_id: Annotated[
+        int, Body(ge=0, description="Company_id of the user making the search.")
+    ],
+    circle_ids: Annotated[List[int], Body(description="Circle_id(s) that the user has access to.")],
+    rerank: Annotated[
+        bool, Body(description="Whether to re-rank the search results. Defaults to True.")
+    ] = True,
+    page_size: Annotated[
+        int, Body(ge=1, description="Number of root contents per page. Defaults to 20.")
+    ] = 20,
+    filter: Annotated[
+        Union[None, str],
+        Body(
+            examples=[None],
+            description="MilvusDB filter expressions, see /v1/content/search."
+        ),
+    ] = None,
+    k_avg: Annotated[
+        int,
+        Body(
+            gt=0,
+            description="Number of highest scoring chunks with duplicate ids to average. Defaults to 2."
+        ),
+    ] = 2,
+    hydration: HydrationBody = SEARCH_HYDRATION,
+):
+    try:
+        logger.info(f"Received search session request with query: {query}")
+
+        # Score and rank all candidates once, later pages are sliced from the session
+        filter_expr = filters.search_filter(tuple(circle_ids), filter)
+        hits_per_query = await search_hits(request, [query], company_id, filter_expr, 0, SEARCH_SESSION_CANDIDATES)
+        scores_per_query, subtrees_per_query = await rank_search_hits(request, [query], hits_per_query, company_id, rerank, k_avg)
+
+        session = request.state.searchsessions.add(
+            SearchSession(
+                company_id=company_id,
+                circle_ids=circle_ids,
+                k_avg=k_avg,
+                hydration=hydration,
+                hits=[{"content_id": hit["content_id"]} for hit in hits_per_query[0]],
+                scores=scores_per_query[0],
+                subtrees=subtrees_per_query[0],
+            )
+        )
+        return await _search_session_page(request, session, 0, page_size)
+
+    except InvalidFilter as e:
+        logger.error(f"Invalid search filter: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error in search session: Type={type(e).__name__}, Message={str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post(
+    "/v1/content/search/session/page",
+    response_model=SearchPageResponse,
+    summary="Responds with the page of a search session a cursor points to, without searching again.",
+)
+async def search_session_page(
+    request: Request,
+    cursor: Annotated[str, Body(min_length=1, description="next_cursor of the previous page.")],
+    company_id: Annotated[
+        int, Body(ge=0, description="Company_id of the user making the search.")
+    ],
+    circle_ids: Annotated[List[int], Body(description="Circle_id(s) that the user has access to.")],
+    page_size: Annotated[
+        int, Body(ge=1, description="Number of root contents per page. Defaults to 20.")
+    ] = 20,
+):
+    try:
+        session_id, offset = decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+    session = request.state.searchsessions.get(session_id)
+    if not session or not session.allows(company_id, circle_ids):
+        raise HTTPException(status_code=404, detail="Search session not found or expired, start a new search.")
+
+    try:
+        return await _search_session_page(request, session, offset, page_size)
+
+    except Exception as e:
+        logger.error(f"Error in search session page: Type={type(e).__name__}, Message={str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
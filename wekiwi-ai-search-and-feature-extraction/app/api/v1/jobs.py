@@ -0,0 +1,33 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+from fastapi import APIRouter, HTTPException, Request
+from typing import List, Union
+
+from app.internal.jobs import Job
+
+
+router = APIRouter()
+
+
+@router.get(
+    "/v1/jobs",
+    response_model=List[Job],
+    summary="Lists background jobs (rebuilds, bulk re-embedding runs) with their per-stage progress, newest first.",
+)
+async def list_jobs(request: Request, kind: Union[str, None] = None):
+    jobs = [job for job in request.state.jobregistry.jobs.values() if kind is None or job.kind == kind]
+    return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+
+
+@router.get(
+    "/v1/jobs/{job_id}",
+    response_model=Job,
+    summary="Returns the status, per-stage counters, throughput and ETA of a background job.",
+)
+async def get_job(request: Request, job_id: str):
+    job = request.state.jobregistry.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job
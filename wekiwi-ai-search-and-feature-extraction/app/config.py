@@ -35,6 +35,51 @@ MILVUS_DB_NAME = config.get("MILVUS_DB_NAME", default="default")
 MILVUS_DB_HOST = config.get("MILVUSDB_HOST", default="localhost")
 MILVUS_DB_PORT = config.get("MILVUSDB_PORT", default=19530)
 
+# Persistent state of the service (rebuild checkpoint, conversion queue), a mounted volume in docker (see
+# example.docker-compose.override.yml). Holds users' Directus tokens of queued conversions, keep it private.
+DATA_DIR = config.get("DATA_DIR", default="/app/data")
+
+# MilvusDB rebuild pipeline (concurrency per stage, batch sizes and resumable checkpoint)
+REBUILD_FETCH_PAGE_SIZE = config.get("REBUILD_FETCH_PAGE_SIZE", cast=int, default=50)
+REBUILD_FETCH_CONCURRENCY = config.get("REBUILD_FETCH_CONCURRENCY", cast=int, default=2)
+REBUILD_SPLIT_CONCURRENCY = config.get("REBUILD_SPLIT_CONCURRENCY", cast=int, default=4)
+REBUILD_EMBED_CONCURRENCY = config.get("REBUILD_EMBED_CONCURRENCY", cast=int, default=8)
+REBUILD_WRITE_BATCH_SIZE = config.get("REBUILD_WRITE_BATCH_SIZE", cast=int, default=500)
+REBUILD_QUEUE_SIZE = config.get("REBUILD_QUEUE_SIZE", cast=int, default=64)
+REBUILD_CHECKPOINT_PATH = config.get("REBUILD_CHECKPOINT_PATH", default=f"{DATA_DIR}/rebuild_checkpoint.json")
+
+# Bulk content creation (max contents per request, concurrent title generation/splitting, embedding and insert batch sizes)
+BULK_MAX_CONTENTS = config.get("BULK_MAX_CONTENTS", cast=int, default=1000)
+BULK_PREPARE_CONCURRENCY = config.get("BULK_PREPARE_CONCURRENCY", cast=int, default=8)
+BULK_EMBED_BATCH_SIZE = config.get("BULK_EMBED_BATCH_SIZE", cast=int, default=32)
+BULK_INSERT_BATCH_SIZE = config.get("BULK_INSERT_BATCH_SIZE", cast=int, default=1000)
+
+# Batch search (max. queries per request)
+SEARCH_BATCH_MAX_QUERIES = config.get("SEARCH_BATCH_MAX_QUERIES", cast=int, default=16)
+
+# Search sessions (candidates ranked by the first page, max. sessions kept in memory and their lifetime in seconds)
+SEARCH_SESSION_CANDIDATES = config.get("SEARCH_SESSION_CANDIDATES", cast=int, default=200)
+SEARCH_SESSION_MAX = config.get("SEARCH_SESSION_MAX", cast=int, default=1000)
+SEARCH_SESSION_TTL = config.get("SEARCH_SESSION_TTL", cast=int, default=600)
+
+# Search hydration ("directus": contents from Directus, "milvus": from MilvusDB scalar fields + cached user data)
+SEARCH_HYDRATION = config.get("SEARCH_HYDRATION", default="directus")
+
+# Directus metadata caches (max. entries and lifetime in seconds), invalidated by Directus Flows on updates
+DIRECTUS_CONTENT_CACHE_SIZE = config.get("DIRECTUS_CONTENT_CACHE_SIZE", cast=int, default=20000)
+DIRECTUS_CONTENT_CACHE_TTL = config.get("DIRECTUS_CONTENT_CACHE_TTL", cast=int, default=300)
+DIRECTUS_USER_CACHE_SIZE = config.get("DIRECTUS_USER_CACHE_SIZE", cast=int, default=10000)
+DIRECTUS_USER_CACHE_TTL = config.get("DIRECTUS_USER_CACHE_TTL", cast=int, default=600)
+
+# Search candidates (ANN limit = needed results * factor, the factor grows as the filter gets more selective)
+SEARCH_CANDIDATE_FACTOR_MIN = config.get("SEARCH_CANDIDATE_FACTOR_MIN", cast=float, default=2.0)
+SEARCH_CANDIDATE_FACTOR_MAX = config.get("SEARCH_CANDIDATE_FACTOR_MAX", cast=float, default=8.0)
+SEARCH_CANDIDATE_RETRIES = config.get("SEARCH_CANDIDATE_RETRIES", cast=int, default=2)
+SEARCH_ROW_COUNT_CACHE_TTL = config.get("SEARCH_ROW_COUNT_CACHE_TTL", cast=int, default=300)
+
+# Metadata updates (rows per vector fetch / re-insert / delete round trip)
+CHUNK_REWRITE_BATCH_SIZE = config.get("CHUNK_REWRITE_BATCH_SIZE", cast=int, default=500)
+
 # Sentence Transformers model (Huggingface integration)
 SENTENCE_TRANSFORMERS_EMBEDDING_MODEL = config.get("SENTENCE_TRANSFORMERS_EMBEDDING_MODEL", default="jinaai/jina-embeddings-v2-base-de")
 SENTENCE_TRANSFORMERS_DEVICE = config.get("SENTENCE_TRANSFORMERS_EMBEDDING_DEVICE", default="cpu")
@@ -77,6 +122,7 @@ RERANKER_REQUEST_FLUSH_TIMEOUT = config.get("RERANKER_REQUEST_FLUSH_TIMEOUT", de
 # Directus API Configuration
 DIRECTUS_URL = config.get("DIRECTUS_URL", default="https://your-default.de")
 DIRECTUS_ADMIN_KEY = config.get("DIRECTUS_ADMIN_KEY")
+DIRECTUS_PAGE_SIZE = config.get("DIRECTUS_PAGE_SIZE", cast=int, default=1000) # Items per page when paging through a collection
 
 # Ollama API Configuration
 OLLAMA_API_URL = config.get("OLLAMA_API_URL", default="http://ollama:11434/api/generate")
@@ -85,6 +131,40 @@ OLLAMA_TITLE_MODEL = config.get("OLLAMA_TITLE_MODEL", default="gemma3")
 # DAW API Hub (External PDF Conversion Service) Configuration
 DAW_API_HUB_URL = config.get("DAW_API_HUB_URL", default="http://daw-api-hub:6100") # Default from your compose override
 DAW_HUB_KEY = config.get("DAW_HUB_KEY") # No default, should be set in docker-compose.override.yml
+# Polling of DAW hub conversion tasks: the first poll is due after the estimated conversion time (seconds per page,
+# or per MB if the page count is unknown), later polls back off exponentially up to DAW_HUB_POLL_MAX_INTERVAL.
+# Tasks are given up after DAW_HUB_POLL_TIMEOUT seconds (or 3x their estimate if longer).
+DAW_HUB_POLL_SECONDS_PER_PAGE = config.get("DAW_HUB_POLL_SECONDS_PER_PAGE", cast=float, default=1.5)
+DAW_HUB_POLL_SECONDS_PER_MB = config.get("DAW_HUB_POLL_SECONDS_PER_MB", cast=float, default=10.0)
+DAW_HUB_POLL_MIN_INTERVAL = config.get("DAW_HUB_POLL_MIN_INTERVAL", cast=float, default=2.0)
+DAW_HUB_POLL_MAX_INTERVAL = config.get("DAW_HUB_POLL_MAX_INTERVAL", cast=float, default=60.0)
+DAW_HUB_POLL_TIMEOUT = config.get("DAW_HUB_POLL_TIMEOUT", cast=float, default=360.0)
+# Public URL of POST /pdf/hub-callback, passed to the hub as callback_url so it can push completions (polling
+# continues as a fallback). Leave empty if the hub cannot reach this service.
+DAW_HUB_CALLBACK_URL = config.get("DAW_HUB_CALLBACK_URL", default="")
+
+# Outbound HTTP clients, one connection pool per upstream (max. connections, default timeout in seconds)
+HTTP_DIRECTUS_MAX_CONNECTIONS = config.get("HTTP_DIRECTUS_MAX_CONNECTIONS", cast=int, default=20)
+HTTP_DIRECTUS_TIMEOUT = config.get("HTTP_DIRECTUS_TIMEOUT", cast=float, default=30.0)
+HTTP_OLLAMA_MAX_CONNECTIONS = config.get("HTTP_OLLAMA_MAX_CONNECTIONS", cast=int, default=8)
+HTTP_OLLAMA_TIMEOUT = config.get("HTTP_OLLAMA_TIMEOUT", cast=float, default=60.0)
+HTTP_DAW_HUB_MAX_CONNECTIONS = config.get("HTTP_DAW_HUB_MAX_CONNECTIONS", cast=int, default=8)
+HTTP_DAW_HUB_TIMEOUT = config.get("HTTP_DAW_HUB_TIMEOUT", cast=float, default=300.0)
+HTTP_KEEPALIVE_EXPIRY = config.get("HTTP_KEEPALIVE_EXPIRY", cast=float, default=30.0)
+
+# Document conversion queue (PDF/DOCX): concurrent conversions, token buckets (jobs per minute and burst) for the
+# DAW hub and per user, persisted in CONVERSION_QUEUE_DIR so queued jobs survive restarts
+CONVERSION_QUEUE_DIR = config.get("CONVERSION_QUEUE_DIR", default=f"{DATA_DIR}/conversion_queue")
+CONVERSION_CONCURRENCY = config.get("CONVERSION_CONCURRENCY", cast=int, default=4)
+CONVERSION_HUB_RATE = config.get("CONVERSION_HUB_RATE", cast=float, default=12.0)
+CONVERSION_HUB_BURST = config.get("CONVERSION_HUB_BURST", cast=int, default=4)
+CONVERSION_USER_RATE = config.get("CONVERSION_USER_RATE", cast=float, default=4.0)
+CONVERSION_USER_BURST = config.get("CONVERSION_USER_BURST", cast=int, default=10)
+# Failed conversions are retried up to CONVERSION_MAX_ATTEMPTS times in total, after CONVERSION_RETRY_DELAY seconds
+# doubled with every attempt. Finished jobs are kept for CONVERSION_JOB_RETENTION seconds for the status endpoints.
+CONVERSION_MAX_ATTEMPTS = config.get("CONVERSION_MAX_ATTEMPTS", cast=int, default=3)
+CONVERSION_RETRY_DELAY = config.get("CONVERSION_RETRY_DELAY", cast=float, default=60.0)
+CONVERSION_JOB_RETENTION = config.get("CONVERSION_JOB_RETENTION", cast=int, default=7 * 24 * 3600)
 
 # Swagger UI Direct Upload Service API Key
 SWAGGERSERVICE_API_KEY = config.get("SWAGGERSERVICE_API_KEY") # No default, should be set in docker-compose.override.yml
@@ -0,0 +1,386 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+import asyncio
+import bisect
+import json
+import os
+import random
+import sqlite3
+import time
+import uuid
+
+from cachetools import TTLCache
+from pathlib import Path
+from typing import List, Literal, Optional
+from pydantic import BaseModel, Field
+from loguru import logger
+
+from app.internal.types import PdfParseTriggerPayload
+from app.internal.utils.pdf_parser import (
+    process_pdf_and_create_reply_task,
+    process_pdf_and_create_content_task,
+    retry_is_safe,
+)
+
+from app.config import (
+    DIRECTUS_URL,
+    DIRECTUS_ADMIN_KEY,
+    CONVERSION_MAX_ATTEMPTS,
+    CONVERSION_RETRY_DELAY,
+    CONVERSION_JOB_RETENTION,
+)
+
+ConversionKind = Literal["reply", "upload"]
+ConversionStage = Literal["fetch", "convert", "poll", "download", "create_content"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversion_jobs (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    company_id INTEGER NOT NULL,
+    user_key TEXT NOT NULL,
+    uses_hub INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT,
+    stage TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL
+);
+CREATE INDEX IF NOT EXISTS conversion_jobs_status ON conversion_jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS conversion_jobs_user ON conversion_jobs (user_key, created_at);
+"""
+
+# Columns added after the first version of the table, added to existing queue databases on start
+_ADDED_COLUMNS = {
+    "stage": "TEXT",
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+    "next_attempt_at": "REAL",
+}
+
+
+class ConversionJob(BaseModel):
+    """Status of a document conversion job, without its payload (which holds the user's token for uploads)."""
+    job_id: str
+    kind: ConversionKind
+    company_id: int
+    user_key: str = Field(description="Directus user id of the upload, or the user_created_id of the reply.")
+    status: Literal["queued", "running", "completed", "failed"]
+    stage: Optional[ConversionStage] = Field(default=None, description="Current stage, or the stage the last attempt stopped at.")
+    attempts: int = Field(description="Attempts started so far.")
+    max_attempts: int = CONVERSION_MAX_ATTEMPTS
+    next_attempt_at: Optional[float] = Field(default=None, description="Time of the next retry of a failed attempt.")
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "ConversionJob":
+        return cls(**{key: row[key] for key in row.keys() if key in cls.model_fields})
+
+
+class TokenBucket:
+    """Allows `rate` jobs per minute on average and bursts of up to `burst` jobs. A rate <= 0 means unlimited."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate / 60
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def wait_time(self) -> float:
+        """Seconds until a token is available, 0 if one is available now."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+class ConversionQueue:
+    """
+    Persistent queue of document conversions (PDF replies triggered by Directus Flows and direct PDF/DOCX uploads).
+
+    Up to `concurrency` conversions run at once. A job only starts when the token bucket of its user and, for PDFs,
+    the token bucket of the DAW hub allow it. Companies are served round robin (FIFO within a company), so one
+    company uploading many files does not hold up the others.
+    Jobs and uploaded documents are stored in `directory` (SQLite + files), queued jobs survive restarts and jobs
+    that were running when the app stopped are started again.
+    A failed attempt is retried with exponential backoff until CONVERSION_MAX_ATTEMPTS, each attempt records the
+    stage it reached. Finished jobs are kept for CONVERSION_JOB_RETENTION seconds for the status endpoints.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        concurrency: int,
+        hub_rate: float,
+        hub_burst: int,
+        user_rate: float,
+        user_burst: int,
+    ):
+        self.directory = Path(directory)
+        self.concurrency = concurrency
+        self.hub_bucket = TokenBucket(hub_rate, hub_burst)
+        # Buckets of inactive users are dropped, a new bucket starts full like a refilled one
+        self.user_buckets: TTLCache = TTLCache(maxsize=10000, ttl=3600)
+        self.user_rate, self.user_burst = user_rate, user_burst
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._wakeup = asyncio.Event()
+        self._scheduler: Optional[asyncio.Task] = None
+        self._running: set[asyncio.Task] = set()
+        self._last_company: Optional[int] = None
+
+    async def start(self):
+        """Opens the queue, requeues jobs interrupted by a restart and starts scheduling."""
+        # Documents and the database (which holds users' Directus tokens) are only readable by the service
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        (self.directory / "documents").mkdir(mode=0o700, exist_ok=True)
+        # Uploads spooled by requests that did not finish (e.g. a restart while receiving them)
+        self.spool_directory.mkdir(mode=0o700, exist_ok=True)
+        for spooled in self.spool_directory.iterdir():
+            spooled.unlink(missing_ok=True)
+        db_path = self.directory / "queue.sqlite3"
+        db_path.touch(mode=0o600, exist_ok=True)
+        db_path.chmod(0o600)  # Journals of SQLite take over the mode of the database file
+        self._db = sqlite3.connect(db_path)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(_SCHEMA)
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(conversion_jobs)")}
+        for column, definition in _ADDED_COLUMNS.items():
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE conversion_jobs ADD COLUMN {column} {definition}")
+
+        # An interrupted attempt is not counted, the job was not at fault
+        requeued = self._db.execute(
+            "UPDATE conversion_jobs SET status = 'queued', attempts = MAX(attempts - 1, 0) WHERE status = 'running'"
+        ).rowcount
+        self._db.commit()
+        self._prune()
+        queued = self._db.execute("SELECT COUNT(*) FROM conversion_jobs WHERE status = 'queued'").fetchone()[0]
+        logger.info(f"Conversion queue started with {queued} queued jobs ({requeued} interrupted by the last restart).")
+        self._scheduler = asyncio.create_task(self._schedule())
+
+    async def stop(self):
+        """Stops scheduling and cancels running conversions, they are started again after the next start."""
+        tasks = [task for task in (self._scheduler, *self._running) if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._db:
+            self._db.close()
+
+    async def submit(
+        self,
+        kind: ConversionKind,
+        company_id: int,
+        user_key: str,
+        payload: dict,
+        uses_hub: bool,
+        document: Optional[Path] = None,
+    ) -> str:
+        """
+        Queues a conversion and returns its job id. The document file (direct uploads, spooled into
+        `spool_directory`) is moved next to the queue.
+        """
+        job_id = uuid.uuid4().hex
+        if document is not None:
+            os.replace(document, self._document_path(job_id))
+        self._db.execute(
+            "INSERT INTO conversion_jobs (job_id, kind, company_id, user_key, uses_hub, payload, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)",
+            (job_id, kind, company_id, user_key, int(uses_hub), json.dumps(payload), time.time()),
+        )
+        self._db.commit()
+        logger.info(f"Queued conversion job {job_id} ({kind}) of company {company_id}.")
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[ConversionJob]:
+        row = self._db.execute("SELECT * FROM conversion_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return ConversionJob.from_row(row) if row else None
+
+    def list_by_user(self, user_key: str, status: Optional[str] = None, limit: int = 100) -> List[ConversionJob]:
+        """Jobs of a user, newest first."""
+        query, params = "SELECT * FROM conversion_jobs WHERE user_key = ?", [user_key]
+        if status:
+            query, params = query + " AND status = ?", params + [status]
+        rows = self._db.execute(query + " ORDER BY created_at DESC LIMIT ?", (*params, limit))
+        return [ConversionJob.from_row(row) for row in rows]
+
+    def _prune(self):
+        """Removes finished jobs older than CONVERSION_JOB_RETENTION."""
+        self._db.execute(
+            "DELETE FROM conversion_jobs WHERE status IN ('completed', 'failed') AND finished_at < ?",
+            (time.time() - CONVERSION_JOB_RETENTION,),
+        )
+        self._db.commit()
+
+    def _set_stage(self, job_id: str, stage: ConversionStage):
+        self._db.execute("UPDATE conversion_jobs SET stage = ? WHERE job_id = ?", (stage, job_id))
+        self._db.commit()
+        logger.info(f"Conversion job {job_id} entered stage {stage}.")
+
+    @property
+    def spool_directory(self) -> Path:
+        """Directory for receiving uploads, on the same file system as the queued documents so they can be moved."""
+        return self.directory / "spool"
+
+    def _document_path(self, job_id: str) -> Path:
+        return self.directory / "documents" / job_id
+
+    def _user_bucket(self, user_key: str) -> TokenBucket:
+        bucket = self.user_buckets.get(user_key)
+        if bucket is None:
+            bucket = self.user_buckets[user_key] = TokenBucket(self.user_rate, self.user_burst)
+        return bucket
+
+    def _next_job(self) -> tuple[Optional[sqlite3.Row], Optional[float]]:
+        """
+        Picks the next job whose buckets allow it to start, serving companies round robin.
+        Returns the job (None if no job may start now) and the seconds until a waiting job may start.
+        """
+        now = time.time()
+        by_company: dict[int, list] = {}
+        delay = None
+        for row in self._db.execute("SELECT * FROM conversion_jobs WHERE status = 'queued' ORDER BY created_at"):
+            if row["next_attempt_at"] and row["next_attempt_at"] > now:
+                retry_in = row["next_attempt_at"] - now
+                delay = retry_in if delay is None else min(delay, retry_in)
+            else:
+                by_company.setdefault(row["company_id"], []).append(row)
+
+        companies = sorted(by_company)
+        first = bisect.bisect_right(companies, self._last_company) if self._last_company is not None else 0
+        for company_id in companies[first:] + companies[:first]:
+            for row in by_company[company_id]:
+                user_bucket = self._user_bucket(row["user_key"])
+                wait = max(user_bucket.wait_time(), self.hub_bucket.wait_time() if row["uses_hub"] else 0.0)
+                if wait == 0:
+                    user_bucket.take()
+                    if row["uses_hub"]:
+                        self.hub_bucket.take()
+                    self._last_company = company_id
+                    return row, delay
+                delay = wait if delay is None else min(delay, wait)
+        return None, delay
+
+    async def _schedule(self):
+        while True:
+            self._wakeup.clear()
+            delay = None
+            while len(self._running) < self.concurrency:
+                row, delay = self._next_job()
+                if row is None:
+                    break
+                self._db.execute(
+                    "UPDATE conversion_jobs SET status = 'running', started_at = ?, attempts = attempts + 1, "
+                    "stage = NULL, next_attempt_at = NULL WHERE job_id = ?",
+                    (time.time(), row["job_id"]),
+                )
+                self._db.commit()
+                task = asyncio.create_task(self._run_job(row))
+                self._running.add(task)
+                task.add_done_callback(self._job_done)
+
+            # Woken up by new or finished jobs, or when the next bucket token is due
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except TimeoutError:
+                pass
+
+    async def _run_job(self, row: sqlite3.Row):
+        payload = json.loads(row["payload"])
+        progress = payload.setdefault("progress", {})
+        try:
+            error = await self._convert(row, payload)
+        except asyncio.CancelledError:
+            raise  # Shutdown, the job stays running and is requeued on the next start
+        except Exception as e:
+            error = str(e)
+
+        self._finish_attempt(row["job_id"], row["attempts"] + 1, error, retry=retry_is_safe(progress))
+
+    def _job_done(self, task: asyncio.Task):
+        # Wake the scheduler once the job no longer counts as running, it may start a retry or the next job
+        self._running.discard(task)
+        self._wakeup.set()
+
+    def _save_progress(self, job_id: str, payload: dict):
+        """Saves the irreversible steps of the running attempt (see pdf_parser.ProgressCallback) with the job."""
+        self._db.execute("UPDATE conversion_jobs SET payload = ? WHERE job_id = ?", (json.dumps(payload), job_id))
+        self._db.commit()
+
+    def _finish_attempt(self, job_id: str, attempt: int, error: Optional[str], retry: bool = True):
+        if error and not retry:
+            # Directus may have created the content, a retry could create it twice
+            error = f"{error} Not retried, the content may have been created."
+        elif error and attempt < CONVERSION_MAX_ATTEMPTS:
+            # Exponential backoff with jitter, so jobs that failed together (e.g. hub outage) are not retried together
+            retry_in = CONVERSION_RETRY_DELAY * 2 ** (attempt - 1) * random.uniform(0.8, 1.2)
+            logger.warning(f"Conversion job {job_id} failed (attempt {attempt}), retrying in {retry_in:.0f}s: {error}")
+            self._db.execute(
+                "UPDATE conversion_jobs SET status = 'queued', next_attempt_at = ?, error = ? WHERE job_id = ?",
+                (time.time() + retry_in, error, job_id),
+            )
+            self._db.commit()
+            return
+
+        if error:
+            logger.error(f"Conversion job {job_id} failed after {attempt} attempts: {error}")
+        else:
+            logger.info(f"Conversion job {job_id} completed.")
+        # The payload is dropped with the document, it is not needed anymore and may hold the user's token
+        self._db.execute(
+            "UPDATE conversion_jobs SET status = ?, finished_at = ?, error = ?, payload = '{}' WHERE job_id = ?",
+            ("failed" if error else "completed", time.time(), error, job_id),
+        )
+        self._db.commit()
+        self._document_path(job_id).unlink(missing_ok=True)
+        self._prune()
+
+    async def _convert(self, row: sqlite3.Row, payload: dict) -> Optional[str]:
+        """
+        Runs the conversion of a job, returns an error message if it did not create content.
+        Steps done by earlier attempts are in payload["progress"], new steps are saved as they are done.
+        """
+        job_id = row["job_id"]
+        on_stage = lambda stage: self._set_stage(job_id, stage)
+        on_progress = lambda progress: self._save_progress(job_id, payload)
+        if row["kind"] == "reply":
+            created_item = await process_pdf_and_create_reply_task(
+                payload=PdfParseTriggerPayload(**{key: value for key, value in payload.items() if key != "progress"}),
+                directus_url=DIRECTUS_URL,
+                directus_token=DIRECTUS_ADMIN_KEY,
+                on_stage=on_stage,
+                progress=payload["progress"],
+                on_progress=on_progress,
+            )
+            return None if created_item else "No reply created, see the log of the conversion."
+
+        # The document is streamed from disk to the DAW hub and Directus, not loaded into memory
+        with open(self._document_path(job_id), "rb") as document:
+            created_item = await process_pdf_and_create_content_task(
+                document=document,
+                filename=payload["filename"],
+                directus_url=DIRECTUS_URL,
+                directus_token=payload["directus_token"],
+                company_id=payload["company_id"],
+                circle_ids=payload["circle_ids"],
+                on_stage=on_stage,
+                progress=payload["progress"],
+                on_progress=on_progress,
+            )
+        return None if created_item else "No content created, see the log of the conversion."
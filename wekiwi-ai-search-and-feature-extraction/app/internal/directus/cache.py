@@ -0,0 +1,49 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+from cachetools import TTLCache
+from typing import Any, Hashable, Iterable, Optional
+
+
+class CountingTTLCache:
+    """Bounded TTL cache that counts hits and misses of its lookups."""
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.items: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        value = self.items.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """Looks up a key without counting it, for repeated lookups within one request."""
+        return self.items.get(key)
+
+    def __setitem__(self, key: Hashable, value: Any):
+        self.items[key] = value
+
+    def invalidate(self, keys: Optional[Iterable[Hashable]] = None) -> int:
+        """Removes the given keys (all if None), returns the number of removed entries."""
+        if keys is None:
+            removed = len(self.items)
+            self.items.clear()
+            return removed
+        return sum(self.items.pop(key, None) is not None for key in keys)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.items),
+            "maxsize": self.items.maxsize,
+            "ttl": self.items.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+        }
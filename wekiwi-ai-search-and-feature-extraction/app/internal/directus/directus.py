@@ -3,12 +3,169 @@
 # See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
 
 from unittest import result
-from pydirectus import DirectusClient as BaseDirectusClient
-from typing import List, Optional
+from typing import AsyncIterator, BinaryIO, List, Optional, Union
 from loguru import logger
 import httpx
+import json
+
+from collections import defaultdict
 
 from app.internal.types import ContentOptional
+from app.internal.directus.cache import CountingTTLCache
+from app.internal.http_clients import http_client
+from app.config import (
+    DIRECTUS_PAGE_SIZE,
+    DIRECTUS_CONTENT_CACHE_SIZE,
+    DIRECTUS_CONTENT_CACHE_TTL,
+    DIRECTUS_USER_CACHE_SIZE,
+    DIRECTUS_USER_CACHE_TTL,
+)
+
+_UPLOAD_TIMEOUT = 300.0  # Seconds, uploads of large documents take longer than the default Directus timeout
+
+# Contents included in a MilvusDB rebuild
+_REBUILD_FILTER = {
+    # TODO: support other content types
+    "content_type": {"_eq": "text"},
+    # "status": {"_eq": "published"} TODO: establish in frontend
+}
+
+
+def _flatten_fields(fields: list, prefix: str = "") -> List[str]:
+    """Flattens relational fields ({"user_created": ["avatar"]}) into the dot notation of the REST API."""
+    flat = []
+    for field in fields:
+        if isinstance(field, dict):
+            for relation, subfields in field.items():
+                flat.extend(_flatten_fields(subfields, f"{prefix}{relation}."))
+        else:
+            flat.append(f"{prefix}{field}")
+    return flat
+
+
+def query_params(query: dict) -> dict:
+    """
+    Converts a query (filter/deep as dicts, fields as a list) into REST query parameters.
+    Without a limit, all matching items are read instead of the Directus default of 100.
+    """
+    params = {"limit": -1}
+    for key, value in query.items():
+        if key == "fields":
+            params[key] = ",".join(_flatten_fields(value))
+        elif isinstance(value, dict):
+            params[key] = json.dumps(value)
+        elif isinstance(value, list):
+            params[key] = ",".join(str(item) for item in value)
+        else:
+            params[key] = value
+    return params
+
+
+class BaseDirectusClient:
+    """
+    Async Directus REST client on the shared Directus HTTP client, so Directus I/O does not block the event loop.
+    Authenticates every request with a static token (admin key or user token).
+    """
+
+    def __init__(self, url: str, token: str):
+        self.url = url
+        self.token = token
+
+    def _endpoint(self, path: str) -> str:
+        return f"{self.url.rstrip('/')}/{path}"
+
+    def _headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.token}"}
+
+    async def read_items(self, collection: str, query: Optional[dict] = None) -> List[dict]:
+        """Reads the items of a collection matching the query."""
+        response = await http_client("directus").get(
+            self._endpoint(f"items/{collection}"), params=query_params(query or {}), headers=self._headers()
+        )
+        response.raise_for_status()
+        return response.json().get("data", [])
+
+    async def create_item(self, collection: str, data: dict) -> dict:
+        """Creates an item and returns it."""
+        return (await self.create_items(collection, [data]))[0]
+
+    async def create_items(self, collection: str, items: List[dict]) -> List[Optional[dict]]:
+        """
+        Creates items in one request and returns them in order. Items may contain nested relational items (e.g. a
+        content with its children in child_id), which Directus creates in the same request.
+        If Directus refuses a batch of several items (4xx), the items are created one by one, refused items are
+        returned as None. A single refused item raises httpx.HTTPStatusError.
+        """
+        if not items:
+            return []
+        response = await http_client("directus").post(self._endpoint(f"items/{collection}"), json=items, headers=self._headers())
+        if len(items) > 1 and response.is_client_error:
+            logger.warning(f"Directus refused creating {len(items)} items in {collection} at once ({response.status_code}), creating them one by one.")
+            created_items = []
+            for item in items:
+                try:
+                    created_items.extend(await self.create_items(collection, [item]))
+                except httpx.HTTPStatusError as e:
+                    logger.error(f"Directus refused creating an item in {collection}: {e.response.status_code} - {e.response.text}")
+                    created_items.append(None)
+            return created_items
+        response.raise_for_status()
+        return response.json().get("data")
+
+    async def update_item(self, collection: str, item_id, data: dict) -> dict:
+        """Updates the given fields of an item and returns it."""
+        response = await http_client("directus").patch(
+            self._endpoint(f"items/{collection}/{item_id}"), json=data, headers=self._headers()
+        )
+        response.raise_for_status()
+        return response.json().get("data")
+
+    async def update_items(self, collection: str, item_ids: List, data: dict) -> List[dict]:
+        """Sets the same fields on several items in one request and returns them."""
+        response = await http_client("directus").patch(
+            self._endpoint(f"items/{collection}"), json={"keys": item_ids, "data": data}, headers=self._headers()
+        )
+        response.raise_for_status()
+        return response.json().get("data")
+
+    async def count_items(self, collection: str, filter: Optional[dict] = None) -> int:
+        """Counts the items of a collection matching the filter."""
+        query = {"aggregate": {"count": "*"}}
+        if filter:
+            query["filter"] = filter
+        result = await self.read_items(collection, query)
+        return int(result[0]["count"]) if result else 0
+
+    async def iter_ids(
+        self,
+        collection: str,
+        filter: Optional[dict] = None,
+        key: str = "content_id",
+        page_size: int = DIRECTUS_PAGE_SIZE,
+    ) -> AsyncIterator[List[int]]:
+        """
+        Yields the ids of the items matching the filter in ascending pages. Pages are keyset paginated (key greater
+        than the last id of the previous page) instead of using offsets, so every page is a range scan on the primary
+        key and memory stays constant regardless of the collection size.
+        """
+        last_id = None
+        while True:
+            conditions = [filter] if filter else []
+            if last_id is not None:
+                conditions.append({key: {"_gt": last_id}})
+            query = {"fields": [key], "sort": [key], "limit": page_size}
+            if conditions:
+                query["filter"] = conditions[0] if len(conditions) == 1 else {"_and": conditions}
+
+            ids = [item[key] for item in await self.read_items(collection, query)]
+            if ids:
+                yield ids
+            if len(ids) < page_size:
+                return
+            last_id = ids[-1]
+
+    async def close(self):
+        """Nothing to release, the connections are pooled in app.internal.http_clients and closed on shutdown."""
 
 
 class DirectusClient(BaseDirectusClient):
@@ -19,14 +176,14 @@ class DirectusClient(BaseDirectusClient):
     """
 
     def __init__(self, DIRECTUS_URL: str = None, DIRECTUS_ADMIN_KEY: str = None):
-        self.token = DIRECTUS_ADMIN_KEY
-        self.url = DIRECTUS_URL
-        super().__init__(hostname=DIRECTUS_URL, static_token=DIRECTUS_ADMIN_KEY)
+        # content_id -> (company_id, row with user ids), user id -> avatar, username
+        self.content_cache = CountingTTLCache(DIRECTUS_CONTENT_CACHE_SIZE, DIRECTUS_CONTENT_CACHE_TTL)
+        self.user_cache = CountingTTLCache(DIRECTUS_USER_CACHE_SIZE, DIRECTUS_USER_CACHE_TTL)
+        super().__init__(DIRECTUS_URL, DIRECTUS_ADMIN_KEY)
         
-    def create_item(self, collection: str, data: dict):
+    async def create_item(self, collection: str, data: dict):
         """
-        Creates an item in Directus as admin, then patches it to set the user_created field if specified.
-        This approach ensures proper user attribution while working within Directus's permission system.
+        Creates an item in Directus as admin with user attribution, see create_items.
         
         Args:
             collection: The collection to create the item in (e.g., "contents")
@@ -35,75 +192,62 @@ class DirectusClient(BaseDirectusClient):
         Returns:
             The created (and potentially patched) item
         """
-        from loguru import logger
-        import httpx
-        
-        # Extract user_created if present, then remove it for the initial creation
-        user_id = None
-        if "user_created" in data and data["user_created"]:
-            user_id = data["user_created"]
-            logger.info(f"Detected user_created field with ID: {user_id}")
-        
-        # Call the parent class method to create the item
-        created_item = super().create_item(collection=collection, data=data)
-        logger.info(f"Created item in collection {collection}: {created_item}")
-        
-        # If we have a user_id and a content_id, patch the user_created field
-        if user_id and "content_id" in created_item:
-            item_id = created_item.get("content_id")
-            logger.info(f"Patching item {item_id} to set user_created to {user_id}")
-            
+        return (await self.create_items(collection, [data]))[0]
+
+    async def create_items(self, collection: str, items: List[dict]) -> List[Optional[dict]]:
+        """
+        Creates items (with nested children) as admin in one request and attributes them to their user_created.
+        Directus usually sets user_created to the admin on creation, items whose user_created was not kept are
+        patched afterwards with one request per user. A failed patch leaves the item attributed to the admin.
+        """
+        created_items = await super().create_items(collection, items)
+
+        # Items (by content_id) that Directus did not attribute to the requested user
+        unattributed = defaultdict(list)
+        for data, created_item in zip(items, created_items):
+            user_id = data.get("user_created")
+            if user_id and created_item and "content_id" in created_item and created_item.get("user_created") != user_id:
+                unattributed[user_id].append(created_item["content_id"])
+
+        patched_items = {}
+        for user_id, item_ids in unattributed.items():
+            logger.info(f"Patching items {item_ids} to set user_created to {user_id}")
             try:
-                # Make direct PATCH request to Directus API
-                url = f"{self.url.rstrip('/')}/items/{collection}/{item_id}"
-                headers = {
-                    "Authorization": f"Bearer {self.token}",
-                    "Content-Type": "application/json"
-                }
-                payload = {
-                    "user_created": user_id
-                }
-                
-                # Use httpx for the API call
-                response = httpx.patch(url, json=payload, headers=headers)
-                response.raise_for_status()
-                patched_item = response.json().get("data")
-                
-                logger.info(f"Successfully patched item {item_id} to user {user_id}")
-                return patched_item
+                for patched_item in await self.update_items(collection, item_ids, {"user_created": user_id}):
+                    patched_items[patched_item["content_id"]] = patched_item
+                logger.info(f"Successfully patched items {item_ids} to user {user_id}")
             except Exception as e:
                 logger.error(f"Failed to patch user_created: {e}")
-        
-        # Return the original item
-        return created_item
+
+        return [
+            patched_items.get(created_item["content_id"], created_item) if created_item and "content_id" in created_item else created_item
+            for created_item in created_items
+        ]
 
     async def get_ids(self, collection: str = "contents") -> List[dict]:
         """
-        Gets all content ids.
+        Gets all content ids. Use iter_ids to page through large collections with constant memory.
         """
-        query = {
-            "fields": ["content_id"],
-            "limit": 50000,  # TODO: better to do in batches or something?
-            # "filter": {"status": "published"} TODO: establish in frontend
-        }
-
-        return self.read_items(collection=collection, query=query)
+        # "filter": {"status": "published"} TODO: establish in frontend
+        return [{"content_id": content_id} async for page in self.iter_ids(collection) for content_id in page]
 
     async def get_ids_rebuild(self, collection: str = "contents") -> List[dict]:
         """
-        Gets all content ids.
+        Gets all content ids included in a rebuild. Use iter_ids_rebuild to page through them with constant memory.
         """
-        query = {
-            "filter": {
-                # TODO: support other content types
-                "content_type": {"_eq": "text"},
-            },
-            "fields": ["content_id"],
-            "limit": 50000,  # TODO: better to do in batches or something?
-            # "filter": {"status": "published"} TODO: establish in frontend
-        }
+        return [{"content_id": content_id} async for page in self.iter_ids_rebuild(collection) for content_id in page]
 
-        return self.read_items(collection=collection, query=query)
+    def iter_ids_rebuild(self, collection: str = "contents", page_size: int = DIRECTUS_PAGE_SIZE) -> AsyncIterator[List[int]]:
+        """
+        Yields the content ids included in a rebuild in ascending, keyset paginated pages.
+        """
+        return self.iter_ids(collection, filter=_REBUILD_FILTER, page_size=page_size)
+
+    async def count_rebuild(self, collection: str = "contents") -> int:
+        """
+        Counts the contents included in a rebuild.
+        """
+        return await self.count_items(collection, filter=_REBUILD_FILTER)
 
     async def get_contents_rebuild(
         self,
@@ -154,7 +298,7 @@ class DirectusClient(BaseDirectusClient):
             ],
         }
 
-        return self.read_items("contents", query=query)
+        return await self.read_items("contents", query=query)
 
     async def get_contents(
         self,
@@ -162,7 +306,89 @@ class DirectusClient(BaseDirectusClient):
         company_id: int,
     ) -> List[ContentOptional]:
         """
-        Gets the content information for specific content ids.
+        Gets the content information for specific content ids, their parents and grandparents.
+        Rows are served from the content cache, only contents missing in it are fetched (with their ancestors).
+        User data is attached from the user cache, so user updates do not invalidate contents.
+        """
+        _, missing = self._cached_contents(content_ids, company_id, count=True)
+        if missing:
+            for row in await self._fetch_contents(missing, company_id):
+                self._cache_content(row, company_id)
+
+        rows, _ = self._cached_contents(content_ids, company_id, count=False)
+        users = await self.get_users([row[field] for row in rows for field in ("user_created", "user_updated") if row[field]])
+        return [
+            {**row, "user_created": users.get(row["user_created"]), "user_updated": users.get(row["user_updated"])}
+            for row in rows
+        ]
+
+    def _cached_contents(self, content_ids: List[int], company_id: int, count: bool) -> tuple[List[dict], List[int]]:
+        """
+        Walks the cache from the contents to their grandparents (the levels of the Directus query).
+        Returns the cached rows and the ids missing in the cache.
+        """
+        rows, missing, seen = [], [], set()
+        level = list(content_ids)
+        for _ in range(3):
+            next_level = []
+            for content_id in level:
+                if content_id is None or content_id in seen:
+                    continue
+                seen.add(content_id)
+                cached = self.content_cache.get(content_id) if count else self.content_cache.peek(content_id)
+                if cached is None or cached[0] != company_id:
+                    missing.append(content_id)
+                    continue
+                rows.append(cached[1])
+                next_level.append(cached[1]["parent_id"])
+            level = next_level
+        return rows, missing
+
+    def _cache_content(self, row: dict, company_id: int):
+        """Caches a content row with the ids of its users, their avatar and username go to the user cache."""
+        row = dict(row)
+        for field in ("user_created", "user_updated"):
+            user = row[field]
+            if user:
+                user = dict(user)
+                user_id = user.pop("id", None)
+                if user_id:
+                    self.user_cache[user_id] = user
+                row[field] = user_id
+        self.content_cache[row["content_id"]] = (company_id, row)
+
+    def invalidate_cache(self, collection: str, keys: Optional[List] = None) -> int:
+        """
+        Drops cached contents ("contents") or users ("directus_users"), all of them if keys is None.
+        Returns the number of dropped entries.
+        """
+        caches = {"contents": self.content_cache, "directus_users": self.user_cache}
+        if collection not in caches:
+            raise ValueError(f"No cache for collection '{collection}'.")
+        if collection == "contents" and keys is not None:
+            keys = [int(key) for key in keys]
+        return caches[collection].invalidate(keys)
+
+    def cache_stats(self) -> dict:
+        return {"contents": self.content_cache.stats(), "users": self.user_cache.stats()}
+
+    async def update_item(self, collection: str, item_id, data: dict) -> dict:
+        """Updates an item and drops it from the cache."""
+        item = await super().update_item(collection, item_id, data)
+        if collection in ("contents", "directus_users"):
+            self.invalidate_cache(collection, [item_id])
+        return item
+
+    async def update_items(self, collection: str, item_ids: List, data: dict) -> List[dict]:
+        """Updates items and drops them from the cache."""
+        items = await super().update_items(collection, item_ids, data)
+        if collection in ("contents", "directus_users"):
+            self.invalidate_cache(collection, item_ids)
+        return items
+
+    async def _fetch_contents(self, content_ids: List[int], company_id: int) -> List[dict]:
+        """
+        Fetches contents, their parents and grandparents from Directus, with the ids of their users.
         """
         query = {
             "filter": {
@@ -207,10 +433,28 @@ class DirectusClient(BaseDirectusClient):
                 "user_created.username",
                 "user_updated.avatar",
                 "user_updated.username",
+                "user_created.id",
+                "user_updated.id",
             ],
         }
 
-        return self.read_items("contents", query=query)
+        return await self.read_items("contents", query=query)
+
+    async def get_users(self, user_ids: List[str]) -> dict[str, dict]:
+        """
+        Gets the display data (avatar, username) of users, cached for DIRECTUS_USER_CACHE_TTL seconds.
+        Unknown users are left out.
+        """
+        users = {user_id: self.user_cache.get(user_id) for user_id in set(user_ids)}
+        missing = [user_id for user_id, user in users.items() if user is None]
+        if missing:
+            params = query_params({"filter": {"id": {"_in": missing}}, "fields": ["id", "avatar", "username"]})
+            response = await http_client("directus").get(self._endpoint("users"), params=params, headers=self._headers())
+            response.raise_for_status()
+            for user in response.json().get("data", []):
+                users[user["id"]] = self.user_cache[user["id"]] = {"avatar": user.get("avatar"), "username": user.get("username")}
+
+        return {user_id: user for user_id, user in users.items() if user is not None}
 
     async def getCirclesAccess(self, user_ids: List[str]):
         """
@@ -225,12 +469,12 @@ class DirectusClient(BaseDirectusClient):
         """
         await self.close()
         
-    def upload_file(self, file_data: bytes, filename: str, mime_type: str = None, folder: str = None):
+    async def upload_file(self, file_data: Union[bytes, BinaryIO], filename: str, mime_type: str = None, folder: str = None):
         """
         Uploads a file to Directus and returns the file ID.
         
         Args:
-            file_data: The binary content of the file
+            file_data: The binary content of the file, or a file opened in binary mode (streamed in chunks)
             filename: The name of the file
             mime_type: The MIME type of the file (default: application/pdf)
             mime_type: Optional MIME type (e.g., PDF, DOCX). Will be guessed if not provided.
@@ -239,8 +483,6 @@ class DirectusClient(BaseDirectusClient):
         Returns:
             The file ID if successful, None otherwise
         """
-        from loguru import logger
-        import httpx
         import mimetypes
         try:
             # If no mime_type is provided, try to guess it from the filename
@@ -286,7 +528,9 @@ class DirectusClient(BaseDirectusClient):
             logger.info(f"Form data: {form_data}")
             
             # Send the POST request with files and form_data separate (standard multipart/form-data)
-            response = httpx.post(upload_url, files=files, data=form_data, headers=headers)
+            response = await http_client("directus").post(
+                upload_url, files=files, data=form_data, headers=headers, timeout=_UPLOAD_TIMEOUT
+            )
             
             # Log response status for debugging
             if response.status_code >= 400:
@@ -318,23 +562,14 @@ class UserDirectusClient(BaseDirectusClient):
     """
 
     def __init__(self, directus_url: str, user_token: str):
-        self.url = directus_url
-        self.token = user_token
-        super().__init__(hostname=directus_url, static_token=user_token)
+        super().__init__(directus_url, user_token)
         logger.info("Initialized UserDirectusClient with user token")
 
-    def create_item(self , collection: str, data: dict):
-        url = f"{self.url.rstrip('/')}/items/{collection}"
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json"
-        }
+    async def create_item(self , collection: str, data: dict):
         try :
-            response = httpx.post(url, json=data, headers=headers)
-            response.raise_for_status()
-            result = response.json()
+            result = (await self.create_items(collection, [data]))[0]
             logger.info(f"Successfully created item in Directus collection '{collection}': {result}")
-            return result.get("data")
+            return result
         except httpx.HTTPStatusError as e:
             logger.error(f"HTTP error while creating item :{e.response.status_code} - {e.response.text}")
             raise
@@ -342,13 +577,13 @@ class UserDirectusClient(BaseDirectusClient):
             logger.error(f"Error while creating item in Directus: {e}")
             raise
             
-    def upload_file(self, file_data: bytes, filename: str, mime_type: str = None, folder: str = None):
+    async def upload_file(self, file_data: Union[bytes, BinaryIO], filename: str, mime_type: str = None, folder: str = None):
         """
         Uploads a file to Directus and returns the file ID.
         Uses the user's token directly without admin patching.
         
         Args:
-            file_data: The binary content of the file
+            file_data: The binary content of the file, or a file opened in binary mode (streamed in chunks)
             filename: The name of the file
             mime_type: Optional MIME type (e.g., PDF, DOCX). Will be guessed if not provided.
             folder: Optional folder ID to store the file in, overrides the default content folder
@@ -401,7 +636,9 @@ class UserDirectusClient(BaseDirectusClient):
             logger.info(f"Request URL: {upload_url}")
             
             # Send the POST request with files and form_data separate (standard multipart/form-data)
-            response = httpx.post(upload_url, files=files, data=form_data, headers=headers)
+            response = await http_client("directus").post(
+                upload_url, files=files, data=form_data, headers=headers, timeout=_UPLOAD_TIMEOUT
+            )
             
             # Log response status for debugging
             if response.status_code >= 400:
@@ -435,10 +672,9 @@ class UserDirectusClient(BaseDirectusClient):
                 "Authorization": f"Bearer {self.token}",
                 "Content-Type": "application/json"
             }
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url, headers=headers)
-                response.raise_for_status()
-                return response.json().get("data")
+            response = await http_client("directus").get(url, headers=headers)
+            response.raise_for_status()
+            return response.json().get("data")
         except httpx.HTTPStatusError as e:
             logger.error(f"HTTP error while getting user info: {e.response.status_code} - {e.response.text}")
             raise
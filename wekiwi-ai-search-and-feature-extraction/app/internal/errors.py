@@ -15,4 +15,7 @@ class UserNotFound(ValueError):
 
 
 class CompanyNotFound(ValueError):
-    pass
\ No newline at end of file
+    pass
+
+class InvalidFilter(ValueError):
+    pass
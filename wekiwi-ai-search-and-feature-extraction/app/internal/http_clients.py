@@ -0,0 +1,73 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+import importlib.util
+
+import httpx
+
+from typing import Dict, Literal
+from loguru import logger
+
+from app.config import (
+    HTTP_DIRECTUS_MAX_CONNECTIONS,
+    HTTP_DIRECTUS_TIMEOUT,
+    HTTP_OLLAMA_MAX_CONNECTIONS,
+    HTTP_OLLAMA_TIMEOUT,
+    HTTP_DAW_HUB_MAX_CONNECTIONS,
+    HTTP_DAW_HUB_TIMEOUT,
+    HTTP_KEEPALIVE_EXPIRY,
+)
+
+Upstream = Literal["directus", "ollama", "daw_hub"]
+
+# Max. connections and default timeout per upstream, requests can override the timeout (e.g. uploads)
+_UPSTREAMS = {
+    "directus": (HTTP_DIRECTUS_MAX_CONNECTIONS, HTTP_DIRECTUS_TIMEOUT),
+    "ollama": (HTTP_OLLAMA_MAX_CONNECTIONS, HTTP_OLLAMA_TIMEOUT),
+    "daw_hub": (HTTP_DAW_HUB_MAX_CONNECTIONS, HTTP_DAW_HUB_TIMEOUT),
+}
+
+# HTTP/2 needs the optional h2 package (httpx[http2]), without it the clients use HTTP/1.1 keep-alive
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def _create_client(upstream: Upstream) -> httpx.AsyncClient:
+    max_connections, timeout = _UPSTREAMS[upstream]
+    return httpx.AsyncClient(
+        http2=_HTTP2,
+        timeout=httpx.Timeout(timeout, connect=min(timeout, 10.0)),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+def open_http_clients():
+    """Creates the pooled client of every upstream, called once in the lifespan of the app."""
+    for upstream in _UPSTREAMS:
+        if upstream not in _clients:
+            _clients[upstream] = _create_client(upstream)
+    logger.info(f"HTTP clients opened for {', '.join(_clients)} (HTTP/2: {_HTTP2}).")
+
+
+def http_client(upstream: Upstream) -> httpx.AsyncClient:
+    """
+    Returns the shared client of an upstream. Outside of the app lifespan (e.g. scripts) the client is created
+    on first use. Do not close the returned client or use it as a context manager.
+    """
+    client = _clients.get(upstream)
+    if client is None or client.is_closed:
+        client = _clients[upstream] = _create_client(upstream)
+    return client
+
+
+async def close_http_clients():
+    """Closes all pooled connections, called on shutdown."""
+    for client in _clients.values():
+        await client.aclose()
+    _clients.clear()
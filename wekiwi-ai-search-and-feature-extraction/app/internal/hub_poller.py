@@ -0,0 +1,187 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+import asyncio
+import random
+import re
+import secrets
+import time
+
+from cachetools import TTLCache
+from typing import BinaryIO, Dict, Optional
+from loguru import logger
+
+from app.internal.http_clients import http_client
+from app.config import (
+    DAW_API_HUB_URL,
+    DAW_HUB_KEY,
+    DAW_HUB_POLL_SECONDS_PER_PAGE,
+    DAW_HUB_POLL_SECONDS_PER_MB,
+    DAW_HUB_POLL_MIN_INTERVAL,
+    DAW_HUB_POLL_MAX_INTERVAL,
+    DAW_HUB_POLL_TIMEOUT,
+    DAW_HUB_CALLBACK_URL,
+)
+
+# Page objects of a PDF ("/Type /Page", not "/Type /Pages"), a cheap estimate without parsing the document
+_PDF_PAGE = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def estimate_conversion_seconds(document: BinaryIO) -> float:
+    """
+    Estimated conversion time of a PDF by the hub, from its page count (or its size if no pages are found).
+    The file is scanned in chunks from its start (blocking, run it in a threadpool from async code).
+    """
+    document.seek(0)
+    pages, size, tail = 0, 0, b""
+    chunk = document.read(_CHUNK_SIZE)
+    while chunk:
+        next_chunk = document.read(_CHUNK_SIZE)
+        size += len(chunk)
+        # The end of the previous chunk is carried over for page objects split between two chunks. Matches ending
+        # at the end of a chunk are counted with the next one, which shows whether "/Page" continues ("/Pages").
+        window = tail + chunk
+        pages += sum(
+            len(tail) <= match.end() and (match.end() < len(window) or not next_chunk)
+            for match in _PDF_PAGE.finditer(window)
+        )
+        tail, chunk = window[-32:], next_chunk
+    if pages:
+        return pages * DAW_HUB_POLL_SECONDS_PER_PAGE
+    return size / (1024 * 1024) * DAW_HUB_POLL_SECONDS_PER_MB
+
+
+class _PendingTask:
+    """A conversion task awaited by a caller, with the time and interval of its next poll."""
+
+    def __init__(self, task_id: str, estimate: float, future: asyncio.Future):
+        now = time.monotonic()
+        self.task_id = task_id
+        self.future = future
+        self.interval = max(DAW_HUB_POLL_MIN_INTERVAL, estimate / 4)
+        self.next_poll_at = now + min(max(estimate, DAW_HUB_POLL_MIN_INTERVAL), DAW_HUB_POLL_MAX_INTERVAL)
+        self.deadline = now + max(DAW_HUB_POLL_TIMEOUT, 3 * estimate)
+
+    def back_off(self):
+        """Schedules the next poll, doubling the interval with jitter so tasks started together spread out."""
+        self.next_poll_at = time.monotonic() + self.interval * random.uniform(0.8, 1.2)
+        self.interval = min(self.interval * 2, DAW_HUB_POLL_MAX_INTERVAL)
+
+
+class HubTaskPoller:
+    """
+    Waits for DAW hub conversion tasks. One loop polls all outstanding tasks over the pooled hub client, each task
+    at its own adaptive schedule: first when its estimated conversion time has passed, then with exponential
+    backoff. If DAW_HUB_CALLBACK_URL is set, the hub can also push the completion of a task to the callback
+    endpoint, which ends the wait right away (polling stays as a fallback).
+    """
+
+    def __init__(self):
+        self._pending: Dict[str, _PendingTask] = {}
+        # Tokens of conversions whose submission failed are never awaited, they expire
+        self._callbacks: TTLCache = TTLCache(maxsize=10000, ttl=3600)
+        self._wakeup = asyncio.Event()
+        self._loop_task: Optional[asyncio.Task] = None
+        self._polls: set[asyncio.Task] = set()
+
+    def callback_url(self) -> tuple[Optional[str], Optional[str]]:
+        """
+        Returns a callback URL for a new conversion and its token (both None without DAW_HUB_CALLBACK_URL).
+        Pass the token to `wait` once the hub returned the task id, completions pushed before are kept.
+        """
+        if not DAW_HUB_CALLBACK_URL:
+            return None, None
+        token = secrets.token_urlsafe(24)
+        self._callbacks[token] = asyncio.get_running_loop().create_future()
+        return f"{DAW_HUB_CALLBACK_URL.rstrip('/')}/{token}", token
+
+    def push(self, token: str, status_data: dict) -> bool:
+        """Completes the wait of the task behind a callback token, returns False for unknown or used tokens."""
+        future = self._callbacks.get(token)
+        if future is None or future.done() or status_data.get("status") not in ("completed", "failed"):
+            return False
+        future.set_result(status_data)
+        return True
+
+    async def wait(self, task_id: str, estimate: float, callback_token: Optional[str] = None) -> Optional[dict]:
+        """
+        Waits until the task completed or failed and returns its last status response, None on timeout.
+        `estimate` is the expected conversion time in seconds (see `estimate_conversion_seconds`).
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending[task_id] = _PendingTask(task_id, estimate, future)
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._poll_loop())
+        self._wakeup.set()
+
+        waiters = {future}
+        callback = self._callbacks.get(callback_token) if callback_token else None
+        if callback is not None:
+            waiters.add(callback)
+        try:
+            done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            return next(iter(done)).result()
+        finally:
+            self._pending.pop(task_id, None)
+            if callback_token:
+                self._callbacks.pop(callback_token, None)
+
+    async def stop(self):
+        """Stops polling, called on shutdown (conversions waiting are cancelled by the conversion queue)."""
+        if self._loop_task:
+            tasks = [self._loop_task, *self._polls]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _poll_loop(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            for task in list(self._pending.values()):
+                if task.future.done():
+                    continue
+                if now >= task.deadline:
+                    task.future.set_result(None)
+                elif now >= task.next_poll_at:
+                    # Polls run side by side, a slow status response does not hold up the other tasks
+                    task.next_poll_at = float("inf")
+                    poll = asyncio.create_task(self._poll(task))
+                    self._polls.add(poll)
+                    poll.add_done_callback(self._poll_done)
+
+            waiting = [task for task in self._pending.values() if not task.future.done()]
+            timeout = min((min(task.next_poll_at, task.deadline) - now for task in waiting), default=None)
+            # Woken up by new tasks and finished polls, or when the next poll or deadline is due
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except TimeoutError:
+                pass
+
+    async def _poll(self, task: _PendingTask):
+        status_endpoint = f"{DAW_API_HUB_URL.rstrip('/')}/docling/docling/task-status/{task.task_id}"
+        headers = {"accept": "application/json", "DAW-Hub-Key": DAW_HUB_KEY}
+        try:
+            response = await http_client("daw_hub").get(status_endpoint, headers=headers, timeout=30.0)
+            response.raise_for_status()
+            status_data = response.json()
+            current_status = status_data.get("status")
+            logger.info(f"Conversion task {task.task_id}: status = {current_status}")
+            if current_status in ("completed", "failed") and not task.future.done():
+                task.future.set_result(status_data)
+                return
+        except Exception as e:
+            # Keep polling until the deadline, the hub may be restarting
+            logger.error(f"Error polling status of conversion task {task.task_id}: {e}")
+        task.back_off()
+
+    def _poll_done(self, poll: asyncio.Task):
+        self._polls.discard(poll)
+        self._wakeup.set()
+
+
+hub_poller = HubTaskPoller()
@@ -0,0 +1,114 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+import asyncio
+import time
+import uuid
+
+from typing import Any, Coroutine, Dict, Literal, Optional
+from pydantic import BaseModel, Field
+from loguru import logger
+
+
+class StageProgress(BaseModel):
+    """Counter of one stage of a job, e.g. contents fetched or chunks embedded."""
+    done: int = 0
+    total: Optional[int] = None
+    initial: int = Field(default=0, description="Work done before this run started (e.g. resumed from a checkpoint), excluded from the throughput.")
+    per_second: float = 0.0
+
+
+class Job(BaseModel):
+    """State of a long running background job (e.g. a MilvusDB rebuild)."""
+    job_id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    kind: str
+    status: Literal['queued', 'running', 'completed', 'failed'] = 'queued'
+    created_at: float = Field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    last_progress_at: Optional[float] = Field(default=None, description="Time of the last counter update, to detect stalled jobs.")
+    message: Optional[str] = None
+    error: Optional[str] = None
+    stages: Dict[str, StageProgress] = Field(default_factory=dict)
+    eta_stage: Optional[str] = Field(default=None, description="Stage whose total defines the end of the job, used for the ETA.")
+    eta_seconds: Optional[float] = None
+    detail: Dict[str, Any] = Field(default_factory=dict)
+
+    def add_stage(self, name: str, total: Optional[int] = None, initial: int = 0):
+        """Registers a stage counter, point eta_stage at it to let it drive the ETA."""
+        self.stages[name] = StageProgress(done=initial, total=total, initial=initial)
+
+    def advance(self, stage: str, count: int = 1):
+        """Adds to a stage counter and refreshes throughput and ETA."""
+        now = time.time()
+        progress = self.stages.setdefault(stage, StageProgress())
+        progress.done += count
+        self.last_progress_at = now
+
+        elapsed = now - (self.started_at or self.created_at)
+        if elapsed > 0:
+            progress.per_second = round((progress.done - progress.initial) / elapsed, 2)
+
+        if stage == self.eta_stage and progress.total is not None and progress.per_second > 0:
+            self.eta_seconds = round(max(progress.total - progress.done, 0) / progress.per_second, 1)
+
+
+class JobRegistry:
+    """
+    Keeps track of background jobs started by the API and the asyncio tasks running them.
+    Jobs live in memory only, they are lost on restart (the rebuild itself resumes from its checkpoint).
+    """
+
+    def __init__(self, max_finished_jobs: int = 100):
+        self.jobs: Dict[str, Job] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.max_finished_jobs = max_finished_jobs
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def running(self, kind: str) -> Optional[Job]:
+        """Returns the queued or running job of the given kind, if any."""
+        for job in self.jobs.values():
+            if job.kind == kind and job.status in ('queued', 'running'):
+                return job
+        return None
+
+    def start(self, job: Job, coroutine: Coroutine) -> Job:
+        """Registers the job and runs the coroutine as an asyncio task, recording its outcome on the job."""
+        self._evict_finished()
+        self.jobs[job.job_id] = job
+        self.tasks[job.job_id] = asyncio.create_task(self._run(job, coroutine))
+        return job
+
+    async def _run(self, job: Job, coroutine: Coroutine):
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            job.message = await coroutine
+            job.status = 'completed'
+            job.eta_seconds = 0.0
+            logger.info(f"Job {job.job_id} ({job.kind}) completed: {job.message}")
+        except asyncio.CancelledError:
+            job.status = 'failed'
+            job.error = "Cancelled"
+            raise
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            logger.error(f"Job {job.job_id} ({job.kind}) failed: {e}")
+        finally:
+            job.finished_at = time.time()
+            self.tasks.pop(job.job_id, None)
+
+    def _evict_finished(self):
+        finished = [job for job in self.jobs.values() if job.finished_at is not None]
+        for job in sorted(finished, key=lambda job: job.finished_at)[:max(0, len(finished) - self.max_finished_jobs + 1)]:
+            self.jobs.pop(job.job_id, None)
+
+    async def cancel_all(self):
+        """Cancels all running jobs, used on shutdown."""
+        for task in list(self.tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
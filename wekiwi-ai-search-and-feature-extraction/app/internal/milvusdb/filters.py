@@ -0,0 +1,161 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+"""
+Builders for MilvusDB filter expressions (see https://milvus.io/docs/boolean.md).
+
+All values are cast to their field type before rendering, so no request value is ever interpolated as is.
+Rendered expressions are cached, the same tenant/circle filters are built for most searches.
+pymilvus 2.4 does not support expression templates with parameters yet, expressions are rendered as strings.
+"""
+
+import json
+import re
+
+from functools import lru_cache
+from typing import Iterable, Literal
+
+from app.internal.errors import InvalidFilter
+
+
+# Fields a user supplied filter may reference (no long text fields, no vectors)
+USER_FILTER_FIELDS = frozenset({
+    "content_id",
+    "content_type",
+    "parent_id",
+    "date_created",
+    "date_updated",
+    "user_created",
+    "user_updated",
+    "file_id",
+    "circle_ids",
+    "topics",
+    "keywords",
+})
+
+_USER_FILTER_KEYWORDS = frozenset({"and", "or", "not", "in", "like", "true", "false"})
+_USER_FILTER_FUNCTIONS = frozenset({"array_contains", "array_contains_all", "array_contains_any", "array_length"})
+_USER_FILTER_MAX_LENGTH = 1024
+
+_TOKEN_PATTERN = re.compile(
+    r'\s*(?:'
+    r'(?P<string>"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')'
+    r'|(?P<number>\d+(?:\.\d+)?)'
+    r'|(?P<name>[A-Za-z_][A-Za-z0-9_]*)'
+    r'|(?P<operator>==|!=|<=|>=|&&|\|\||[<>()\[\],+\-*/%!])'
+    r')'
+)
+
+DateField = Literal["date_created", "date_updated"]
+ContentType = Literal["text", "image", "audio"]
+
+
+def _int_list(values: Iterable[int]) -> str:
+    return json.dumps([int(value) for value in values])
+
+
+@lru_cache(maxsize=1024)
+def company(company_id: int) -> str:
+    """Restricts to one company, company_id is the partition key."""
+    return f"company_id == {int(company_id)}"
+
+
+@lru_cache(maxsize=1024)
+def any_circle(circle_ids: tuple[int, ...]) -> str:
+    """Chunks posted in at least one of the circles."""
+    return f"ARRAY_CONTAINS_ANY(circle_ids, {_int_list(circle_ids)})"
+
+
+@lru_cache(maxsize=1024)
+def in_circle(circle_id: int) -> str:
+    """Chunks posted in the circle."""
+    return f"ARRAY_CONTAINS(circle_ids, {int(circle_id)})"
+
+
+def primary_ids(primary_ids: Iterable[int]) -> str:
+    return f"id in {_int_list(primary_ids)}"
+
+
+def content_id(content_id: int) -> str:
+    return f"content_id == {int(content_id)}"
+
+
+def content_ids(content_ids: Iterable[int]) -> str:
+    return f"content_id in {_int_list(content_ids)}"
+
+
+@lru_cache(maxsize=256)
+def content_types(content_types: tuple[ContentType, ...]) -> str:
+    for content_type in content_types:
+        if content_type not in ContentType.__args__:
+            raise InvalidFilter(f"Unknown content_type '{content_type}'.")
+    return f"content_type in {json.dumps(list(content_types))}"
+
+
+def date_range(field: DateField, start: int | None = None, end: int | None = None) -> str | None:
+    """Unix timestamps, both bounds inclusive. Returns None if no bound is given."""
+    if field not in DateField.__args__:
+        raise InvalidFilter(f"'{field}' is not a date field.")
+    conditions = []
+    if start is not None:
+        conditions.append(f"{field} >= {int(start)}")
+    if end is not None:
+        conditions.append(f"{field} <= {int(end)}")
+    return " and ".join(conditions) or None
+
+
+def all_of(*expressions: str | None) -> str:
+    """Combines expressions with 'and', skipping empty ones."""
+    return " and ".join(expression for expression in expressions if expression)
+
+
+def tenant(company_id: int, expression: str | None = None) -> str:
+    """
+    Scopes an expression to a company. The partition key condition leads the expression, which lets
+    MilvusDB only search/query the partition the company is hashed to instead of filtering all partitions.
+    """
+    return all_of(company(company_id), f"({expression})" if expression else None)
+
+
+@lru_cache(maxsize=1024)
+def user_filter(expression: str | None) -> str | None:
+    """
+    Validates a raw user filter and returns it wrapped in parentheses, or None if it is empty.
+    Only fields from USER_FILTER_FIELDS, literals, operators and array functions are accepted and parentheses
+    must be balanced, so the filter cannot widen the company/circle restriction it is combined with.
+    """
+    if not expression or not expression.strip():
+        return None
+    if len(expression) > _USER_FILTER_MAX_LENGTH:
+        raise InvalidFilter(f"Filter is longer than {_USER_FILTER_MAX_LENGTH} characters.")
+
+    brackets = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = _TOKEN_PATTERN.match(expression, position)
+        if not match or match.end() == position:
+            raise InvalidFilter(f"Invalid filter at position {position}: '{expression[position:position + 16]}'.")
+        position = match.end()
+
+        if name := match.group("name"):
+            if name not in USER_FILTER_FIELDS and name.lower() not in _USER_FILTER_KEYWORDS | _USER_FILTER_FUNCTIONS:
+                raise InvalidFilter(f"Field '{name}' is not allowed in filters.")
+        elif operator := match.group("operator"):
+            if operator in "([":
+                brackets.append(operator)
+            elif operator in ")]":
+                if not brackets or brackets.pop() + operator not in ("()", "[]"):
+                    raise InvalidFilter("Unbalanced parentheses in filter.")
+
+    if brackets:
+        raise InvalidFilter("Unbalanced parentheses in filter.")
+
+    return f"({expression})"
+
+
+@lru_cache(maxsize=1024)
+def search_filter(circle_ids: tuple[int, ...], expression: str | None = None) -> str:
+    """Filter of a search within a company: the circles the user has access to and the optional user filter."""
+    return all_of(any_circle(circle_ids), user_filter(expression))
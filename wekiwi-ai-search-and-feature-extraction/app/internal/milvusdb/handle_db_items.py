@@ -8,15 +8,21 @@ import asyncio
 import re
 
 from fastapi import Request, BackgroundTasks
-from typing import List
+from starlette.concurrency import run_in_threadpool
+from typing import Callable, List
 from loguru import logger
 
-from app.internal.types import ContentValidated, ContentOptional
+from app.internal.jobs import Job
+from app.internal.types import ContentValidated, ContentOptional, ContentCreateItem, ContentCreateResult, ContentCirclesUpdate, MAX_CIRCLE_IDS
+from app.internal.milvusdb import filters
+from app.internal.milvusdb.milvusdb import CONTENT_VECTOR_FIELDS, CONTENT_SCALAR_FIELDS
 from app.internal.utils.text_splitter import text_splitter
 from app.internal.utils.sanitize_text import sanitize_text
 
 from app.internal.utils.generate_title import generate_german_title
 
+from app.config import BULK_PREPARE_CONCURRENCY, BULK_EMBED_BATCH_SIZE, BULK_INSERT_BATCH_SIZE, CHUNK_REWRITE_BATCH_SIZE
+
 
 async def create_content_chunks(
     request: Request,
@@ -27,13 +33,29 @@ async def create_content_chunks(
 ) -> list[dict]:
     """Creates or updates database items with optional text and title embeddings."""
     
+    title, text_chunks = await prepare_content_chunks(request, background_tasks, content)
+
+    return await embed_content_chunks(request, content, title, text_chunks, company_id, circle_ids)
+
+
+def split_content_text(text: str) -> list[str]:
+    """Sanitizes and splits the content text into chunks (CPU bound, run it in a threadpool where possible)."""
+    if re.match(r'^\s*$', text):
+        return [""]
+    # XML/ElementTree objects are now handled by ContentValidated validator
+    document_chunks = text_splitter(sanitize_text(text))
+    return [doc.page_content for doc in document_chunks]
+
+
+async def prepare_content_chunks(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    content: ContentValidated,
+) -> tuple[str, list[str]]:
+    """Splits the content text into chunks and generates a title if none is provided."""
+    
     # Split text into chunks
-    if re.match(r'^\s*$', content.text):
-        text_chunks = [""]
-    else:
-        # XML/ElementTree objects are now handled by ContentValidated validator
-        document_chunks = text_splitter(sanitize_text(content.text))
-        text_chunks = [doc.page_content for doc in document_chunks]      
+    text_chunks = await run_in_threadpool(split_content_text, content.text)
         
     # Generate title if not provided
     if re.match(r'^\s*$', content.title):
@@ -48,6 +70,19 @@ async def create_content_chunks(
 
     logger.info(f"Processing content_id: {content.content_id} text chunks: {len(text_chunks)}, title: {title}") 
 
+    return title, text_chunks
+
+
+async def embed_content_chunks(
+    request: Request,
+    content: ContentValidated,
+    title: str,
+    text_chunks: list[str],
+    company_id: str = None,
+    circle_ids: List[str] = None,
+) -> list[dict]:
+    """Embeds the title and text chunks of a content and builds the MilvusDB items."""
+
     # Create embedding tasks
     embedding_tasks = [
         request.state.textrequestProcessor.process_request(title, "embed"),  # Title embedding
@@ -60,11 +95,11 @@ async def create_content_chunks(
     # Gather and process ALL embedding results using a single asyncio.gather
     embedding_results = await asyncio.gather(*embedding_tasks)
 
-    title_embedding_dense = embedding_results[0]  # First result is title embedding
+    title_embedding_dense = await embedding_results[0]  # First result is title embedding
 
-    # Separate dense and sparse embeddings
-    text_embeddings_dense = embedding_results[1::2]  # Every other result starting from the second
-    text_embeddings_sparse = embedding_results[2::2]  # Every other result starting from the third
+    # Separate dense and sparse embeddings (await the futures, so the results are ready)
+    text_embeddings_dense = await asyncio.gather(*embedding_results[1::2])  # Every other result starting from the second
+    text_embeddings_sparse = await asyncio.gather(*embedding_results[2::2])  # Every other result starting from the third
 
     # Create list of content chunks
     items = []
@@ -74,82 +109,377 @@ async def create_content_chunks(
             "text": chunk,
             "company_id": company_id,
             "circle_ids": circle_ids,
-            "title_embedding_dense": title_embedding_dense.result(),
-            "text_embedding_dense": text_embeddings_dense[index].result(), 
-            "text_embedding_sparse": text_embeddings_sparse[index].result() or {0:0.0},  
+            "title_embedding_dense": title_embedding_dense,
+            "text_embedding_dense": text_embeddings_dense[index], 
+            "text_embedding_sparse": text_embeddings_sparse[index] or {0:0.0},  
         }
         items.append(item)
 
     return items
     
+async def embed_contents_bulk(
+    request: Request,
+    prepared: list[tuple[ContentValidated, str, list[str], int, List[int]]],
+    batch_size: int = BULK_EMBED_BATCH_SIZE,
+) -> list[list[dict]]:
+    """
+    Embeds the titles and text chunks of many contents together and builds their MilvusDB items.
+    Inputs of all contents are submitted in batches of batch_size, so the models see full batches
+    across document boundaries instead of one request per chunk.
+    """
+    dense_inputs, sparse_inputs = [], []
+    for _, title, text_chunks, _, _ in prepared:
+        dense_inputs.append(title)
+        dense_inputs.extend(text_chunks)
+        sparse_inputs.extend(text_chunks)
+
+    async def embed(processor, inputs: list[str]) -> list:
+        futures = await asyncio.gather(*[
+            processor.process_batch(inputs[i:i + batch_size], "embed") for i in range(0, len(inputs), batch_size)
+        ])
+        return [result for batch in await asyncio.gather(*futures) for result in batch]
+
+    dense_results, sparse_results = await asyncio.gather(
+        embed(request.state.textrequestProcessor, dense_inputs),
+        embed(request.state.textrequestProcessor1, sparse_inputs),
+    )
+
+    # Walk the flat results in the same order they were submitted
+    items_per_content = []
+    dense_index, sparse_index = 0, 0
+    for content, _, text_chunks, company_id, circle_ids in prepared:
+        title_embedding_dense = dense_results[dense_index]
+        dense_index += 1
+
+        items = []
+        for chunk in text_chunks:
+            items.append({
+                **content.model_dump(),
+                "text": chunk,
+                "company_id": company_id,
+                "circle_ids": circle_ids,
+                "title_embedding_dense": title_embedding_dense,
+                "text_embedding_dense": dense_results[dense_index],
+                "text_embedding_sparse": sparse_results[sparse_index] or {0:0.0},
+            })
+            dense_index += 1
+            sparse_index += 1
+        items_per_content.append(items)
+
+    return items_per_content
+
+
+async def create_contents_bulk(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    items: List[ContentCreateItem],
+    job: Job,
+) -> List[ContentCreateResult]:
+    """
+    Creates MilvusDB items for many contents: prepares (title, split) them concurrently, embeds all chunks
+    together and writes them in a few large inserts. A failing content does not fail the others.
+    """
+    results = [ContentCreateResult(content_id=item.content.content_id, status="created") for item in items]
+
+    def fail(index: int, error: str):
+        logger.error(f"Bulk create failed for content ID {items[index].content.content_id}: {error}")
+        results[index].status = "failed"
+        results[index].error = error
+
+    job.add_stage("contents_prepared", total=len(items))
+    job.add_stage("chunks_embedded")
+    job.add_stage("rows_written")
+    job.eta_stage = "contents_prepared"
+
+    # Generate titles and split texts, bounded because title generation calls the LLM
+    semaphore = asyncio.Semaphore(BULK_PREPARE_CONCURRENCY)
+
+    async def prepare(item: ContentCreateItem):
+        async with semaphore:
+            if not item.content.title and not item.content.text:
+                raise ValueError("Title or text must be provided.")
+            prepared = await prepare_content_chunks(request, background_tasks, item.content)
+            job.advance("contents_prepared")
+            return prepared
+
+    prepared_results = await asyncio.gather(*[prepare(item) for item in items], return_exceptions=True)
+
+    prepared, prepared_indices = [], []
+    for index, (item, result) in enumerate(zip(items, prepared_results)):
+        if isinstance(result, Exception):
+            fail(index, str(result))
+            continue
+        title, text_chunks = result
+        prepared.append((item.content, title, text_chunks, item.company_id, item.circle_ids))
+        prepared_indices.append(index)
+
+    if not prepared:
+        return results
+
+    # Embed the chunks of all contents together
+    job.stages["chunks_embedded"].total = sum(len(text_chunks) for _, _, text_chunks, _, _ in prepared)
+    job.eta_stage = "chunks_embedded"
+    items_per_content = await embed_contents_bulk(request, prepared)
+    job.advance("chunks_embedded", job.stages["chunks_embedded"].total)
+
+    # Write in large inserts, a failing insert only fails the contents in that batch
+    job.stages["rows_written"].total = job.stages["chunks_embedded"].total
+    job.eta_stage = "rows_written"
+    batch_indices, batch_items = [], []
+
+    async def write():
+        try:
+            async with request.state.milvusdbclient.content_writes({row["content_id"] for row in batch_items}):
+                await request.state.milvusdbclient.insert_data(batch_items)
+            job.advance("rows_written", len(batch_items))
+        except Exception as e:
+            for index in batch_indices:
+                fail(index, f"Insert failed: {e}")
+
+    for index, db_items in zip(prepared_indices, items_per_content):
+        results[index].chunks = len(db_items)
+        batch_indices.append(index)
+        batch_items.extend(db_items)
+        if len(batch_items) >= BULK_INSERT_BATCH_SIZE:
+            await write()
+            batch_indices, batch_items = [], []
+
+    if batch_items:
+        await write()
+
+    return results
+
+
+def diff_content_chunks(
+    content_chunks: List[dict],
+    text_chunks: list[str],
+) -> tuple[list[dict], list[dict], list[str]]:
+    """
+    Matches the new text chunks against the stored rows by their text.
+    Returns the rows to keep, the rows to remove and the chunks that need to be embedded.
+    """
+    unmatched = {}
+    for row in content_chunks:
+        unmatched.setdefault(row["text"], []).append(row)
+
+    kept, added = [], []
+    for chunk in text_chunks:
+        rows = unmatched.get(chunk)
+        if rows:
+            kept.append(rows.pop())
+        else:
+            added.append(chunk)
+
+    removed = [row for rows in unmatched.values() for row in rows]
+    return kept, removed, added
+
+
 async def update_content_chunks(
     request: Request,
     content: ContentOptional,
     content_chunks: List[dict],
     company_id: str | None = None,
     circle_ids: List[str] | None = None,
-) -> list[dict]:
-    """Updates database items with optional text and title embeddings."""
+) -> tuple[list[dict], list[int]]:
+    """
+    Updates the text of a content chunk-wise. Returns the items to insert and the primary ids to delete.
 
-    embedding_tasks = []
-    text_embeddings_dense = []
-    text_embeddings_sparse = []
-
-    if not content.text or re.match(r'^\s*$', content.text):
-        # Reuse existing text chunks and extract embeddings with a single loop
-        text_chunks = []
-        for chunk in content_chunks:
-            text_chunks.append(chunk["text"])
-            text_embeddings_dense.append(chunk.get("text_embedding_dense"))
-            text_embeddings_sparse.append(chunk.get("text_embedding_sparse"))
-    else:
-        # Text chunks need to be re-created and embedded
-        # XML/ElementTree objects are now handled by ContentValidated/ContentOptional validator
-        document_chunks = text_splitter(sanitize_text(content.text))
-        text_chunks = [doc.page_content for doc in document_chunks] 
-        
-        logger.info(f"Re-creating and processing text chunks.")
+    content_chunks are the stored rows without vectors. Unchanged chunks keep their rows (or, if other fields
+    changed, their embeddings), only new chunks are embedded and only vanished chunks are deleted.
+    """
+    text_chunks = await run_in_threadpool(split_content_text, content.text)
+    kept, removed, added = diff_content_chunks(content_chunks, text_chunks)
 
-        # Create dense and sparse embedding tasks
-        for chunk in text_chunks:
-            embedding_tasks.append(request.state.textrequestProcessor.process_request(chunk, "embed"))
-            embedding_tasks.append(request.state.textrequestProcessor1.process_request(chunk, "embed"))
+    updates = content.model_dump(exclude_none=True, exclude={"text"})
+    if company_id:
+        updates["company_id"] = company_id
+    if circle_ids:
+        updates["circle_ids"] = circle_ids
 
+    def updated(row: dict) -> dict:
+        return {**row, **updates}
 
-    # Create title embedding task only if content.title is provided
-    if content.title:
-        embedding_tasks.append(request.state.textrequestProcessor.process_request(content.title, "embed"))
+    reference = content_chunks[0]
+    title_changed = updated(reference)["title"] != reference["title"]
+    rewritten = [row for row in kept if updated(row) != row]
 
-    # Execute all gathered embedding tasks concurrently
-    embedding_results = await asyncio.gather(*embedding_tasks)
+    logger.info(
+        f"Content ID {content.content_id}: {len(kept)} chunks unchanged ({len(rewritten)} with changed fields), "
+        f"{len(added)} added, {len(removed)} removed."
+    )
 
-    # Extract title embedding (if generated)
-    title_embedding = embedding_results.pop(0).result() if content.title else content_chunks[0].get("title_embedding_dense")
+    # Only fetch the vectors of rows that are re-written (and a title embedding to re-use for new chunks)
+    fetch_ids = [row["id"] for row in rewritten]
+    if added and not title_changed and not fetch_ids:
+        fetch_ids = [reference["id"]]
+    vector_rows = {}
+    if fetch_ids:
+        vector_rows = {
+            row["id"]: row for row in await request.state.milvusdbclient.get_data(
+                primary_ids=fetch_ids, output_fields=["id", *CONTENT_VECTOR_FIELDS]
+            )
+        }
 
-    # If text embedding were generated, extract them
-    if content.text:
-        text_embeddings_dense = [res.result() for res in embedding_results[1::2]]
-        text_embeddings_sparse = [res.result() for res in embedding_results[::2]]
+    # Create embedding tasks for the title (if changed) and the new chunks only
+    embedding_tasks = []
+    if title_changed and (added or rewritten):
+        embedding_tasks.append(request.state.textrequestProcessor.process_request(updates["title"], "embed"))
+    for chunk in added:
+        embedding_tasks.append(request.state.textrequestProcessor.process_request(chunk, "embed"))  # Dense
+        embedding_tasks.append(request.state.textrequestProcessor1.process_request(chunk, "embed"))  # Sparse
+
+    embedding_results = await asyncio.gather(*await asyncio.gather(*embedding_tasks))
+
+    if title_changed and (added or rewritten):
+        title_embedding = embedding_results.pop(0)
+    elif vector_rows:
+        title_embedding = next(iter(vector_rows.values()))["title_embedding_dense"]
+    else:
+        title_embedding = None  # Nothing is inserted
+
+    text_embeddings_dense = embedding_results[0::2]
+    text_embeddings_sparse = embedding_results[1::2]
 
-    # Create list of content chunks
     items = []
-    for index, chunk in enumerate(text_chunks):
+    for row in rewritten:
+        vectors = vector_rows[row["id"]]
+        item = {
+            **updated(row),
+            "title_embedding_dense": title_embedding if title_changed else vectors["title_embedding_dense"],
+            "text_embedding_dense": vectors["text_embedding_dense"],
+            "text_embedding_sparse": vectors["text_embedding_sparse"] or {0:0.0},
+        }
+        item.pop("id", None) # Remove id (auto-generated by MilvusDB)
+        items.append(item)
+
+    for index, chunk in enumerate(added):
         item = {
-            **content_chunks[index],
-            **content.model_dump(exclude_none=True), #, exclude=["company_id", "circle_ids"]
+            **updated(reference),
             "text": chunk,
             "title_embedding_dense": title_embedding,
             "text_embedding_dense": text_embeddings_dense[index],
             "text_embedding_sparse": text_embeddings_sparse[index] or {0:0.0},
         }
         item.pop("id", None) # Remove id (auto-generated by MilvusDB)
-        
-        if company_id:
-            item["company_id"] = company_id
-        if circle_ids:
-            item["circle_ids"] = circle_ids
-        
         items.append(item)
 
-    return items
-    
\ No newline at end of file
+    delete_ids = [row["id"] for row in removed] + [row["id"] for row in rewritten]
+
+    return items, delete_ids
+
+
+async def rewrite_content_chunks(
+    request: Request,
+    content_chunks: List[dict],
+    transform: Callable[[dict], dict],
+    title_embedding: list[float] | None = None,
+    batch_size: int = CHUNK_REWRITE_BATCH_SIZE,
+) -> int:
+    """
+    Applies transform to stored rows (scalar fields only, including "id") and re-writes the rows that changed.
+    Returns the number of re-written rows.
+
+    Vectors are never re-computed, but every changed row is still read and re-written with its vectors:
+    MilvusDB 2.4 cannot update single fields, and search filters on circle_ids inside the vector rows. Changed
+    rows are re-inserted with their stored vectors (and title_embedding, if given) and the old rows are deleted
+    by primary id, so a circle change on a large document costs about as much as re-inserting its chunks.
+    """
+    changed = []
+    for row in content_chunks:
+        updated_row = transform(row)
+        if updated_row != row or title_embedding is not None:
+            changed.append(updated_row)
+
+    for i in range(0, len(changed), batch_size):
+        batch = changed[i:i + batch_size]
+        primary_ids = [row["id"] for row in batch]
+
+        vector_rows = {
+            row["id"]: row for row in await request.state.milvusdbclient.get_data(
+                primary_ids=primary_ids, output_fields=["id", *CONTENT_VECTOR_FIELDS]
+            )
+        }
+
+        items = []
+        for row in batch:
+            vectors = vector_rows[row["id"]]
+            item = {
+                **row,
+                "title_embedding_dense": title_embedding if title_embedding is not None else vectors["title_embedding_dense"],
+                "text_embedding_dense": vectors["text_embedding_dense"],
+                "text_embedding_sparse": vectors["text_embedding_sparse"] or {0:0.0},
+            }
+            item.pop("id", None) # Remove id (auto-generated by MilvusDB)
+            items.append(item)
+
+        # Insert before deleting, so the chunks never disappear from search
+        async with request.state.milvusdbclient.content_writes({row["content_id"] for row in batch}):
+            await request.state.milvusdbclient.insert_data(items)
+            await request.state.milvusdbclient.delete_data(primary_ids=primary_ids)
+
+    return len(changed)
+
+
+async def update_content_circles_bulk(
+    request: Request,
+    update: ContentCirclesUpdate,
+    job: Job,
+    batch_size: int = CHUNK_REWRITE_BATCH_SIZE,
+) -> tuple[int, int]:
+    """
+    Changes the circle_ids of all chunks matching the update, in batches of whole contents.
+    Only the ids of the matching chunks are read up front, contents whose circle_ids do not change are not written.
+    Contents that would end up in more than MAX_CIRCLE_IDS circles are skipped and listed in job.detail.
+    Returns the number of matched contents and re-written chunks.
+    """
+    filter_expr = filters.all_of(
+        filters.content_ids(update.content_ids) if update.content_ids is not None else None,
+        filters.in_circle(update.circle_id) if update.circle_id is not None else None,
+    )
+
+    # Snapshot the matching rows first, re-written rows get new primary ids and must not be visited again
+    primary_ids_per_content = {}
+    for row in await request.state.milvusdbclient.query_all(
+        filter_expr, output_fields=["id", "content_id"], company_id=update.company_id
+    ):
+        primary_ids_per_content.setdefault(row["content_id"], []).append(row["id"])
+
+    job.detail["skipped_content_ids"] = []
+    job.add_stage("contents_updated", total=len(primary_ids_per_content))
+    job.add_stage("chunks_rewritten")
+    job.eta_stage = "contents_updated"
+    logger.info(f"Updating circle_ids of {len(primary_ids_per_content)} contents.")
+
+    def transform(row: dict) -> dict:
+        return {**row, "circle_ids": update.apply(row["circle_ids"])}
+
+    # Batches hold whole contents, so the chunks of a content always share the same circle_ids
+    batch_content_ids, batch_primary_ids = [], []
+
+    async def flush():
+        content_chunks = await request.state.milvusdbclient.get_data(
+            primary_ids=batch_primary_ids, output_fields=CONTENT_SCALAR_FIELDS, company_id=update.company_id
+        )
+
+        # Checked before writing, a content exceeding the capacity of circle_ids would fail the whole insert
+        skipped_ids = {row["content_id"] for row in content_chunks if len(update.apply(row["circle_ids"])) > MAX_CIRCLE_IDS}
+        if skipped_ids:
+            logger.warning(f"Skipping contents {sorted(skipped_ids)}, they would be in more than {MAX_CIRCLE_IDS} circles.")
+            job.detail["skipped_content_ids"].extend(sorted(skipped_ids))
+            content_chunks = [row for row in content_chunks if row["content_id"] not in skipped_ids]
+
+        rewritten = await rewrite_content_chunks(request, content_chunks, transform, batch_size=batch_size)
+        job.advance("chunks_rewritten", rewritten)
+        job.advance("contents_updated", len(batch_content_ids))
+
+    for content_id, primary_ids in primary_ids_per_content.items():
+        batch_content_ids.append(content_id)
+        batch_primary_ids.extend(primary_ids)
+        if len(batch_primary_ids) >= batch_size:
+            await flush()
+            batch_content_ids, batch_primary_ids = [], []
+
+    if batch_primary_ids:
+        await flush()
+
+    return len(primary_ids_per_content), job.stages["chunks_rewritten"].done
@@ -11,15 +11,34 @@ from pymilvus import (
     FieldSchema,
     DataType,
     connections,
-    Collection
+    Collection,
+    MilvusException,
 )
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+from typing import Callable, Iterable
 from loguru import logger
 
+import asyncio
+import math
+import time
+
+from app.internal.milvusdb import filters
+from app.internal.types import MAX_CIRCLE_IDS
+from app.config import (
+    SEARCH_CANDIDATE_FACTOR_MIN,
+    SEARCH_CANDIDATE_FACTOR_MAX,
+    SEARCH_CANDIDATE_RETRIES,
+    SEARCH_ROW_COUNT_CACHE_TTL,
+)
+
 _MAX_LENGTH_TEXT = 20480
 _MAX_LENGTH_TITLE = 368
 
 _CONTENT_COLLECTION_NAME = "contents"
 
+_MAX_SEARCH_LIMIT = 16384  # Max. topk (and offset + limit) of a MilvusDB search
+
 _COLLECTION_SCHEMA = CollectionSchema(
     auto_id=True,
     enable_dynamic_field=False,
@@ -56,7 +75,7 @@ _COLLECTION_SCHEMA = CollectionSchema(
             name="circle_ids",
             dtype=DataType.ARRAY,
             element_type=DataType.INT32,
-            max_capacity=8,
+            max_capacity=MAX_CIRCLE_IDS,
         ),##
         FieldSchema(
             name="topics",
@@ -100,6 +119,9 @@ _COLLECTION_SCHEMA = CollectionSchema(
     partition_key_field="company_id",
 )
 
+CONTENT_VECTOR_FIELDS = ["title_embedding_dense", "text_embedding_dense", "text_embedding_sparse"]
+CONTENT_SCALAR_FIELDS = [field.name for field in _COLLECTION_SCHEMA.fields if field.name not in CONTENT_VECTOR_FIELDS]
+
 class MilvusClient(BaseMilvusClient):
     """A class to manage the connection to a Milvus server, perform vector operations and edit content fields."""
 
@@ -108,6 +130,14 @@ class MilvusClient(BaseMilvusClient):
     ):  # db_name: str = "milvus"):
         self.host = host
         self.port = port
+        self._row_counts = TTLCache(maxsize=4096, ttl=SEARCH_ROW_COUNT_CACHE_TTL)  # (collection, filter) -> rows
+        # Contents written to the live collection while a rebuild fills a shadow collection, see content_writes
+        self._tracked_shadow: str | None = None
+        self._changed_content_ids: set[int] = set()
+        self._on_content_change: Callable[[list[int]], None] | None = None
+        self._running_writes = 0
+        self._writes_idle = asyncio.Event()
+        self._writes_idle.set()
         super().__init__(
             uri=f"http://{self.host}:{self.port}"
         )  # , db_name=self.db_name
@@ -121,52 +151,15 @@ class MilvusClient(BaseMilvusClient):
         try:
 
             if not self.has_collection(_CONTENT_COLLECTION_NAME):
-                
-                # Create HNSW indexes on vector fields
-                index_params = self.prepare_index_params()
-
-                # Add indexes for different fields
-                index_params.add_index(
-                    field_name="title_embedding_dense",
-                    index_type="HNSW",
-                    index_name="title_embedding_dense",
-                    M=16, 
-                    efConstruction=200,
-                    metric_type="IP"  # COSINE
-                )
-
-                index_params.add_index(
-                    field_name="text_embedding_dense",
-                    index_type="HNSW",
-                    index_name="text_embedding_dense",
-                    M=16,
-                    efConstruction=200,
-                    metric_type="IP"  # COSINE
-                )
-
-                index_params.add_index(
-                    field_name="text_embedding_sparse",
-                    index_type="SPARSE_INVERTED_INDEX",
-                    index_name="text_embedding_sparse",
-                    metric_type="IP"  # COSINE
-                )
-                
-                # TODO: Add time embedings
-                # index_params.add_index(
-                #     field_name="time_embedding",
-                #     index_type="HNSW",
-                #     index_name="time_embedding",
-                #     M=16,
-                #     efConstruction=200,
-                #     metric_type="IP"  # COSINE
-                # )
-
-                self.create_collection(
-                    _CONTENT_COLLECTION_NAME, schema=_COLLECTION_SCHEMA, index_params=index_params, consistency_level="Strong"
-                )
+                # Fresh deployment: create a versioned collection and point the alias to it
+                collection_name = self._create_content_collection()
+                self.create_alias(collection_name=collection_name, alias=_CONTENT_COLLECTION_NAME)
+                logger.info(f"Created collection '{collection_name}' with alias '{_CONTENT_COLLECTION_NAME}'.")
+            elif self._resolve_collection_name() == _CONTENT_COLLECTION_NAME:
+                self._migrate_legacy_collection()
 
             # Load the collection
-            self.load_collection(collection_name=_CONTENT_COLLECTION_NAME, replica_number=1)
+            self.load_collection(collection_name=self._resolve_collection_name(), replica_number=1)
 
             logger.info(f"Connected to Milvus server at {self.host}:{self.port}")
             return self
@@ -174,11 +167,242 @@ class MilvusClient(BaseMilvusClient):
             logger.error(f"Error connecting to Milvus: {e}")
             raise e
 
+    def _prepare_content_index_params(self):
+        """Prepares the index parameters shared by all versions of the content collection."""
+
+        # Create HNSW indexes on vector fields
+        index_params = self.prepare_index_params()
+
+        # Add indexes for different fields
+        index_params.add_index(
+            field_name="title_embedding_dense",
+            index_type="HNSW",
+            index_name="title_embedding_dense",
+            M=16, 
+            efConstruction=200,
+            metric_type="IP"  # COSINE
+        )
+
+        index_params.add_index(
+            field_name="text_embedding_dense",
+            index_type="HNSW",
+            index_name="text_embedding_dense",
+            M=16,
+            efConstruction=200,
+            metric_type="IP"  # COSINE
+        )
+
+        index_params.add_index(
+            field_name="text_embedding_sparse",
+            index_type="SPARSE_INVERTED_INDEX",
+            index_name="text_embedding_sparse",
+            metric_type="IP"  # COSINE
+        )
+        
+        # TODO: Add time embedings
+        # index_params.add_index(
+        #     field_name="time_embedding",
+        #     index_type="HNSW",
+        #     index_name="time_embedding",
+        #     M=16,
+        #     efConstruction=200,
+        #     metric_type="IP"  # COSINE
+        # )
+
+        return index_params
+
+    def _create_content_collection(self) -> str:
+        """Creates a new versioned content collection (e.g. 'contents_1718000000') with schema and indexes."""
+        collection_name = f"{_CONTENT_COLLECTION_NAME}_{time.time_ns() // 1_000_000}"
+
+        self.create_collection(
+            collection_name,
+            schema=_COLLECTION_SCHEMA,
+            index_params=self._prepare_content_index_params(),
+            consistency_level="Strong",
+        )
+        return collection_name
+
+    def _migrate_legacy_collection(self):
+        """
+        Turns a plain 'contents' collection of deployments created before aliasing into an aliased one.
+        The collection is renamed to a versioned name (keeping its data) and the alias is created on it,
+        so rebuilds can always swap with alter_alias.
+        """
+        collection_name = f"{_CONTENT_COLLECTION_NAME}_{time.time_ns() // 1_000_000}"
+        logger.warning(f"Migrating legacy collection '{_CONTENT_COLLECTION_NAME}' to '{collection_name}' with an alias.")
+
+        self.release_collection(collection_name=_CONTENT_COLLECTION_NAME)
+        self.rename_collection(old_name=_CONTENT_COLLECTION_NAME, new_name=collection_name)
+        try:
+            self.create_alias(collection_name=collection_name, alias=_CONTENT_COLLECTION_NAME)
+        except Exception:
+            # Keep the deployment usable under its old name, the migration is retried on the next start
+            self.rename_collection(old_name=collection_name, new_name=_CONTENT_COLLECTION_NAME)
+            raise
+
+    def _resolve_collection_name(self, alias: str = _CONTENT_COLLECTION_NAME) -> str:
+        """
+        Returns the physical collection the alias points to.
+        A legacy plain 'contents' collection (not yet migrated by _setup) is returned as is.
+        """
+        try:
+            return self.describe_alias(alias)["collection_name"]
+        except MilvusException:
+            return alias
+
+    async def create_shadow_collection(self) -> str:
+        """
+        Creates a versioned shadow collection with the same schema and indexes as the live one.
+        Searches keep using the live collection until swap_collection_alias is called.
+        """
+        try:
+            shadow_name = self._create_content_collection()
+            self.load_collection(collection_name=shadow_name, replica_number=1)
+            logger.info(f"Created shadow collection '{shadow_name}'.")
+            return shadow_name
+        except Exception as e:
+            logger.error(f"Error creating shadow collection: {e}")
+            raise e
+
+    def track_content_changes(
+        self,
+        shadow_name: str,
+        content_ids: Iterable[int] = (),
+        on_change: Callable[[list[int]], None] | None = None,
+    ):
+        """
+        Records the ids of contents written to the live collection from now on, until shadow_name is swapped in
+        or dropped. content_ids are changes recorded before (e.g. by an interrupted rebuild), on_change is called
+        with the ids of every write, so they can be persisted.
+        """
+        self._tracked_shadow = shadow_name
+        self._changed_content_ids = set(content_ids)
+        self._on_content_change = on_change
+
+    def _stop_tracking_content_changes(self, shadow_name: str):
+        if self._tracked_shadow == shadow_name:
+            self._tracked_shadow = None
+            self._changed_content_ids = set()
+            self._on_content_change = None
+
+    @asynccontextmanager
+    async def content_writes(self, content_ids: Iterable[int]):
+        """
+        Wraps every write of contents to the live collection. While a rebuild fills a shadow collection the ids
+        are recorded, and swap_collection_alias copies these contents from the live collection before the swap.
+        The ids are recorded once the write is done, content_ids may be extended by the caller inside the block.
+        """
+        self._running_writes += 1
+        self._writes_idle.clear()
+        try:
+            yield
+        finally:
+            self._running_writes -= 1
+            if self._running_writes == 0:
+                self._writes_idle.set()
+            if self._tracked_shadow is not None:
+                content_ids = list(content_ids)
+                self._changed_content_ids.update(content_ids)
+                if self._on_content_change and content_ids:
+                    self._on_content_change(content_ids)
+
+    async def _sync_changed_contents(self, shadow_name: str) -> int:
+        """
+        Replaces the changed contents in the shadow collection by their rows (with vectors) in the live collection,
+        until no changes are left and no write is running. Returns the change in the row count of the shadow.
+        """
+        if self._tracked_shadow != shadow_name:
+            return 0
+
+        row_delta = 0
+        output_fields = [field for field in CONTENT_SCALAR_FIELDS if field != "id"] + CONTENT_VECTOR_FIELDS
+        while True:
+            await self._writes_idle.wait()
+            if not self._changed_content_ids:
+                return row_delta
+
+            content_ids = list(self._changed_content_ids)
+            self._changed_content_ids.clear()
+
+            for i in range(0, len(content_ids), 1000):
+                filter_expr = filters.content_ids(content_ids[i:i + 1000])
+
+                rows = await self.query_all(filter_expr, output_fields)
+                for row in rows:
+                    row["text_embedding_sparse"] = row["text_embedding_sparse"] or {0:0.0}
+                stale_rows = self.query(
+                    collection_name=shadow_name, filter=filter_expr, output_fields=["count(*)"], consistency_level="Strong"
+                )[0]["count(*)"]
+
+                await self.delete_data(filter_expr=filter_expr, collection_name=shadow_name)
+                for j in range(0, len(rows), 500):
+                    await self.insert_data(rows[j:j + 500], collection_name=shadow_name)
+                row_delta += len(rows) - stale_rows
+
+            logger.info(f"Copied {len(content_ids)} contents changed during the rebuild to '{shadow_name}'.")
+
+    async def swap_collection_alias(self, shadow_name: str, expected_row_count: int = None):
+        """
+        Validates the shadow collection, atomically repoints the content alias to it and drops the previous version.
+        Contents written to the live collection while the shadow was filled are copied over first (see content_writes).
+        Raises a ValueError (and leaves the live collection untouched) if the row count does not match.
+        """
+        try:
+            row_delta = await self._sync_changed_contents(shadow_name)
+            if expected_row_count is not None:
+                expected_row_count += row_delta
+
+            # Nothing below awaits, no write can slip in between the last copy and the swap
+            Collection(shadow_name).flush()
+            # Live rows only, the collection stats still count deleted rows (e.g. of a resumed rebuild) until compaction
+            row_count = self.query(
+                collection_name=shadow_name, filter="", output_fields=["count(*)"], consistency_level="Strong"
+            )[0]["count(*)"]
+
+            if expected_row_count is not None and row_count != expected_row_count:
+                raise ValueError(
+                    f"Shadow collection '{shadow_name}' has {row_count} rows, expected {expected_row_count}."
+                )
+
+            previous_name = self._resolve_collection_name()
+            if previous_name == _CONTENT_COLLECTION_NAME:
+                # Legacy collections are migrated by _setup, never drop one before the alias points elsewhere
+                raise ValueError(f"'{_CONTENT_COLLECTION_NAME}' is not an alias yet, restart the service to migrate it.")
+
+            self.alter_alias(collection_name=shadow_name, alias=_CONTENT_COLLECTION_NAME)
+            self._stop_tracking_content_changes(shadow_name)
+            self.drop_collection(previous_name)
+
+            logger.info(f"Alias '{_CONTENT_COLLECTION_NAME}' now points to '{shadow_name}' ({row_count} rows), dropped '{previous_name}'.")
+        except Exception as e:
+            logger.error(f"Error swapping collection alias: {e}")
+            raise e
+
+    async def drop_shadow_collection(self, shadow_name: str):
+        """Drops an unused shadow collection, e.g. after a failed rebuild. Never drops the live collection."""
+        try:
+            if shadow_name in (_CONTENT_COLLECTION_NAME, self._resolve_collection_name()):
+                raise ValueError(f"Refusing to drop live collection '{shadow_name}'.")
+            if not self.has_collection(_CONTENT_COLLECTION_NAME):
+                # Without a live collection the shadow may be the only copy of the data
+                raise ValueError(f"Refusing to drop '{shadow_name}', no live collection exists.")
+            self._stop_tracking_content_changes(shadow_name)
+            if self.has_collection(shadow_name):
+                self.drop_collection(shadow_name)
+                logger.info(f"Dropped shadow collection '{shadow_name}'.")
+        except Exception as e:
+            logger.error(f"Error dropping shadow collection: {e}")
+            raise e
+
     async def recreate_collection(self, collection_name: str = _CONTENT_COLLECTION_NAME):
-        """Recreates the collection and indexes."""
+        """Recreates the collection and indexes. Prefer create_shadow_collection + swap_collection_alias for rebuilds."""
         try:
             if self.has_collection(collection_name):
-                self.drop_collection(collection_name)
+                physical_name = self._resolve_collection_name(collection_name)
+                if physical_name != collection_name:
+                    self.drop_alias(collection_name)
+                self.drop_collection(physical_name)
             await self._setup()
             logger.info("Recreated collection and indexes.")
         except Exception as e:
@@ -227,13 +451,21 @@ class MilvusClient(BaseMilvusClient):
         primary_ids: list = None,
         partition_name: str = None,
         collection_name: str = _CONTENT_COLLECTION_NAME,
+        company_id: int = None,
     ):
-        """Deletes entities based on filter expression or primary ids, optionally within a specific partition."""
+        """
+        Deletes entities based on filter expression or primary ids, optionally within a specific partition.
+        With company_id the delete is restricted to the company (and its partition).
+        """
         
         if filter_expr and primary_ids:
             raise ValueError(
                 "Only one of 'filter_expr' or 'primary_ids' can be provided."
             )
+
+        if company_id is not None and (filter_expr or primary_ids):
+            filter_expr = filters.tenant(company_id, filter_expr or filters.primary_ids(primary_ids))
+            primary_ids = None
             
         try:
             if filter_expr:
@@ -264,13 +496,21 @@ class MilvusClient(BaseMilvusClient):
         primary_ids: list = None,
         output_fields: list[str] = None,
         partition_names: list[str] = None,
+        company_id: int = None,
     ):
-        """Queries the collection for entities based on IDs."""
+        """
+        Queries the collection for entities based on a filter expression or IDs.
+        With company_id the query is restricted to the company (and its partition).
+        """
         
         if filter_expr and primary_ids:
             raise ValueError(
                 "Only one of 'filter_expr' or 'primary_ids' can be provided."
             )
+
+        if company_id is not None and (filter_expr or primary_ids):
+            filter_expr = filters.tenant(company_id, filter_expr or filters.primary_ids(primary_ids))
+            primary_ids = None
             
         try:
             if filter_expr:
@@ -297,9 +537,84 @@ class MilvusClient(BaseMilvusClient):
             logger.error(f"Error during query: {e}")
             raise e
 
+    async def query_all(
+        self,
+        filter_expr: str,
+        output_fields: list[str],
+        batch_size: int = 1000,
+        collection_name: str = _CONTENT_COLLECTION_NAME,
+        company_id: int = None,
+    ) -> list[dict]:
+        """
+        Queries all entities matching the filter expression, paging through the results with a query iterator.
+        Unlike get_data this is not capped by the query limit (16384) of MilvusDB.
+        With company_id the query is restricted to the company (and its partition).
+        """
+        if company_id is not None:
+            filter_expr = filters.tenant(company_id, filter_expr)
+
+        try:
+            iterator = Collection(collection_name).query_iterator(
+                batch_size=batch_size, expr=filter_expr, output_fields=output_fields
+            )
+            query_result = []
+            while page := iterator.next():
+                query_result.extend(page)
+            iterator.close()
+            logger.info(f"Queried {len(query_result)} entities.")
+            return query_result
+        except Exception as e:
+            logger.error(f"Error during query: {e}")
+            raise e
+
+    async def tenant_stats(self, company_id: int, collection_name: str = _CONTENT_COLLECTION_NAME) -> dict:
+        """
+        Returns the number of content chunks of a company (a filtered count, not partition statistics).
+        Companies are hashed into partitions shared with other companies by the partition key (company_id).
+        """
+        try:
+            count_result = self.query(
+                collection_name=collection_name,
+                filter=filters.company(company_id),
+                output_fields=["count(*)"],
+            )
+            return {
+                "company_id": company_id,
+                "chunk_count": count_result[0]["count(*)"],
+                "collection_name": self._resolve_collection_name(collection_name),
+            }
+        except Exception as e:
+            logger.error(f"Error getting tenant stats: {e}")
+            raise e
+
+    async def count_rows(self, filter_expr: str, collection_name: str = _CONTENT_COLLECTION_NAME) -> int:
+        """Counts the entities matching the filter expression, cached for SEARCH_ROW_COUNT_CACHE_TTL seconds."""
+        key = (collection_name, filter_expr)
+        if key not in self._row_counts:
+            count_result = self.query(collection_name=collection_name, filter=filter_expr, output_fields=["count(*)"])
+            self._row_counts[key] = count_result[0]["count(*)"]
+        return self._row_counts[key]
+
+    @staticmethod
+    def candidate_limit(needed: int, matching_rows: int | None, tenant_rows: int | None, offset: int = 0) -> int:
+        """
+        Picks the ANN limit per vector field for a page ending at `needed` results, skipping `offset` results.
+        Filtered HNSW searches return fewer hits the more selective the filter is, so the over-fetch factor
+        grows with the selectivity (matching rows / rows of the company) from SEARCH_CANDIDATE_FACTOR_MIN
+        (everything matches) up to SEARCH_CANDIDATE_FACTOR_MAX. Never asks for more rows than match,
+        and offset + limit stays within the max. topk of MilvusDB.
+        """
+        if matching_rows is None or not tenant_rows:
+            limit = needed * 3
+        else:
+            selectivity = max(matching_rows / tenant_rows, 1e-6)
+            factor = min(SEARCH_CANDIDATE_FACTOR_MAX, max(SEARCH_CANDIDATE_FACTOR_MIN, SEARCH_CANDIDATE_FACTOR_MIN / math.sqrt(selectivity)))
+            limit = min(math.ceil(needed * factor), max(matching_rows, needed))
+        return max(1, min(limit, _MAX_SEARCH_LIMIT - offset))
+
     async def multi_vector_search(
         self,
-        vectors: list[float],  # [...]
+        vectors: list[list],  # [[query1_vector, query2_vector, ...] per field, ...]
         field_names: list[str],  # [field_name1, field_name2, ...]
         offset: int = None,
         search_params: dict = None,
@@ -308,37 +623,37 @@ class MilvusClient(BaseMilvusClient):
         ranking_strategy: str = "rrf",  # "weighted" or "rrf"
         weights: list = None,  # weights for weighted ranking
         page_size: int | None = 20,
+        collection_name: str = _CONTENT_COLLECTION_NAME,
+        company_id: int = None,
     ):
-        """Performs a multi-vector paginated search with optional filtering and specified ranking strategy."""
+        """
+        Performs a multi-vector paginated search with optional filtering and specified ranking strategy.
+        Several queries are searched in one round trip, the result holds the hits of each query in query order.
+        With company_id the search is restricted to the company by a leading company_id condition (as before).
+
+        The ANN limit per vector field adapts to how selective the filter is within the company (see candidate_limit).
+        If the page comes back short although more rows match, the search is retried with a larger limit.
+        """
+        tenant_expr = filters.company(company_id) if company_id is not None else None
+        if company_id is not None:
+            filter_expr = filters.tenant(company_id, filter_expr)
+
         try:
             search_params = search_params or {}
+            offset = offset or 0
+            needed = offset + page_size
 
-            limit = page_size
-
-            # Create AnnSearchRequest objects for each vector field
-            req_list = []
-
-            for vector, field_name in zip(vectors, field_names):
-                
-                param = {
-                    "metric_type": "IP",
-                    "params": { "offset": offset },
-                }
-                
-                param.update(search_params.get(field_name, {}))
-                
-                req = AnnSearchRequest(
-                    data=[vector],
-                    anns_field=field_name,
-                    param=param,
-                    expr=filter_expr,
-                    limit=limit*3
-                )
-                req_list.append(req)
+            # Row statistics of the company and of the filter (cached)
+            matching_rows, tenant_rows = None, None
+            if filter_expr:
+                matching_rows = await self.count_rows(filter_expr, collection_name)
+                tenant_rows = await self.count_rows(tenant_expr, collection_name) if tenant_expr else None
+            limit = self.candidate_limit(needed, matching_rows, tenant_rows, offset)
+            max_limit = max(1, _MAX_SEARCH_LIMIT - offset)
 
             # Choose ranking strategy
             if ranking_strategy == "weighted":
-                if len(weights) != len(req_list):
+                if len(weights) != len(vectors):
                     raise ValueError(
                         "Weights must have the same length as the number of vector fields."
                     )
@@ -352,15 +667,51 @@ class MilvusClient(BaseMilvusClient):
                     "Invalid ranking strategy. Choose 'weighted' or 'rrf'."
                 )
             
-            content_collection = Collection(_CONTENT_COLLECTION_NAME)
-
-            search_result = content_collection.hybrid_search(
-                req_list,
-                ranker,
-                offset=offset, # Number of initial search results to skip
-                limit=page_size,  # Number of final search results to return
-                output_fields=output_fields,
-            )
+            # Resolves the alias, so searches follow the collection swap of a rebuild
+            content_collection = Collection(collection_name)
+
+            for attempt in range(SEARCH_CANDIDATE_RETRIES + 1):
+                # Create AnnSearchRequest objects for each vector field
+                req_list = []
+
+                for vector, field_name in zip(vectors, field_names):
+                    
+                    param = {
+                        "metric_type": "IP",
+                        "params": { "offset": offset },
+                    }
+                    
+                    param.update(search_params.get(field_name, {}))
+                    
+                    req = AnnSearchRequest(
+                        data=vector,
+                        anns_field=field_name,
+                        param=param,
+                        expr=filter_expr,
+                        limit=limit
+                    )
+                    req_list.append(req)
+
+                search_result = content_collection.hybrid_search(
+                    req_list,
+                    ranker,
+                    offset=offset, # Number of initial search results to skip
+                    limit=page_size,  # Number of final search results to return
+                    output_fields=output_fields,
+                )
+
+                # Retry only if a page is short, more rows match and the limit can still grow
+                hits = min(len(query_hits) for query_hits in search_result)
+                if (
+                    hits >= page_size
+                    or matching_rows is None
+                    or matching_rows <= offset + hits
+                    or limit >= min(max_limit, matching_rows)
+                ):
+                    break
+                logger.debug(f"Search returned {hits} of {page_size} hits with limit {limit}, retrying.")
+                limit = min(limit * 4, max_limit)
+
             return search_result
         except Exception as e:
             logger.error(f"Error during multi-vector search: {e}")
@@ -0,0 +1,299 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+import asyncio
+import json
+import os
+import time
+
+from fastapi import Request, BackgroundTasks
+from typing import Any, Awaitable, Callable
+from loguru import logger
+
+from app.internal.jobs import Job
+from app.internal.types import ContentValidated
+from app.internal.milvusdb import filters
+from app.internal.milvusdb.handle_db_items import prepare_content_chunks, embed_content_chunks
+
+from app.config import (
+    REBUILD_FETCH_PAGE_SIZE,
+    REBUILD_FETCH_CONCURRENCY,
+    REBUILD_SPLIT_CONCURRENCY,
+    REBUILD_EMBED_CONCURRENCY,
+    REBUILD_WRITE_BATCH_SIZE,
+    REBUILD_QUEUE_SIZE,
+    REBUILD_CHECKPOINT_PATH,
+)
+
+_STAGE_DONE = object()  # Sentinel telling a stage worker that its input is exhausted
+
+
+def load_checkpoint(path: str = REBUILD_CHECKPOINT_PATH) -> dict | None:
+    """Loads the rebuild checkpoint, returns None if there is none."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable rebuild checkpoint {path}: {e}")
+        return None
+
+
+def save_checkpoint(checkpoint: dict, path: str = REBUILD_CHECKPOINT_PATH):
+    """Writes the checkpoint atomically, so a crash never leaves a half written file behind."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def clear_checkpoint(path: str = REBUILD_CHECKPOINT_PATH):
+    for file_path in (path, f"{path}.done", f"{path}.changes"):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def load_done_ids(path: str = REBUILD_CHECKPOINT_PATH) -> set[int]:
+    """Loads the ids of contents already written to the shadow collection (one id per line)."""
+    try:
+        with open(f"{path}.done") as f:
+            return {int(line) for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def record_done_ids(content_ids: list[int], path: str = REBUILD_CHECKPOINT_PATH):
+    """Appends ids of contents written to the shadow collection, the checkpoint itself stays small."""
+    with open(f"{path}.done", "a") as f:
+        f.writelines(f"{content_id}\n" for content_id in content_ids)
+
+
+def forget_done_ids(content_ids: list[int], path: str = REBUILD_CHECKPOINT_PATH):
+    """Removes ids from the done ids (atomically, like `save_checkpoint`), only needed when resuming."""
+    forgotten = set(content_ids)
+    done_ids = load_done_ids(path) - forgotten
+    tmp_path = f"{path}.done.tmp"
+    with open(tmp_path, "w") as f:
+        f.writelines(f"{content_id}\n" for content_id in done_ids)
+    os.replace(tmp_path, f"{path}.done")
+
+
+def load_changed_ids(path: str = REBUILD_CHECKPOINT_PATH) -> list[int]:
+    """Loads the ids of contents written to the live collection during the rebuild (one id per line)."""
+    try:
+        with open(f"{path}.changes") as f:
+            return [int(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def record_changed_ids(content_ids: list[int], path: str = REBUILD_CHECKPOINT_PATH):
+    """Appends ids of changed contents, so they are still copied into the shadow collection after a restart."""
+    with open(f"{path}.changes", "a") as f:
+        f.writelines(f"{content_id}\n" for content_id in content_ids)
+
+
+def resume_change_tracking(milvusdbclient):
+    """
+    Called on startup: keeps recording contents written to the live collection for an interrupted rebuild,
+    so they are not lost when the rebuild is resumed.
+    """
+    checkpoint = load_checkpoint()
+    if checkpoint and milvusdbclient.has_collection(checkpoint["shadow_name"]):
+        milvusdbclient.track_content_changes(checkpoint["shadow_name"], load_changed_ids(), record_changed_ids)
+
+
+def parse_rebuild_content(content_dict: dict) -> tuple[ContentValidated, int, list[int]]:
+    """Extracts the content, company_id and circle_ids from a Directus rebuild row."""
+    circle_ids = [circle["circle_id"]["circle_id"] for circle in content_dict["circle_contents"]]
+
+    if content_dict["company_id"]:
+        company_id = content_dict["company_id"]
+    else:
+        company_id = 0
+        logger.warning(f"Company_id not found for {content_dict['content_id']}. Setting to 0.")
+
+    return ContentValidated(**content_dict), company_id, circle_ids
+
+
+async def _run_stage(
+    worker: Callable[[Any], Awaitable[list]],
+    concurrency: int,
+    in_queue: asyncio.Queue,
+    out_queue: asyncio.Queue | None,
+    downstream_workers: int,
+):
+    """
+    Runs `concurrency` workers that take items from in_queue and put their results on out_queue.
+    Once all workers have seen the end of their input, the end is signalled to each downstream worker.
+    """
+
+    async def _worker():
+        while True:
+            item = await in_queue.get()
+            if item is _STAGE_DONE:
+                return
+            for result in await worker(item):
+                await out_queue.put(result)
+
+    await asyncio.gather(*[_worker() for _ in range(concurrency)])
+
+    if out_queue is not None:
+        for _ in range(downstream_workers):
+            await out_queue.put(_STAGE_DONE)
+
+
+async def rebuild_contents(request: Request, job: Job, resume: bool = True) -> str:
+    """
+    Rebuilds all content chunks from Directus into a shadow collection and swaps it in.
+
+    The work runs as a pipeline of bounded stages (list ids -> fetch pages from Directus -> sanitize/split -> embed ->
+    write), so Directus latency, text splitting, embedding and MilvusDB inserts overlap. Content ids are paged
+    through with keyset pagination, memory only grows with the set of contents done. Progress is checkpointed
+    after every write (done ids are appended to a separate file), an interrupted rebuild continues in the same
+    shadow collection when started again.
+    Contents written to the live collection while the rebuild runs are recorded and copied into the shadow
+    collection right before the swap, so they are not lost.
+    """
+    start_time = time.time()
+    milvusdbclient = request.state.milvusdbclient
+    directusclient = request.state.directusclient
+    background_tasks = BackgroundTasks()  # Title updates, run once the rebuild is done
+
+    checkpoint = load_checkpoint()
+
+    if checkpoint and not (resume and milvusdbclient.has_collection(checkpoint["shadow_name"])):
+        # Start over, the shadow collection of the previous attempt is not needed anymore
+        await milvusdbclient.drop_shadow_collection(checkpoint["shadow_name"])
+        checkpoint = None
+
+    if checkpoint:
+        # Rows of the batch that was being written when the rebuild stopped may or may not have been inserted
+        if checkpoint["in_flight_ids"]:
+            await milvusdbclient.delete_data(
+                filter_expr=filters.content_ids(checkpoint["in_flight_ids"]), collection_name=checkpoint["shadow_name"]
+            )
+            forget_done_ids(checkpoint["in_flight_ids"])
+            checkpoint["in_flight_ids"] = []
+    else:
+        clear_checkpoint()
+        checkpoint = {
+            "shadow_name": await milvusdbclient.create_shadow_collection(),
+            "in_flight_ids": [],
+            "rows_written": 0,
+        }
+    save_checkpoint(checkpoint)
+
+    # Record writes to the live collection before anything is read from Directus
+    milvusdbclient.track_content_changes(checkpoint["shadow_name"], load_changed_ids(), record_changed_ids)
+
+    shadow_name = checkpoint["shadow_name"]
+    done_ids = load_done_ids()
+    if done_ids:
+        logger.info(f"Resuming rebuild in '{shadow_name}' with {len(done_ids)} contents done.")
+
+    # The totals are estimates, contents created or deleted while the rebuild runs change them
+    content_count = await directusclient.count_rebuild(collection="contents")
+    pending_count = max(content_count - len(done_ids), 0)
+
+    job.detail.update({"shadow_name": shadow_name, "contents_failed": 0})
+    job.add_stage("contents_fetched", total=pending_count)
+    job.add_stage("contents_split", total=pending_count)
+    job.add_stage("chunks_embedded")
+    job.add_stage("rows_written", initial=checkpoint["rows_written"])
+    job.add_stage("contents_done", total=content_count, initial=len(done_ids))
+    job.eta_stage = "contents_done"
+    logger.info(f"Rebuilding about {pending_count} of {content_count} contents into '{shadow_name}'.")
+
+    page_queue = asyncio.Queue(maxsize=REBUILD_QUEUE_SIZE)
+    content_queue = asyncio.Queue(maxsize=REBUILD_QUEUE_SIZE)
+    chunk_queue = asyncio.Queue(maxsize=REBUILD_QUEUE_SIZE)
+    item_queue = asyncio.Queue(maxsize=REBUILD_QUEUE_SIZE)
+
+    async def list_pages():
+        async for ids in directusclient.iter_ids_rebuild(collection="contents"):
+            pending_ids = [content_id for content_id in ids if content_id not in done_ids]
+            for i in range(0, len(pending_ids), REBUILD_FETCH_PAGE_SIZE):
+                await page_queue.put(pending_ids[i:i + REBUILD_FETCH_PAGE_SIZE])
+        for _ in range(REBUILD_FETCH_CONCURRENCY):
+            await page_queue.put(_STAGE_DONE)
+
+    async def fetch(page: list[int]) -> list:
+        page_ids = set(page)
+        content_list = await directusclient.get_contents_rebuild(page)
+        logger.debug(f"{len(content_list)} Content items pulled from Directus.")
+
+        contents = []
+        # The query also returns parents of the requested contents, only keep the requested ones
+        for content_dict in content_list:
+            if content_dict["content_id"] not in page_ids:
+                continue
+            try:
+                contents.append(parse_rebuild_content(content_dict))
+            except Exception as e:
+                logger.error(f"Skipping content {content_dict['content_id']} in rebuild: {e}")
+                job.detail["contents_failed"] += 1
+                job.stages["contents_done"].total -= 1
+        job.advance("contents_fetched", len(contents))
+        return contents
+
+    async def split(parsed: tuple) -> list:
+        content, company_id, circle_ids = parsed
+        title, text_chunks = await prepare_content_chunks(request, background_tasks, content)
+        job.advance("contents_split")
+        return [(content, company_id, circle_ids, title, text_chunks)]
+
+    async def embed(prepared: tuple) -> list:
+        content, company_id, circle_ids, title, text_chunks = prepared
+        items = await embed_content_chunks(request, content, title, text_chunks, company_id, circle_ids)
+        job.advance("chunks_embedded", len(items))
+        return [(content.content_id, items)]
+
+    async def write():
+        buffer_ids, buffer_items = [], []
+
+        async def flush():
+            checkpoint["in_flight_ids"] = buffer_ids
+            save_checkpoint(checkpoint)
+
+            await milvusdbclient.insert_data(buffer_items, collection_name=shadow_name)
+
+            record_done_ids(buffer_ids)
+            checkpoint["in_flight_ids"] = []
+            checkpoint["rows_written"] += len(buffer_items)
+            save_checkpoint(checkpoint)
+
+            job.advance("rows_written", len(buffer_items))
+            job.advance("contents_done", len(buffer_ids))
+
+        while (embedded := await item_queue.get()) is not _STAGE_DONE:
+            content_id, items = embedded
+            buffer_ids.append(content_id)
+            buffer_items.extend(items)
+            if len(buffer_items) >= REBUILD_WRITE_BATCH_SIZE:
+                await flush()
+                buffer_ids, buffer_items = [], []
+
+        if buffer_items:
+            await flush()
+
+    async with asyncio.TaskGroup() as task_group:
+        task_group.create_task(list_pages())
+        task_group.create_task(_run_stage(fetch, REBUILD_FETCH_CONCURRENCY, page_queue, content_queue, REBUILD_SPLIT_CONCURRENCY))
+        task_group.create_task(_run_stage(split, REBUILD_SPLIT_CONCURRENCY, content_queue, chunk_queue, REBUILD_EMBED_CONCURRENCY))
+        task_group.create_task(_run_stage(embed, REBUILD_EMBED_CONCURRENCY, chunk_queue, item_queue, 1))
+        task_group.create_task(write())
+
+    # Copy contents changed meanwhile, validate the row count and repoint the alias (drops the previous version)
+    await milvusdbclient.swap_collection_alias(shadow_name, expected_row_count=checkpoint["rows_written"])
+    clear_checkpoint()
+
+    await background_tasks()
+
+    time_taken = (time.time() - start_time) / 60
+    return f"MilvusDB content chunks have been successfully rebuilt. Time taken: {time_taken:.1f} minutes."
@@ -11,6 +11,10 @@ from loguru import logger
 from time import time
     
 
+class _Batch(list):
+    """Marks a list of inputs submitted with process_batch, so it is not taken as a single input."""
+
+
 class TextRequestProcessor:
     """
     Processes embedding and reranking requests using a provided model.
@@ -54,9 +58,19 @@ class TextRequestProcessor:
             if requests:
                 async with self.gpu_lock:  # Ensure exclusive GPU/CPU access (acquire + release)
                     try:
+                        # Flatten batches submitted with process_batch into one model call
+                        inputs, slices = [], []
+                        for data in requests:
+                            if isinstance(data, _Batch):
+                                slices.append(slice(len(inputs), len(inputs) + len(data)))
+                                inputs.extend(data)
+                            else:
+                                slices.append(len(inputs))
+                                inputs.append(data)
+
                         # Process batched requests and return results
-                        results = process_func(requests)
-                        self._set_results(futures, results, response_key)
+                        results = process_func(inputs)
+                        self._set_results(futures, [results[index] for index in slices], response_key)
                     except Exception as e:
                         logger.error(f"Processing error: {e}")
                         for future in futures:
@@ -80,3 +94,10 @@ class TextRequestProcessor:
         elif queue_name == 'rerank':
             await self.rerank_queue.put((request_data, future))
         return future
+
+    async def process_batch(self, request_data: List[Any], queue_name: str) -> asyncio.Future:
+        """
+        Submits a list of inputs that is processed in a single model call (plus whatever else is queued).
+        The returned future resolves to the list of results in input order.
+        """
+        return await self.process_request(_Batch(request_data), queue_name)
@@ -0,0 +1,352 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+import asyncio
+
+from datetime import datetime, timezone
+from fastapi import Request
+from starlette.concurrency import run_in_threadpool
+from typing import AsyncIterator, List, Literal
+from loguru import logger
+
+import polars as pl
+
+from app.internal.milvusdb import filters
+from app.internal.utils.search_postprocessing import calculate_combined_df, build_hierarchy, rank_root_subtrees
+
+
+_SEARCH_FIELD_NAMES = ["title_embedding_dense", "text_embedding_dense", "text_embedding_sparse"]
+
+# Fields of the chunk rows that make up a content in the format of DirectusClient.get_contents (text is read separately)
+_MILVUS_CONTENT_FIELDS = [
+    "id", "content_id", "file_id", "content_type", "title", "parent_id", "date_created", "date_updated", "user_created", "user_updated"
+]
+
+Hydration = Literal["directus", "milvus"]
+
+
+async def embed_queries(request: Request, queries: List[str]) -> tuple[list, list]:
+    """Embeds all queries in one batch per model, returns the dense and sparse vectors in query order."""
+    dense_future, sparse_future = await asyncio.gather(
+        request.state.textrequestProcessor.process_batch(queries, "embed"),
+        request.state.textrequestProcessor1.process_batch(queries, "embed"),
+    )
+    return await dense_future, await sparse_future
+
+
+async def search_hits(
+    request: Request,
+    queries: List[str],
+    company_id: int,
+    filter_expr: str,
+    offset: int,
+    page_size: int,
+) -> list[list[dict]]:
+    """
+    Embeds the queries and runs one hybrid search for all of them.
+    Returns the hits (content_id, parent_id, text, distance) per query, in hybrid search order.
+    """
+    dense_vectors, sparse_vectors = await embed_queries(request, queries)
+
+    search_result = await request.state.milvusdbclient.multi_vector_search(
+        vectors=[dense_vectors, dense_vectors, sparse_vectors],
+        field_names=_SEARCH_FIELD_NAMES,
+        filter_expr=filter_expr,
+        company_id=company_id, # Only the partition of the company is searched
+        offset=offset,
+        page_size=page_size,
+        output_fields=["content_id", "parent_id", "text"],
+    )
+
+    return [
+        [
+            {
+                "content_id": hit.fields["content_id"],
+                "parent_id": hit.fields["parent_id"],
+                "text": hit.fields["text"],
+                "distance": float(hit.distance),
+            }
+            for hit in query_hits
+        ]
+        for query_hits in search_result
+    ]
+
+
+async def rerank_hits(request: Request, query: str, hits: list[dict]) -> list[float]:
+    """Scores the chunks of the hits against the query with the re-ranking model, in one batch."""
+    if not hits:
+        return []
+    future = await request.state.textrerankingProcessor.process_batch(
+        [(query, hit["text"]) for hit in hits], "rerank"
+    )
+    return [float(score) for score in await future]
+
+
+def contents_for_hits(contents: list[dict], content_ids: list[int]) -> list[dict]:
+    """Selects the contents of the hits and their ancestors from a Directus result fetched for several queries."""
+    parent_ids = {content["content_id"]: content["parent_id"] for content in contents}
+    selected = set()
+    for content_id in content_ids:
+        while content_id is not None and content_id in parent_ids and content_id not in selected:
+            selected.add(content_id)
+            content_id = parent_ids[content_id]
+    return [content for content in contents if content["content_id"] in selected]
+
+
+def _format_timestamp(timestamp: int) -> str | None:
+    """Formats a unix timestamp like Directus does, 0 means not set."""
+    if not timestamp:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+async def get_milvus_contents(
+    request: Request, company_id: int, content_ids: list[int], hit_texts: dict[int, str]
+) -> list[dict]:
+    """
+    Builds contents in the format of DirectusClient.get_contents from MilvusDB scalar fields and cached user data.
+    MilvusDB only stores chunks: the text of a content is the text of its best hit (hit_texts) or of its first chunk,
+    interaction_id is not available. Contents without chunks in MilvusDB are fetched from Directus.
+    """
+    rows = await request.state.milvusdbclient.get_data(
+        filter_expr=filters.content_ids(sorted(content_ids)), output_fields=_MILVUS_CONTENT_FIELDS, company_id=company_id
+    )
+    first_chunks = {}
+    for row in sorted(rows, key=lambda row: row["id"]):
+        first_chunks.setdefault(row["content_id"], row)
+
+    # Only read the text of contents that are not hits (first chunk by primary id)
+    text_rows = [row["id"] for content_id, row in first_chunks.items() if content_id not in hit_texts]
+    texts, users = await asyncio.gather(
+        request.state.milvusdbclient.get_data(primary_ids=text_rows, output_fields=["content_id", "text"]) if text_rows else asyncio.sleep(0, []),
+        request.state.directusclient.get_users([
+            user_id for row in first_chunks.values() for user_id in (row["user_created"], row["user_updated"]) if user_id
+        ]),
+    )
+    texts = {**{row["content_id"]: row["text"] for row in texts}, **hit_texts}
+
+    contents = [
+        {
+            "content_id": content_id,
+            "file_id": row["file_id"],
+            "content_type": row["content_type"],
+            "title": row["title"],
+            "text": texts.get(content_id, ""),
+            "parent_id": row["parent_id"] or None,
+            "date_created": _format_timestamp(row["date_created"]),
+            "date_updated": _format_timestamp(row["date_updated"]),
+            "interaction_id": None,
+            "user_created": users.get(row["user_created"]),
+            "user_updated": users.get(row["user_updated"]),
+        }
+        for content_id, row in first_chunks.items()
+    ]
+
+    missing = [content_id for content_id in content_ids if content_id not in first_chunks]
+    if missing:
+        logger.debug(f"Contents {missing} not found in MilvusDB, falling back to Directus.")
+        fetched = {content["content_id"] for content in contents}
+        contents.extend(
+            content for content in await request.state.directusclient.get_contents(content_ids=missing, company_id=company_id)
+            if content["content_id"] not in fetched
+        )
+    return contents
+
+
+def best_hit_texts(hits: list[dict], scores: list[float]) -> dict[int, str]:
+    """Text of the best scoring chunk of each content, for hits that carry their text."""
+    texts, best_scores = {}, {}
+    for hit, score in zip(hits, scores):
+        if "text" in hit and score > best_scores.get(hit["content_id"], float("-inf")):
+            texts[hit["content_id"]] = hit["text"]
+            best_scores[hit["content_id"]] = score
+    return texts
+
+
+async def build_search_hierarchy(
+    contents: list[dict], content_ids: list[int], scores: list[float], k_avg: int, limit: int | None = None
+) -> list:
+    """Combines the chunk scores with the Directus contents and builds the hierarchy of the top `limit` roots."""
+    score_lf = pl.LazyFrame({"content_id": content_ids, "score": scores})
+    combined_df = await run_in_threadpool(calculate_combined_df, score_lf, contents, k_avg)
+    return await run_in_threadpool(build_hierarchy, combined_df, limit)
+
+
+async def score_hits(request: Request, query: str, hits: list[dict], rerank: bool) -> list[float]:
+    """Re-ranking model scores of the hits, or their hybrid search scores without re-ranking."""
+    if rerank:
+        return await rerank_hits(request, query, hits)
+    return [hit["distance"] for hit in hits]
+
+
+async def lookup_parent_ids(request: Request, company_id: int, hits: list[dict]) -> dict[int, int | None]:
+    """
+    Returns the parent_id of the contents of the hits and of their ancestors up to the grandparents (the depth the
+    Directus fetch covers), read from MilvusDB: every chunk carries the parent_id of its content (0 for roots).
+    """
+    parent_ids = {hit["content_id"]: hit["parent_id"] or None for hit in hits}
+    for _ in range(2):
+        pending = {parent_id for parent_id in parent_ids.values() if parent_id is not None and parent_id not in parent_ids}
+        if not pending:
+            break
+        rows = await request.state.milvusdbclient.get_data(
+            filter_expr=filters.content_ids(sorted(pending)), output_fields=["content_id", "parent_id"], company_id=company_id
+        )
+        for row in rows:
+            parent_ids[row["content_id"]] = row["parent_id"] or None
+        # Parents without chunks in MilvusDB are treated as roots
+        for parent_id in pending - parent_ids.keys():
+            parent_ids[parent_id] = None
+    return parent_ids
+
+
+def rank_subtrees(parent_ids: dict[int, int | None], content_ids: list[int], scores: list[float], k_avg: int) -> list[list[int]]:
+    """Ranks the roots of the hits by their scores, returns the content ids of each root's subtree, best first."""
+    score_lf = pl.LazyFrame({"content_id": content_ids, "score": scores})
+    nodes = [{"content_id": content_id, "parent_id": parent_id} for content_id, parent_id in parent_ids.items()]
+    return rank_root_subtrees(calculate_combined_df(score_lf, nodes, k_avg))
+
+
+async def rank_search_hits(
+    request: Request,
+    queries: List[str],
+    hits_per_query: list[list[dict]],
+    company_id: int,
+    rerank: bool,
+    k_avg: int,
+) -> tuple[list[list[float]], list[list[list[int]]]]:
+    """
+    Scores the hits of each query and ranks their root contents, using parent_ids from MilvusDB instead of Directus.
+    Returns the scores and the ranked subtrees per query. Parent lookups run while the re-ranking model scores.
+    """
+    scores_per_query, parent_ids_per_query = await asyncio.gather(
+        asyncio.gather(*[score_hits(request, query, hits, rerank) for query, hits in zip(queries, hits_per_query)]),
+        asyncio.gather(*[lookup_parent_ids(request, company_id, hits) for hits in hits_per_query]),
+    )
+
+    subtrees_per_query = []
+    for hits, scores, parent_ids in zip(hits_per_query, scores_per_query, parent_ids_per_query):
+        content_ids = [hit["content_id"] for hit in hits]
+        subtrees_per_query.append(await run_in_threadpool(rank_subtrees, parent_ids, content_ids, scores, k_avg) if hits else [])
+    return list(scores_per_query), subtrees_per_query
+
+
+async def hydrate_subtrees(
+    request: Request,
+    company_id: int,
+    hits_per_query: list[list[dict]],
+    scores_per_query: list[list[float]],
+    subtrees_per_query: list[list[list[int]]],
+    k_avg: int,
+    hydration: Hydration = "directus",
+) -> list[list]:
+    """
+    Fetches the contents of the selected subtrees (one fetch for all queries) from Directus or MilvusDB and builds
+    their hierarchies. Hits outside the selected subtrees are neither fetched nor assembled.
+    """
+    selected_per_query = []
+    for hits, scores, subtrees in zip(hits_per_query, scores_per_query, subtrees_per_query):
+        subtree_ids = {content_id for subtree in subtrees for content_id in subtree}
+        selected_per_query.append([
+            (hit["content_id"], score) for hit, score in zip(hits, scores) if hit["content_id"] in subtree_ids
+        ])
+
+    all_content_ids = list({content_id for selected in selected_per_query for content_id, _ in selected})
+    if not all_content_ids:
+        return [[] for _ in hits_per_query]
+
+    if hydration == "milvus":
+        hit_texts = {}
+        for hits, scores in zip(hits_per_query, scores_per_query):
+            hit_texts.update(best_hit_texts(hits, scores))
+        subtree_ids = {content_id for subtrees in subtrees_per_query for subtree in subtrees for content_id in subtree}
+        contents = await get_milvus_contents(request, company_id, list(subtree_ids), hit_texts)
+    else:
+        contents = await request.state.directusclient.get_contents(content_ids=all_content_ids, company_id=company_id)
+
+    hierarchies = []
+    for selected in selected_per_query:
+        if not selected:
+            hierarchies.append([])
+            continue
+        content_ids, scores = [list(column) for column in zip(*selected)]
+        query_contents = contents if len(selected_per_query) == 1 else contents_for_hits(contents, content_ids)
+        hierarchies.append(await build_search_hierarchy(query_contents, content_ids, scores, k_avg))
+    return hierarchies
+
+
+async def search_hierarchies(
+    request: Request,
+    queries: List[str],
+    company_id: int,
+    circle_ids: List[int],
+    rerank: bool = True,
+    offset: int = 0,
+    page_size: int = 20,
+    filter: str | None = None,
+    k_avg: int = 2,
+    hydration: Hydration = "directus",
+) -> list[list]:
+    """
+    Searches several queries at once and returns a content hierarchy per query.
+    The queries share one embedding batch per model, one hybrid search and one content fetch (Directus or MilvusDB).
+    Roots are ranked before the content fetch, only the top page_size root subtrees are fetched and assembled.
+    """
+    filter_expr = filters.search_filter(tuple(circle_ids), filter)
+
+    hits_per_query = await search_hits(request, queries, company_id, filter_expr, offset, page_size)
+    if not any(hits_per_query):
+        return [[] for _ in queries]
+
+    scores_per_query, subtrees_per_query = await rank_search_hits(request, queries, hits_per_query, company_id, rerank, k_avg)
+
+    hierarchies = await hydrate_subtrees(
+        request, company_id, hits_per_query, scores_per_query, [subtrees[:page_size] for subtrees in subtrees_per_query], k_avg, hydration
+    )
+    logger.debug(f"Built hierarchies for {len(queries)} queries.")
+    return hierarchies
+
+
+async def stream_search_hierarchy(
+    request: Request,
+    query: str,
+    company_id: int,
+    circle_ids: List[int],
+    rerank: bool = True,
+    offset: int = 0,
+    page_size: int = 20,
+    filter: str | None = None,
+    k_avg: int = 2,
+    hydration: Hydration = "directus",
+) -> AsyncIterator[tuple[str, list]]:
+    """
+    Searches a query and yields (stage, hierarchy) as soon as each ordering is known: "hybrid" (hybrid search scores)
+    right after the Directus fetch, then "reranked" once the re-ranking model has scored all chunks.
+    Re-ranking runs while the first ordering is built and sent.
+    """
+    filter_expr = filters.search_filter(tuple(circle_ids), filter)
+
+    hits = (await search_hits(request, [query], company_id, filter_expr, offset, page_size))[0]
+    if not hits:
+        yield "hybrid", []
+        return
+
+    content_ids = [hit["content_id"] for hit in hits]
+    rerank_task = asyncio.create_task(rerank_hits(request, query, hits)) if rerank else None
+
+    try:
+        if hydration == "milvus":
+            parent_ids = await lookup_parent_ids(request, company_id, hits)
+            hit_texts = best_hit_texts(hits, [hit["distance"] for hit in hits])
+            contents = await get_milvus_contents(request, company_id, list(parent_ids), hit_texts)
+        else:
+            contents = await request.state.directusclient.get_contents(content_ids=list(set(content_ids)), company_id=company_id)
+        yield "hybrid", await build_search_hierarchy(contents, content_ids, [hit["distance"] for hit in hits], k_avg, page_size)
+
+        if rerank_task:
+            yield "reranked", await build_search_hierarchy(contents, content_ids, await rerank_task, k_avg, page_size)
+    finally:
+        # Client disconnected or fetch failed before the re-ranking was used
+        if rerank_task and not rerank_task.done():
+            rerank_task.cancel()
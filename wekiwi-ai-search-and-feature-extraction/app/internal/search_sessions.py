@@ -0,0 +1,63 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+import time
+import uuid
+
+from cachetools import TTLCache
+from typing import List, Literal, Optional
+from pydantic import BaseModel, Field
+
+
+class SearchSession(BaseModel):
+    """Scored hits and ranked root subtrees of a search, paged through with a cursor."""
+    session_id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    company_id: int
+    circle_ids: List[int]
+    k_avg: int
+    hydration: Literal["directus", "milvus"] = "directus"
+    hits: List[dict] = Field(description="Hits of the search (content_id), in hybrid search order.")
+    scores: List[float] = Field(description="Score of each hit.")
+    subtrees: List[List[int]] = Field(description="Content ids of each root's subtree, best root first.")
+    created_at: float = Field(default_factory=time.time)
+
+    def allows(self, company_id: int, circle_ids: List[int]) -> bool:
+        """Sessions are bound to the company and circles of the search, other users cannot page through them."""
+        return self.company_id == company_id and set(self.circle_ids) == set(circle_ids)
+
+    def page(self, offset: int, page_size: int) -> tuple[List[List[int]], Optional[str]]:
+        """Returns the root subtrees of a page and the cursor of the next page (None on the last page)."""
+        next_offset = offset + page_size
+        next_cursor = encode_cursor(self.session_id, next_offset) if next_offset < len(self.subtrees) else None
+        return self.subtrees[offset:next_offset], next_cursor
+
+
+def encode_cursor(session_id: str, offset: int) -> str:
+    return f"{session_id}.{offset}"
+
+
+def decode_cursor(cursor: str) -> tuple[str, int]:
+    """Raises ValueError for malformed cursors."""
+    session_id, offset = cursor.split(".")
+    offset = int(offset)
+    if offset < 0:
+        raise ValueError("Cursor offset must not be negative.")
+    return session_id, offset
+
+
+class SearchSessionStore:
+    """
+    Keeps search sessions in memory. The number of sessions and their lifetime are bounded, each session holds
+    the ids and scores of at most SEARCH_SESSION_CANDIDATES hits. Sessions are lost on restart.
+    """
+
+    def __init__(self, max_sessions: int, ttl: int):
+        self.sessions: TTLCache = TTLCache(maxsize=max_sessions, ttl=ttl)
+
+    def add(self, session: SearchSession) -> SearchSession:
+        self.sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id: str) -> Optional[SearchSession]:
+        return self.sessions.get(session_id)
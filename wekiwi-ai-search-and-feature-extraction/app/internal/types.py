@@ -3,7 +3,7 @@
 # See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
 
 from typing import List, Optional, Literal, Any # Added Any for potential future use
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, field_validator, model_validator
 
 from datetime import datetime
 
@@ -64,6 +64,48 @@ class ContentValidated(ContentBase):
             return int(dt.timestamp())
         return value or 0
 
+# e.g. Bulk content creation
+class ContentCreateItem(BaseModel):
+    content: ContentValidated = Field(..., description="Content to be embedded")
+    circle_ids: List[int] = Field(..., description="Circle_id(s) that the user has access to and the content should be posted in.")
+    company_id: int = Field(..., description="Company_id of the user posting the content.")
+
+class ContentCreateResult(BaseModel):
+    content_id: int
+    status: Literal['created', 'failed']
+    chunks: int = 0
+    error: Optional[str] = None
+
+MAX_CIRCLE_IDS = 8  # Capacity of the circle_ids array field in MilvusDB
+
+# e.g. Bulk circle reassignment (circle merged or deleted)
+class ContentCirclesUpdate(BaseModel):
+    company_id: int = Field(..., description="Company_id of the contents to update.")
+    content_ids: Optional[List[int]] = Field(None, description="Only update these contents.")
+    circle_id: Optional[int] = Field(None, description="Only update contents currently posted in this circle.")
+    set_circle_ids: Optional[List[int]] = Field(None, description="Replace the circle_ids of the matching contents.")
+    add_circle_ids: List[int] = Field(default=[], description="Circle_ids to add to the matching contents.")
+    remove_circle_ids: List[int] = Field(default=[], description="Circle_ids to remove from the matching contents.")
+
+    @model_validator(mode='after')
+    def check_selection(self):
+        if self.content_ids is None and self.circle_id is None:
+            raise ValueError("content_ids or circle_id must be provided.")
+        if self.set_circle_ids is not None and (self.add_circle_ids or self.remove_circle_ids):
+            raise ValueError("set_circle_ids cannot be combined with add_circle_ids or remove_circle_ids.")
+        if self.set_circle_ids is None and not (self.add_circle_ids or self.remove_circle_ids):
+            raise ValueError("set_circle_ids, add_circle_ids or remove_circle_ids must be provided.")
+        if len(set(self.set_circle_ids or [])) > MAX_CIRCLE_IDS or len(set(self.add_circle_ids)) > MAX_CIRCLE_IDS:
+            raise ValueError(f"A content can be posted in at most {MAX_CIRCLE_IDS} circles.")
+        return self
+
+    def apply(self, circle_ids: List[int]) -> List[int]:
+        """Returns the new circle_ids of a content."""
+        if self.set_circle_ids is not None:
+            return list(dict.fromkeys(self.set_circle_ids))
+        updated = [circle_id for circle_id in circle_ids if circle_id not in self.remove_circle_ids]
+        return updated + [circle_id for circle_id in self.add_circle_ids if circle_id not in updated]
+
 class ContentSearchResult(ContentBase):
     score: Optional[float]
     child_id: Optional[List["ContentSearchResult"]]
@@ -3,6 +3,7 @@
 # See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
 
 import httpx
+from app.internal.http_clients import http_client
 from app.config import OLLAMA_API_URL, OLLAMA_TITLE_MODEL
 
 async def generate_german_title(text: str) -> str:
@@ -81,10 +82,9 @@ TITEL:"""
     }
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(api_url, headers=headers, json=data)
-            print(response.json())
-            response.raise_for_status()
-            return response.json().get("response", "").strip()
+        response = await http_client("ollama").post(api_url, headers=headers, json=data)
+        print(response.json())
+        response.raise_for_status()
+        return response.json().get("response", "").strip()
     except httpx.HTTPError as e:
         raise httpx.HTTPError(f"API request failed: {e}") 
\ No newline at end of file
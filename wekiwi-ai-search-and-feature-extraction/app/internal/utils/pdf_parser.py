@@ -1,13 +1,16 @@
 # wekiwi-ai-search-and-feature-extraction/app/internal/utils/pdf_parser.py
-from io import BytesIO
 from unittest import result
 import httpx
-import asyncio
+import os
+import tempfile
 import base64 # Needed if we fetch asset data as base64
-from typing import Any, Dict, Optional, List
+from typing import Any, BinaryIO, Callable, Dict, Optional, List
 from loguru import logger
+from starlette.concurrency import run_in_threadpool
 # Import the custom DirectusClient implementation
 from app.internal.directus import DirectusClient, UserDirectusClient
+from app.internal.http_clients import http_client
+from app.internal.hub_poller import hub_poller, estimate_conversion_seconds
 
 # Import the payload model from the types file
 from app.internal.types import PdfParseTriggerPayload
@@ -16,27 +19,80 @@ from app.config import DAW_API_HUB_URL, DAW_HUB_KEY
 from markitdown import MarkItDown
 import html
 
+# Documents are streamed in chunks of this size (downloads from Directus), uploads stream from their file objects
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Stages of a conversion reported to `on_stage` (e.g. the conversion queue): fetch, convert, poll, download, create_content
+StageCallback = Callable[[str], None]
+
+
+def enter_stage(on_stage: Optional[StageCallback], stage: str):
+    if on_stage:
+        on_stage(stage)
+
+# Irreversible steps of a conversion are recorded in a progress dict and reported to `on_progress` (e.g. saved with
+# the job by the conversion queue), so a retry does not repeat them:
+#   file_id           - the document uploaded to Directus
+#   content_requested - "with_document" or "text_only", a create request was sent to Directus
+#   content_id        - the content created in Directus
+ProgressCallback = Callable[[dict], None]
+
+
+def record_progress(progress: dict, on_progress: Optional[ProgressCallback], **steps):
+    progress.update(steps)
+    if on_progress:
+        on_progress(progress)
+
+
+def retry_is_safe(progress: dict) -> bool:
+    """
+    A failed conversion may be retried unless Directus may have created its content without a way to find it again.
+    Contents created together with their document are found by the uploaded file (see find_content_of_file).
+    """
+    return progress.get("content_requested") in (None, "with_document")
+
+
+async def find_content_of_file(directus_client: UserDirectusClient, file_id: str) -> Optional[dict]:
+    """Returns the text content created with the document content of an uploaded file, None if there is none."""
+    documents = await directus_client.read_items(
+        "contents", {"filter": {"file_id": {"_eq": file_id}}, "fields": ["content_id", "parent_id"], "limit": 1}
+    )
+    if documents and documents[0].get("parent_id"):
+        return {"content_id": documents[0]["parent_id"]}
+    return None
+
 # --- Helper Function to Get Asset Data ---
 # Consider moving this to app/internal/directus/directus.py if reusable
 # Add directus_base_url and directus_token as arguments
-async def get_directus_asset_data(file_id: str, directus_base_url: str, directus_token: str) -> Optional[bytes]:
-    """Fetches raw asset data from Directus using provided URL and token."""
+async def get_directus_asset_data(file_id: str, directus_base_url: str, directus_token: str) -> Optional[BinaryIO]:
+    """
+    Downloads an asset from Directus using provided URL and token, streamed in chunks into a temporary file.
+    Returns the file positioned at its start (deleted when closed), None if the download failed.
+    """
     # Note: directus_client object is no longer needed here
+    asset_file = tempfile.TemporaryFile()
     try:
         # Construct URL using the passed base URL
         asset_url = f"{directus_base_url.rstrip('/')}/assets/{file_id}"
         # Use the passed token directly for the Authorization header
         headers = {"Authorization": f"Bearer {directus_token}"}
 
-        async with httpx.AsyncClient(timeout=300.0) as client: # Added timeout
-            response = await client.get(asset_url, headers=headers, follow_redirects=True)
+        client = http_client("directus")
+        async with client.stream("GET", asset_url, headers=headers, follow_redirects=True, timeout=300.0) as response:
+            if response.is_error:
+                await response.aread()
             response.raise_for_status() # Raise exception for 4xx/5xx errors
-            logger.info(f"Successfully fetched asset data for file_id: {file_id}")
-            return response.content
+            async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                asset_file.write(chunk)
+        asset_file.seek(0)
+        logger.info(f"Successfully fetched asset data for file_id: {file_id}")
+        return asset_file
     except httpx.HTTPStatusError as e:
+        asset_file.close()
         logger.error(f"HTTP error fetching asset {file_id} from Directus: {e.response.status_code} - {e.response.text}")
         return None
     except Exception as e:
+        asset_file.close()
         logger.error(f"Error fetching asset {file_id} from Directus: {e}")
         return None
 
@@ -44,10 +100,14 @@ async def get_directus_asset_data(file_id: str, directus_base_url: str, directus
 async def process_pdf_and_create_reply_task(
     payload: PdfParseTriggerPayload,
     directus_url: str, # Keep this argument
-    directus_token: str # This is the admin token
+    directus_token: str, # This is the admin token
+    on_stage: Optional[StageCallback] = None,
+    progress: Optional[dict] = None,
+    on_progress: Optional[ProgressCallback] = None,
 ):
     """
-    Background task to process PDF and create reply.
+    Background task to process PDF and create reply, returns the created reply (None if the task failed).
+    Steps done by an earlier attempt are recorded in `progress` (see ProgressCallback) and not repeated.
     1. Initializes Directus client.
     2. Fetches PDF data from Directus.
     3. Calls external conversion service (daw-api-hub).
@@ -56,6 +116,10 @@ async def process_pdf_and_create_reply_task(
     6. Creates reply content item in Directus.
     """
     logger.info(f"Starting PDF processing task for file_id: {payload.directus_file_id}")
+    progress = {} if progress is None else progress
+    if progress.get("content_id"):
+        logger.info(f"Reply {progress['content_id']} was created by an earlier attempt.")
+        return {"content_id": progress["content_id"]}
 
     # 1. Initialize Directus Client
     try:
@@ -68,9 +132,11 @@ async def process_pdf_and_create_reply_task(
         return  # Cannot proceed without Directus client
 
     # 2. Fetch PDF Data
+    enter_stage(on_stage, "fetch")
     # Pass file_id, url, and token to the helper function
-    pdf_data = await get_directus_asset_data(payload.directus_file_id, directus_url, directus_token)
-    if not pdf_data:
+    # The PDF is kept in a temporary file, deleted when the task returns and the file is closed
+    pdf_file = await get_directus_asset_data(payload.directus_file_id, directus_url, directus_token)
+    if not pdf_file:
         logger.error(f"Failed to fetch PDF data for file_id: {payload.directus_file_id}. Aborting task.")
         return
 
@@ -107,123 +173,98 @@ async def process_pdf_and_create_reply_task(
         return
 
     # Use the correct endpoint that expects multipart/form-data
+    enter_stage(on_stage, "convert")
     conversion_endpoint = f"{external_service_url.rstrip('/')}/docling/docling/convert-pdf?use_background=true"
     task_id: Optional[str] = None
+    callback_url, callback_token = hub_poller.callback_url()
+    params = {"callback_url": callback_url} if callback_url else None
 
     try:
-        async with httpx.AsyncClient(timeout=300.0) as client: # Increased timeout
-            # Prepare multipart/form-data
-            files = {'file': (f"{payload.directus_file_id}.pdf", pdf_data, 'application/pdf')}
-            headers = {
-                'accept': 'application/json',
-                'DAW-Hub-Key': external_service_key
-                # Content-Type is set automatically by httpx for multipart/form-data
-            }
-            logger.info(f"Calling external conversion service: {conversion_endpoint}")
-            logger.info(f"PDF data size: {len(pdf_data)} bytes")
-            logger.info(f"Request headers: {headers}")
-            logger.info(f"File name in request: {payload.directus_file_id}.pdf")
-            
-            try:
-                response = await client.post(conversion_endpoint, files=files, headers=headers)
-                logger.info(f"Conversion service response status: {response.status_code}")
-                logger.info(f"Conversion service response headers: {dict(response.headers)}")
-                logger.info(f"Conversion service response content: {response.content[:500]}...")  # Log first 500 chars to avoid huge logs
-                response.raise_for_status()
-                response_data = response.json()
-                logger.info(f"Conversion service response data: {response_data}")
-                task_id = response_data.get("task_id")
-                if not task_id:
-                    # Handle potential synchronous response from daw-api-hub if file is small
-                    if response_data.get("text") is not None:
-                         logger.info("Conversion service returned synchronous result.")
-                         # Skip polling and downloading, go directly to creating reply
-                         parsed_text = response_data.get("text")
-                         # Proceed to step 6
-                    else:
-                         logger.error(f"Conversion service did not return task_id or text. Response: {response_data}")
-                         return
+        client = http_client("daw_hub")
+        # Prepare multipart/form-data
+        files = {'file': (f"{payload.directus_file_id}.pdf", pdf_file, 'application/pdf')}
+        headers = {
+            'accept': 'application/json',
+            'DAW-Hub-Key': external_service_key
+            # Content-Type is set automatically by httpx for multipart/form-data
+        }
+        logger.info(f"Calling external conversion service: {conversion_endpoint}")
+        logger.info(f"PDF data size: {os.fstat(pdf_file.fileno()).st_size} bytes")
+        logger.info(f"Request headers: {headers}")
+        logger.info(f"File name in request: {payload.directus_file_id}.pdf")
+        
+        try:
+            response = await client.post(conversion_endpoint, files=files, headers=headers, params=params)
+            logger.info(f"Conversion service response status: {response.status_code}")
+            logger.info(f"Conversion service response headers: {dict(response.headers)}")
+            logger.info(f"Conversion service response content: {response.content[:500]}...")  # Log first 500 chars to avoid huge logs
+            response.raise_for_status()
+            response_data = response.json()
+            logger.info(f"Conversion service response data: {response_data}")
+            task_id = response_data.get("task_id")
+            if not task_id:
+                # Handle potential synchronous response from daw-api-hub if file is small
+                if response_data.get("text") is not None:
+                     logger.info("Conversion service returned synchronous result.")
+                     # Skip polling and downloading, go directly to creating reply
+                     parsed_text = response_data.get("text")
+                     # Proceed to step 6
                 else:
-                     logger.info(f"Conversion task initiated with task_id: {task_id}")
-                     parsed_text = None # Needs polling
+                     logger.error(f"Conversion service did not return task_id or text. Response: {response_data}")
+                     return
+            else:
+                 logger.info(f"Conversion task initiated with task_id: {task_id}")
+                 parsed_text = None # Needs polling
 
-            except httpx.HTTPStatusError as e:
-                logger.error(f"HTTP error calling conversion service: {e.response.status_code} - {e.response.text}")
-                return
-            except Exception as e:
-                logger.error(f"Error calling conversion service: {e}")
-                return
+        except httpx.HTTPStatusError as e:
+            logger.error(f"HTTP error calling conversion service: {e.response.status_code} - {e.response.text}")
+            return
+        except Exception as e:
+            logger.error(f"Error calling conversion service: {e}")
+            return
 
     except Exception as e:
         logger.error(f"Error calling conversion service: {e}")
         return
 
-    # 4. Poll for Completion (only if task_id was received)
+    # 4. Wait for Completion (only if task_id was received), polled adaptively or pushed by the hub
     if task_id:
-        status_endpoint = f"{external_service_url.rstrip('/')}/docling/docling/task-status/{task_id}"
-        polling_interval = 10 # seconds
-        max_polling_attempts = 36 # 36 * 10s = 6 minutes timeout
-
-        logger.info(f"Polling status endpoint: {status_endpoint}")
-        for attempt in range(max_polling_attempts):
-            await asyncio.sleep(polling_interval) # Wait *before* polling (gives task time to start)
-            try:
-                async with httpx.AsyncClient(timeout=30.0) as client:
-                    headers = {'accept': 'application/json', 'DAW-Hub-Key': external_service_key}
-                    logger.info(f"Polling attempt {attempt+1}/{max_polling_attempts} - Sending request to: {status_endpoint}")
-                    logger.info(f"Polling request headers: {headers}")
-                    
-                    response = await client.get(status_endpoint, headers=headers)
-                    logger.info(f"Polling response status: {response.status_code}")
-                    logger.info(f"Polling response headers: {dict(response.headers)}")
-                    logger.info(f"Polling response content: {response.content[:500]}...")  # Log first 500 chars
-                    
-                    response.raise_for_status()
-                    status_data = response.json()
-                    current_status = status_data.get("status")
-                    logger.info(f"Polling attempt {attempt+1}/{max_polling_attempts}: Status = {current_status}")
-                    if current_status == "completed":
-                        logger.info(f"Task {task_id} completed.")
-                        # Text should be included in status response now due to previous change
-                        parsed_text = status_data.get("result_text")
-                        if parsed_text is None:
-                             logger.warning(f"Task {task_id} completed but result_text missing in status response. Will attempt download.")
-                             # Fallback to download if text not in status
-                        break # Exit polling loop
-                    elif current_status == "failed":
-                        error_message = status_data.get("error", "Unknown error")
-                        logger.error(f"Conversion task {task_id} failed: {error_message}")
-                        return # Stop processing
-
-                # Wait is now at the beginning of the loop
-
-            except httpx.HTTPStatusError as e:
-                logger.error(f"HTTP error polling task status: {e.response.status_code} - {e.response.text}")
-                # Continue polling
-            except Exception as e:
-                logger.error(f"Error polling task status: {e}")
-                # Continue polling
-        else: # Loop finished without breaking (timeout)
-            logger.error(f"Polling timeout for task {task_id} after {max_polling_attempts} attempts.")
+        enter_stage(on_stage, "poll")
+        # Scanning the document for its pages is blocking file I/O, keep it off the event loop
+        estimate = await run_in_threadpool(estimate_conversion_seconds, pdf_file)
+        status_data = await hub_poller.wait(task_id, estimate, callback_token)
+        if status_data is None:
+            logger.error(f"Polling timeout for task {task_id}.")
             return
+        if status_data.get("status") == "failed":
+            error_message = status_data.get("error", "Unknown error")
+            logger.error(f"Conversion task {task_id} failed: {error_message}")
+            return # Stop processing
+
+        logger.info(f"Task {task_id} completed.")
+        # Text should be included in status response now due to previous change
+        parsed_text = status_data.get("result_text")
+        if parsed_text is None:
+             logger.warning(f"Task {task_id} completed but result_text missing in status response. Will attempt download.")
 
     # 5. Download Text (Fallback if not included in status)
     if task_id and parsed_text is None: # Only download if polling finished but text wasn't in status
+        enter_stage(on_stage, "download")
         download_endpoint = f"{external_service_url.rstrip('/')}/docling/docling/download-converted/{task_id}"
         logger.info(f"Attempting fallback download from: {download_endpoint}")
         try:
-            async with httpx.AsyncClient(timeout=300.0) as client:
-                headers = {'accept': 'text/plain', 'DAW-Hub-Key': external_service_key} # Expect plain text
-                logger.info(f"Download fallback request headers: {headers}")
-                
-                response = await client.get(download_endpoint, headers=headers)
-                logger.info(f"Download fallback response status: {response.status_code}")
-                logger.info(f"Download fallback response headers: {dict(response.headers)}")
-                logger.info(f"Download fallback response content (first 500 chars): {response.text[:500]}...")
-                
-                response.raise_for_status()
-                parsed_text = response.text
-                logger.info(f"Successfully downloaded converted text via fallback (length: {len(parsed_text)}).")
+            client = http_client("daw_hub")
+            headers = {'accept': 'text/plain', 'DAW-Hub-Key': external_service_key} # Expect plain text
+            logger.info(f"Download fallback request headers: {headers}")
+            
+            response = await client.get(download_endpoint, headers=headers)
+            logger.info(f"Download fallback response status: {response.status_code}")
+            logger.info(f"Download fallback response headers: {dict(response.headers)}")
+            logger.info(f"Download fallback response content (first 500 chars): {response.text[:500]}...")
+            
+            response.raise_for_status()
+            parsed_text = response.text
+            logger.info(f"Successfully downloaded converted text via fallback (length: {len(parsed_text)}).")
         except httpx.HTTPStatusError as e:
             logger.error(f"HTTP error during fallback download: {e.response.status_code} - {e.response.text}")
             return
@@ -236,6 +277,7 @@ async def process_pdf_and_create_reply_task(
         return
 
     # 6. Create Reply in Directus
+    enter_stage(on_stage, "create_content")
     logger.info(f"Creating reply content item in Directus for parent_id: {payload.parent_content_id}")
     try:
         # Ensure circle_ids is a list of dicts for Directus
@@ -255,35 +297,46 @@ async def process_pdf_and_create_reply_task(
         }
         
         # The DirectusClient.create_item method will handle user attribution automatically
-        created_item = directus_client.create_item("contents", reply_payload)
+        record_progress(progress, on_progress, content_requested="text_only")
+        created_item = await directus_client.create_item("contents", reply_payload)
+        record_progress(progress, on_progress, content_id=created_item.get('content_id'))
         logger.info(f"Successfully created reply content item with ID: {created_item.get('content_id')}")
 
     except Exception as e:
         # Log the payload for debugging if creation fails
         logger.error(f"Payload for failed Directus create: {reply_payload}")
         logger.error(f"Failed to create reply content item in Directus: {e}")
-        # Consider adding retry logic or specific error handling
+        if isinstance(e, httpx.HTTPStatusError):
+            # Directus answered with an error, nothing was created and the conversion queue can retry
+            record_progress(progress, on_progress, content_requested=None)
+        return None
 
     logger.info(f"Finished PDF processing task for file_id: {payload.directus_file_id}")
+    return created_item
 
 # --- Added for Direct PDF Upload Processing ---
 async def process_pdf_and_create_content_task(
-    document_data: bytes,
+    document: BinaryIO,
     filename: str,
     directus_url: str,
     directus_token: str,
     company_id: Optional[int] = None,
-    circle_ids: Optional[List[int]] = None
+    circle_ids: Optional[List[int]] = None,
+    on_stage: Optional[StageCallback] = None,
+    progress: Optional[dict] = None,
+    on_progress: Optional[ProgressCallback] = None,
 ):
     """
     Background task to process a directly uploaded PDF or DOCX file and create content.
+    The document is a file opened in binary mode, it is streamed to the DAW hub and Directus.
+    Steps done by an earlier attempt are recorded in `progress` (see ProgressCallback) and not repeated.
     1. Initializes Directus client with the user's token.
     2. Calls external conversion service (daw-api-hub) for PDFs or processes DOCX directly.
     3. Polls for conversion completion if PDF.
     4. Downloads converted text.
-    5. Creates text content item in Directus using the authenticated user.
-    6. Uploads the document to Directus.
-    7. Creates document content item with parent_id pointing to text content.
+    5. Uploads the document to Directus.
+    6. Creates the text content item with the document content item as its child in one request,
+       using the authenticated user.
     """
     logger.info(f"Starting direct PDF processing task for file: {filename}")
 
@@ -300,6 +353,20 @@ async def process_pdf_and_create_content_task(
     if not company_id or not circle_ids:
         logger.error("Missing required company_id or circle_ids for content creation")
         return  # Cannot proceed without company_id and circle_ids
+
+    progress = {} if progress is None else progress
+    if not progress.get("content_id") and progress.get("content_requested") == "with_document":
+        # An earlier attempt sent the content without learning the result, it is found by its document
+        try:
+            existing = await find_content_of_file(directus_client, progress["file_id"])
+        except Exception as e:
+            logger.error(f"Failed to look up content of file {progress['file_id']}: {e}")
+            return  # Retried by the conversion queue
+        if existing:
+            record_progress(progress, on_progress, content_id=existing["content_id"])
+    if progress.get("content_id"):
+        logger.info(f"Content {progress['content_id']} was created by an earlier attempt.")
+        return {"content_id": progress["content_id"]}
     
         
     logger.info(f"Processing document for company_id: {company_id}, circle_ids: {circle_ids}")
@@ -309,12 +376,14 @@ async def process_pdf_and_create_content_task(
     external_service_key = DAW_HUB_KEY
     task_id = None
     parsed_text = None
+    callback_token = None
 
     #Determine the type of document
     is_pdf = filename.endswith(".pdf")
     is_docx = filename.endswith(".docx")
 
     # If the file is a PDF, send it to the external service for conversion
+    enter_stage(on_stage, "convert")
     if is_pdf:
         # Validation for external service configuration
         if not external_service_url or not external_service_key:
@@ -326,22 +395,26 @@ async def process_pdf_and_create_content_task(
             upload_endpoint = f"{external_service_url.rstrip('/')}/docling/docling/convert-pdf?use_background=true"
             
             # Prepare the file for upload
-            files = {"file": (filename, document_data, "application/pdf")}
+            document.seek(0)
+            files = {"file": (filename, document, "application/pdf")}
             headers = {"Accept": "application/json", "DAW-Hub-Key": external_service_key}
             
-            async with httpx.AsyncClient(timeout=300.0) as client:
-                logger.info(f"Sending PDF to conversion service at: {upload_endpoint}")
-                response = await client.post(upload_endpoint, files=files, headers=headers)
-                response.raise_for_status()
-                
-                # Extract task ID from response
-                response_data = response.json()
-                task_id = response_data.get("task_id")
-                if not task_id:
-                    logger.error("No task_id received from conversion service")
-                    return
-                
-                logger.info(f"Conversion task created with ID: {task_id}")
+            callback_url, callback_token = hub_poller.callback_url()
+            params = {"callback_url": callback_url} if callback_url else None
+
+            client = http_client("daw_hub")
+            logger.info(f"Sending PDF to conversion service at: {upload_endpoint}")
+            response = await client.post(upload_endpoint, files=files, headers=headers, params=params)
+            response.raise_for_status()
+            
+            # Extract task ID from response
+            response_data = response.json()
+            task_id = response_data.get("task_id")
+            if not task_id:
+                logger.error("No task_id received from conversion service")
+                return
+            
+            logger.info(f"Conversion task created with ID: {task_id}")
         except httpx.HTTPStatusError as e:
             logger.error(f"HTTP error calling conversion service: {e.response.status_code} - {e.response.text}")
             return
@@ -354,7 +427,7 @@ async def process_pdf_and_create_content_task(
         # Handle DOCX processing
         try:
             # Extract text with preserved formatting
-            parsed_text = await extract_markdown_form_docx(document_data)
+            parsed_text = await extract_markdown_form_docx(document)
             content_type = "text"
             logger.info(f"Parsed text: {parsed_text}")
         except Exception as e:
@@ -362,62 +435,40 @@ async def process_pdf_and_create_content_task(
             return
             
             
-    # 4. Poll for Conversion Completion
+    # 4. Wait for Conversion Completion, polled adaptively or pushed by the hub
     if is_pdf and task_id:
-        status_endpoint = f"{external_service_url.rstrip('/')}/docling/docling/task-status/{task_id}"
-        headers = {"Accept": "application/json", "DAW-Hub-Key": external_service_key}
-        
-        max_polling_attempts = 12  # 1 minute total (5s intervals)
-        polling_interval = 5      # seconds
-        
-        # Poll the external conversion service until the task is completed or timeout
-        for attempt in range(max_polling_attempts):
-            await asyncio.sleep(polling_interval)  # Wait first, then poll
-            
-            try:
-                logger.info(f"Polling conversion status, attempt {attempt + 1}/{max_polling_attempts}")
-                async with httpx.AsyncClient(timeout=30.0) as client:
-                    response = await client.get(status_endpoint, headers=headers)
-                    response.raise_for_status()
-                    
-                    status_data = response.json()
-                    current_status = status_data.get("status")
-                    logger.info(f"Current status: {current_status}")
-                    
-                    if current_status == "completed":
-                        # Check if text is included in the status response
-                        parsed_text = status_data.get("text")
-                        if parsed_text:
-                            logger.info(f"Received parsed text in status response (length: {len(parsed_text)})")
-                        else:
-                            logger.info("Parsed text not included in status, will use fallback download")
-                        break  # Exit polling loop
-                    elif current_status == "failed":
-                        error_message = status_data.get("error", "Unknown error")
-                        logger.error(f"Conversion task {task_id} failed: {error_message}")
-                        return  # Stop processing
-            except httpx.HTTPStatusError as e:
-                logger.error(f"HTTP error polling task status: {e.response.status_code} - {e.response.text}")
-                # Continue polling
-            except Exception as e:
-                logger.error(f"Error polling task status: {e}")
-                # Continue polling
-        else:  # Loop finished without breaking (timeout)
-            logger.error(f"Polling timeout for task {task_id} after {max_polling_attempts} attempts.")
+        enter_stage(on_stage, "poll")
+        # Scanning the document for its pages is blocking file I/O, keep it off the event loop
+        estimate = await run_in_threadpool(estimate_conversion_seconds, document)
+        status_data = await hub_poller.wait(task_id, estimate, callback_token)
+        if status_data is None:
+            logger.error(f"Polling timeout for task {task_id}.")
             return
+        if status_data.get("status") == "failed":
+            error_message = status_data.get("error", "Unknown error")
+            logger.error(f"Conversion task {task_id} failed: {error_message}")
+            return  # Stop processing
+
+        # Check if text is included in the status response
+        parsed_text = status_data.get("text")
+        if parsed_text:
+            logger.info(f"Received parsed text in status response (length: {len(parsed_text)})")
+        else:
+            logger.info("Parsed text not included in status, will use fallback download")
 
     # 5. Download Text (Fallback if not included in status)
     if task_id and parsed_text is None:  # Only download if polling finished but text wasn't in status
+        enter_stage(on_stage, "download")
         download_endpoint = f"{external_service_url.rstrip('/')}/docling/docling/download-converted/{task_id}"
         logger.info(f"Attempting fallback download from: {download_endpoint}")
         try:
-            async with httpx.AsyncClient(timeout=300.0) as client:
-                headers = {'accept': 'text/plain', 'DAW-Hub-Key': external_service_key}
-                
-                response = await client.get(download_endpoint, headers=headers)
-                response.raise_for_status()
-                parsed_text = response.text
-                logger.info(f"Successfully downloaded converted text via fallback (length: {len(parsed_text)})")
+            client = http_client("daw_hub")
+            headers = {'accept': 'text/plain', 'DAW-Hub-Key': external_service_key}
+            
+            response = await client.get(download_endpoint, headers=headers)
+            response.raise_for_status()
+            parsed_text = response.text
+            logger.info(f"Successfully downloaded converted text via fallback (length: {len(parsed_text)})")
         except httpx.HTTPStatusError as e:
             logger.error(f"HTTP error during fallback download: {e.response.status_code} - {e.response.text}")
             return
@@ -429,29 +480,68 @@ async def process_pdf_and_create_content_task(
         logger.error("Failed to retrieve parsed text. Aborting content creation.")
         return
 
-    # 6. Create Text Content in Directus (this will be the parent)
+    # Ensure circle_ids is a list of dicts for Directus
+    circle_contents_payload = [{'circle_id': cid} for cid in circle_ids] if circle_ids else []
+
+    # Extract title from filename (remove extension)
+    title = filename
+    if "." in filename:
+        title = filename.rsplit(".", 1)[0]
+
+    # 6. Upload PDF to Directus (in the content folder), first so the text content and its document content can be
+    # created in one request
+    enter_stage(on_stage, "create_content")
+    file_id = progress.get("file_id")
+    if not file_id:
+        document.seek(0)
+        file_id = await directus_client.upload_file(document, filename)
+        if file_id:
+            record_progress(progress, on_progress, file_id=file_id)
+    if file_id:
+        logger.info(f"Successfully uploaded PDF to Directus with file_id: {file_id}")
+        document_payload = {
+            "title": None,  # title is null as specified
+            "text": None,  # text is null as specified
+            "company_id": company_id,
+            "circle_contents": circle_contents_payload,
+            "content_type": 'document',
+            "file_id": file_id,
+            "to_be_parsed_by_directus_flow": False  # Flag to exclude from post-as-reply flow
+        }
+    else:
+        logger.error("Failed to upload PDF file to Directus. Document content will not be created.")
+        document_payload = None
+
+    # 7. Create Text Content in Directus (this will be the parent), with the document content nested as its child
     text_content_id = None
     logger.info(f"Creating text content item in Directus using authenticated user token")
+    text_content_payload = {
+        "text": parsed_text,
+        "company_id": company_id,
+        "circle_contents": circle_contents_payload,
+        "content_type": 'text',
+        "title": title
+    }
     try:
-        # Ensure circle_ids is a list of dicts for Directus
-        circle_contents_payload = [{'circle_id': cid} for cid in circle_ids] if circle_ids else []
-
-        # Extract title from filename (remove extension)
-        title = filename
-        if "." in filename:
-            title = filename.rsplit(".", 1)[0]
+        try:
+            if document_payload:
+                record_progress(progress, on_progress, content_requested="with_document")
+                text_content_item = await directus_client.create_item(
+                    "contents", {**text_content_payload, "child_id": [document_payload]}
+                )
+                document_payload = None  # Created together with its parent
+            else:
+                record_progress(progress, on_progress, content_requested="text_only")
+                text_content_item = await directus_client.create_item("contents", text_content_payload)
+        except httpx.HTTPStatusError as e:
+            if not (document_payload and e.response.is_client_error):
+                raise
+            logger.warning(f"Directus refused the nested document content ({e.response.status_code}), creating it separately.")
+            record_progress(progress, on_progress, content_requested="text_only")
+            text_content_item = await directus_client.create_item("contents", text_content_payload)
 
-        text_content_payload = {
-            "text": parsed_text,
-            "company_id": company_id,
-            "circle_contents": circle_contents_payload,
-            "content_type": 'text',
-            "title": title
-        }
-        
-        # Create the text content item
-        text_content_item = directus_client.create_item("contents", text_content_payload)
         text_content_id = text_content_item.get('content_id')
+        record_progress(progress, on_progress, content_id=text_content_id)
         logger.info(f"Successfully created text content item with ID: {text_content_id}")
         
         if not text_content_id:
@@ -462,48 +552,36 @@ async def process_pdf_and_create_content_task(
         # Log the payload for debugging if creation fails
         logger.error(f"Payload for failed Directus text content create: {text_content_payload}")
         logger.error(f"Failed to create text content item in Directus: {e}")
+        if isinstance(e, httpx.HTTPStatusError):
+            # Directus answered with an error, nothing was created and the conversion queue can retry
+            record_progress(progress, on_progress, content_requested=None)
         return None
 
-    # 7. Upload PDF to Directus (in the content folder)
-    try:
-        file_id = directus_client.upload_file(document_data, filename)
-        if not file_id:
-            logger.error("Failed to upload PDF file to Directus. Document content will not be created.")
-            return text_content_item  # Return the text content item anyway
+    # 8. Create the document content as a child of the text content, only if Directus refused the nested creation
+    if document_payload:
+        try:
+            document_item = await directus_client.create_item(
+                "contents", {**document_payload, "parent_id": text_content_id}  # set parent to text content
+            )
+            document_content_id = document_item.get('content_id')
+            logger.info(f"Successfully created document content item with ID: {document_content_id}")
             
-        logger.info(f"Successfully uploaded PDF to Directus with file_id: {file_id}")
-        
-        # 8. Create a document content item in Directus as a child of the text content
-        document_payload = {
-            "title": None,  # title is null as specified
-            "text": None,  # text is null as specified
-            "company_id": company_id,
-            "circle_contents": circle_contents_payload,
-            "content_type": 'document',
-            "file_id": file_id,
-            "parent_id": text_content_id,  # This is the critical part - set parent to text content
-            "to_be_parsed_by_directus_flow": False  # Flag to exclude from post-as-reply flow
-        }
-        
-        document_item = directus_client.create_item("contents", document_payload)
-        document_content_id = document_item.get('content_id')
-        logger.info(f"Successfully created document content item with ID: {document_content_id}")
-        
-    except Exception as e:
-        logger.error(f"Failed to create document content: {e}")
-        # Return the text content item even if document creation failed
-        return text_content_item
+        except Exception as e:
+            logger.error(f"Failed to create document content: {e}")
+            # Return the text content item even if document creation failed
+            return text_content_item
 
     logger.info(f"Finished direct PDF processing task for file: {filename}")
     return text_content_item  # Return the text content item (the parent)
 
 
-async def extract_markdown_form_docx(docx_data: bytes) -> str:
+async def extract_markdown_form_docx(docx_file: BinaryIO) -> str:
     """
-    convert docx file(as bytes) to markdown using Markitdown in memory
+    convert docx file(opened in binary mode) to markdown using Markitdown
     """
     markdown = MarkItDown()
-    md_result = markdown.convert(BytesIO(docx_data))
+    docx_file.seek(0)
+    md_result = markdown.convert(docx_file)
     return md_result.text_content
     
     
\ No newline at end of file
@@ -3,7 +3,6 @@
 # See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
 
 import polars as pl
-from loguru import logger
 # Removed numpy import as explicit checks are removed
 # import numpy as np
 
@@ -28,106 +27,119 @@ def calculate_combined_df(score_lf, content, k_avg):
 
     return combined_df
 
-def build_hierarchy(df):
-    # logger.debug(f"build_hierarchy: Input df schema: {df.schema}") # Removed debug log
-    # logger.debug(f"build_hierarchy: Input df head:\n{df.head(5)}") # Removed debug log
+_NODE_ID = "content_id"
+_PARENT_ID = "parent_id"
+
+
+def _ancestor_pairs(edges: pl.DataFrame) -> pl.DataFrame:
     """
-    Builds the hierarchical structure and calculates scores efficiently.
+    Returns all (descendant, ancestor) pairs of the tree, including every node as its own ancestor, and whether the
+    chain of the descendant ends at a root (parent_id null). Descendants whose chain ends at a parent that is not in
+    the frame are orphans.
+    """
+    frontier = edges.select(
+        pl.col(_NODE_ID).alias("descendant"), pl.col(_NODE_ID).alias("ancestor"), pl.col(_PARENT_ID).alias("next")
+    )
+    levels = [frontier]
+    # Each step walks one level up, the number of levels bounds the walk (protects against cycles)
+    for _ in range(edges.height):
+        frontier = (
+            frontier.filter(pl.col("next").is_not_null())
+            .join(edges, left_on="next", right_on=_NODE_ID, how="inner")
+            .select("descendant", pl.col("next").alias("ancestor"), pl.col(_PARENT_ID).alias("next"))
+        )
+        if frontier.is_empty():
+            break
+        levels.append(frontier)
+
+    pairs = pl.concat(levels)
+    rooted = pairs.filter(pl.col("next").is_null()).select("descendant").unique()
+    return pairs.join(rooted, on="descendant", how="semi").select("descendant", "ancestor")
+
+
+def _rank_roots(df: pl.DataFrame) -> tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame, pl.DataFrame]:
     """
+    Aggregates subtree score sums and leaf counts (scored nodes) column-wise over an ancestor table and ranks the
+    roots by score + average leaf score (stable, ties keep the input order).
+    Returns the cast frame, the ancestor pairs, the nodes with their average leaf score and the ranked roots.
+    """
+    df = df.with_columns(pl.col(_NODE_ID).cast(pl.Int64), pl.col(_PARENT_ID).cast(pl.Int64))
+    pairs = _ancestor_pairs(df.select(_NODE_ID, _PARENT_ID))
+
+    # Subtree aggregates: every node contributes its score to itself and all its ancestors
+    subtree = (
+        pairs.join(df.select(pl.col(_NODE_ID).alias("descendant"), "score"), on="descendant", how="left")
+        .group_by("ancestor")
+        .agg(
+            pl.col("score").sum().alias("total_score"),
+            pl.col("score").is_not_null().sum().alias("total_leafs"),
+        )
+        .select(
+            pl.col("ancestor").alias(_NODE_ID),
+            pl.when(pl.col("total_leafs") > 0)
+            .then(pl.col("total_score") / pl.col("total_leafs"))
+            .otherwise(None)
+            .alias("avg_leaf_score"),
+        )
+    )
+    nodes = df.with_row_index("_row").join(subtree, on=_NODE_ID, how="inner")
+
+    roots = (
+        nodes.filter(pl.col(_PARENT_ID).is_null())
+        .with_columns((pl.col("score").fill_null(0) + pl.col("avg_leaf_score").fill_null(0)).alias("_rank"))
+        .sort(["_rank", "_row"], descending=[True, False])
+    )
+    return df, pairs, nodes, roots
+
 
-    # Create a dictionary for fast parent-child lookup
-    parent_child_map = {}
-    # Use iter_rows() default tuple format for potentially better performance
-    for row_tuple in df.iter_rows():
-        # Unpack based on expected column order (adjust if schema changes)
-        # Assuming schema: content_id, file_id, content_type, title, text, parent_id, ..., score
-        # This is less robust than named=True but avoids potential dict overhead
-        try:
-             # Adjust indices based on actual combined_df schema
-             content_id = row_tuple[0]
-             parent_id = row_tuple[5]
-             score = row_tuple[-1] # Assuming score is the last column
-             # Create the dict needed for parent_child_map
-             # Only include necessary fields if full row dict isn't needed downstream
-             node_data = {
-                 "content_id": content_id,
-                 "score": score,
-                 # Add other fields from row_tuple by index if needed by calculate_scores_and_build_subtree
-                 "file_id": row_tuple[1],
-                 "content_type": row_tuple[2],
-                 "title": row_tuple[3],
-                 "text": row_tuple[4],
-                 "parent_id": parent_id,
-                 "date_created": row_tuple[6],
-                 "date_updated": row_tuple[7],
-                 "interaction_id": row_tuple[8],
-                 "user_created": row_tuple[9],
-                 "user_updated": row_tuple[10],
-             }
-             parent_child_map.setdefault(parent_id, []).append(node_data)
-        except IndexError:
-             logger.warning(f"Could not unpack row tuple during parent_child_map creation: {row_tuple}")
-             continue # Skip malformed rows
-
-    def calculate_scores_and_build_subtree(node):
-        """
-        Recursively calculates scores and builds the subtree for a node.
-        """
-        # Initialize with safe defaults - parent nodes may have None scores
-        node_score = node.get("score")
-        # Removed debug logs and explicit numpy checks (float conversion happens earlier now)
-
-        total_score = 0 if node_score is None else node_score
-        total_leafs = 1 if node_score is not None else 0
-        child_ids = []
-
-        # Process children (if any) using the precomputed map
-        for child in parent_child_map.get(node["content_id"], []):
-            child_score, child_leafs, child_tree = calculate_scores_and_build_subtree(child)
-
-            # Removed debug logs and explicit numpy checks
-
-            # Safely add child scores - they might be None if the child is a container
-            if child_score is not None:
-                # Removed type check log
-                total_score += child_score
-            if child_leafs > 0:
-                total_leafs += child_leafs
-            child_ids.append(child_tree)
-
-        # Calculate average leaf score - ensure we don't divide by zero
-        avg_leaf_score = total_score / total_leafs if total_leafs > 0 else None
-        # Removed debug log
-
-        # Return results (including subtree)
-        node["avg_leaf_score"] = avg_leaf_score
-        node["child_id"] = child_ids
-        return total_score, total_leafs, node
-
-    # Find root nodes and build the hierarchy
-    root_nodes = parent_child_map.get(None, [])
-    hierarchy = []
-    for root_node in root_nodes:
-        _, _, root_tree = calculate_scores_and_build_subtree(root_node)
-        hierarchy.append(root_tree)
-
-    # Sort by combined score, handling None values safely
-    def get_sort_key(x):
-        direct_score = x.get("score")
-        avg_score = x.get("avg_leaf_score")
-        # Removed debug logs and explicit numpy checks
-
-        direct_score_num = direct_score or 0
-        avg_score_num = avg_score or 0
-
-        # Removed type check log
-
-        return direct_score_num + avg_score_num
-
-    try:
-        hierarchy.sort(key=get_sort_key, reverse=True)
-    except Exception as sort_e:
-        logger.error(f"Error during hierarchy sort: {sort_e}")
-        raise # Re-raise the sorting error
-
-    return hierarchy
+def rank_root_subtrees(df) -> list[list[int]]:
+    """
+    Ranks the roots of a frame with content_id, parent_id and score columns the same way build_hierarchy does,
+    without any other content fields. Returns the content ids of each root's subtree (root first), best root first.
+    """
+    if df.is_empty():
+        return []
+
+    _, pairs, _, roots = _rank_roots(df)
+    subtrees = dict(
+        pairs.filter(pl.col("ancestor") != pl.col("descendant"))
+        .group_by("ancestor")
+        .agg(pl.col("descendant"))
+        .iter_rows()
+    )
+    return [[root_id, *subtrees.get(root_id, [])] for root_id in roots[_NODE_ID]]
+
+
+def build_hierarchy(df, limit: int | None = None):
+    """
+    Builds the hierarchical structure and calculates scores efficiently.
+
+    Scores are aggregated column-wise (see _rank_roots) and only the subtrees of the first `limit` roots
+    (all if None) are turned into nested dicts. Nodes whose parent is not part of the frame are dropped.
+    """
+    if df.is_empty():
+        return []
+
+    df, pairs, nodes, roots = _rank_roots(df)
+    if limit is not None:
+        roots = roots.head(limit)
+
+    # Materialise only the subtrees of the selected roots
+    selected = pairs.join(roots.select(pl.col(_NODE_ID).alias("ancestor")), on="ancestor", how="semi")
+    subtree_nodes = nodes.join(selected.select(pl.col("descendant").alias(_NODE_ID)).unique(), on=_NODE_ID, how="semi").sort("_row")
+
+    fields = [_NODE_ID, "score"] + [column for column in df.columns if column not in (_NODE_ID, "score")] + ["avg_leaf_score"]
+    columns = subtree_nodes.select(fields).to_dict(as_series=False)
+    node_dicts = {}
+    for values in zip(*columns.values()):
+        node = dict(zip(fields, values))
+        node["child_id"] = []
+        node_dicts[node[_NODE_ID]] = node
+
+    # Children keep the input order
+    for node in node_dicts.values():
+        parent = node_dicts.get(node[_PARENT_ID])
+        if parent is not None:
+            parent["child_id"].append(node)
+
+    return [node_dicts[content_id] for content_id in roots[_NODE_ID]]
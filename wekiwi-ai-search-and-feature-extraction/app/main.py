@@ -14,11 +14,13 @@ from concurrent.futures import ProcessPoolExecutor
 
 from fastapi import FastAPI, APIRouter, Depends
 
+from .api.v1 import jobs
 from .api.v1.content import content, search
 from .api.v1.content.text import rerank, caption
 # Add the imports for PDF processing endpoints
 from .api.v1.content import parse_and_reply
 from .api.v1.content import direct_upload
+from .api.v1.content import hub_callback
 
 from .internal.utils.logging import init_logging, log_requests_and_responses
 from .internal.errors import (
@@ -41,6 +43,7 @@ from .api.authentication import check_authentication
 # from .config import POSTGRES_DB_NAME, POSTGRES_DB_HOST, POSTGRES_DB_PORT
 
 from .internal.milvusdb import MilvusClient
+from .internal.milvusdb.rebuild import resume_change_tracking
 from .config import (
     # MILVUS_DB_NAME,
     MILVUS_DB_HOST,
@@ -48,8 +51,24 @@ from .config import (
 )
 
 from .internal.directus import DirectusClient
+from .internal.http_clients import open_http_clients, close_http_clients
+from .internal.hub_poller import hub_poller
+from .internal.jobs import JobRegistry
 from .config import DIRECTUS_URL, DIRECTUS_ADMIN_KEY
 
+from .internal.conversion_queue import ConversionQueue
+from .config import (
+    CONVERSION_QUEUE_DIR,
+    CONVERSION_CONCURRENCY,
+    CONVERSION_HUB_RATE,
+    CONVERSION_HUB_BURST,
+    CONVERSION_USER_RATE,
+    CONVERSION_USER_BURST,
+)
+
+from .internal.search_sessions import SearchSessionStore
+from .config import SEARCH_SESSION_MAX, SEARCH_SESSION_TTL
+
 from .internal.processor import TextRequestProcessor
 from .config import REQUEST_FLUSH_TIMEOUT, ACCUMLATION_TIMEOUT
 
@@ -93,9 +112,27 @@ async def lifespan(application: FastAPI):
     milvusdbclient = await MilvusClient(
         MILVUS_DB_HOST, MILVUS_DB_PORT,  # , MILVUS_DB_NAME
     )
+    # Writes are recorded for an interrupted rebuild, so resuming it does not lose them
+    resume_change_tracking(milvusdbclient)
 
+    # One pooled HTTP client per upstream (Directus, Ollama, DAW hub), shared by all outbound calls
+    open_http_clients()
     directusclient = DirectusClient(DIRECTUS_URL, DIRECTUS_ADMIN_KEY)
 
+    jobregistry = JobRegistry()
+    searchsessions = SearchSessionStore(SEARCH_SESSION_MAX, SEARCH_SESSION_TTL)
+
+    # Document conversions, queued jobs of the previous run are resumed
+    conversionqueue = ConversionQueue(
+        CONVERSION_QUEUE_DIR,
+        CONVERSION_CONCURRENCY,
+        CONVERSION_HUB_RATE,
+        CONVERSION_HUB_BURST,
+        CONVERSION_USER_RATE,
+        CONVERSION_USER_BURST,
+    )
+    await conversionqueue.start()
+
     # Load models
     txt_emb_model = SentenceTransformerWrapper(
         SENTENCE_TRANSFORMERS_EMBEDDING_MODEL,
@@ -142,6 +179,9 @@ async def lifespan(application: FastAPI):
         # "postgrespool": postgrespool,
         "milvusdbclient": milvusdbclient,
         "directusclient": directusclient,
+        "jobregistry": jobregistry,
+        "searchsessions": searchsessions,
+        "conversionqueue": conversionqueue,
         "txt_emb_model": txt_emb_model,
         "txt_emb_model1": txt_emb_model1,
         "textrequestProcessor": textrequestProcessor,
@@ -178,9 +218,15 @@ async def lifespan(application: FastAPI):
     #         "textrerankingProcessor": textrerankingProcessor,
     #     }
 
+    # Stop background jobs (an interrupted rebuild resumes from its checkpoint)
+    await jobregistry.cancel_all()
+    await conversionqueue.stop()
+    await hub_poller.stop()
+
     # Close connections
     # await postgrespool.close_pool()
     await milvusdbclient.disconnect()
+    await close_http_clients()
 
 
 title = """Wekiwi API - search and feature extraction"""
@@ -210,6 +256,12 @@ app.include_router(
     dependencies=[Depends(check_authentication)],
 )
 
+app.include_router(
+    jobs.router,
+    tags=["Jobs"],
+    dependencies=[Depends(check_authentication)],
+)
+
 app.include_router(
     caption.router,
     tags=["Text"],
@@ -236,6 +288,12 @@ app.include_router(
     tags=["PDF Parsing"],
     # No global authentication dependency - uses custom service API key auth
 )
+
+# Completions pushed by the DAW hub, authenticated by the one-time token of the callback URL
+app.include_router(
+    hub_callback.router,
+    tags=["PDF Parsing"],
+)
 # --- End adding PDF parsing routers ---
 
 router = APIRouter()
@@ -0,0 +1,119 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+"""
+Benchmark of tenant isolation in MilvusDB: partition key routing vs. filter-only isolation.
+
+Creates two temporary collections with the same synthetic data, one with company_id as partition key (as the
+contents collection) and one with company_id as a plain field, and compares the search latency of a single
+company for a growing number of companies.
+
+Usage (against a running MilvusDB, the collections are dropped afterwards):
+    python scripts/milvus_tenant_benchmark.py --uri http://localhost:19530 --tenants 10 100 1000
+
+Milvus Lite (a local file as --uri) cannot be used, it rejects filters on partition key fields.
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from pymilvus import MilvusClient, DataType, Collection, connections
+
+
+_COLLECTIONS = {
+    "partition_key": "benchmark_tenants_partition_key",
+    "filter_only": "benchmark_tenants_filter_only",
+}
+
+
+def create_collection(client: MilvusClient, name: str, partition_key: bool, dim: int):
+    if client.has_collection(name):
+        client.drop_collection(name)
+
+    schema = MilvusClient.create_schema(auto_id=True, enable_dynamic_field=False)
+    schema.add_field("id", DataType.INT64, is_primary=True)
+    schema.add_field("company_id", DataType.INT64, is_partition_key=partition_key)
+    schema.add_field("circle_ids", DataType.ARRAY, element_type=DataType.INT32, max_capacity=8)
+    schema.add_field("text_embedding_dense", DataType.FLOAT_VECTOR, dim=dim)
+
+    index_params = client.prepare_index_params()
+    index_params.add_index(
+        field_name="text_embedding_dense", index_type="HNSW", metric_type="IP", params={"M": 16, "efConstruction": 200}
+    )
+    client.create_collection(collection_name=name, schema=schema, index_params=index_params)
+
+
+def insert_tenants(client: MilvusClient, name: str, first_tenant: int, tenants: int, rows_per_tenant: int, dim: int):
+    rows = [
+        {
+            "company_id": company_id,
+            "circle_ids": [random.randint(1, 8)],
+            "text_embedding_dense": [random.random() for _ in range(dim)],
+        }
+        for company_id in range(first_tenant, first_tenant + tenants)
+        for _ in range(rows_per_tenant)
+    ]
+    for i in range(0, len(rows), 5000):
+        client.insert(collection_name=name, data=rows[i:i + 5000])
+    # MilvusClient of pymilvus 2.4.4 has no flush, the ORM collection shares its connection
+    Collection(name, using="benchmark").flush()
+
+
+def measure(client: MilvusClient, name: str, tenants: int, queries: int, dim: int, limit: int) -> tuple[float, float]:
+    """Returns the p50 and p95 latency in milliseconds of searches within a random company."""
+    latencies = []
+    for _ in range(queries):
+        company_id = random.randrange(tenants)
+        start = time.perf_counter()
+        client.search(
+            collection_name=name,
+            data=[[random.random() for _ in range(dim)]],
+            anns_field="text_embedding_dense",
+            filter=f"company_id == {company_id} and ARRAY_CONTAINS_ANY(circle_ids, [1, 2, 3])",
+            limit=limit,
+            search_params={"metric_type": "IP"},
+        )
+        latencies.append((time.perf_counter() - start) * 1000)
+    return statistics.median(latencies), statistics.quantiles(latencies, n=20)[18]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default="http://localhost:19530")
+    parser.add_argument("--tenants", type=int, nargs="+", default=[10, 100, 1000], help="Numbers of companies to measure, ascending.")
+    parser.add_argument("--rows-per-tenant", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=60)
+    args = parser.parse_args()
+
+    client = MilvusClient(uri=args.uri)
+    connections.connect(alias="benchmark", uri=args.uri)
+    for isolation, name in _COLLECTIONS.items():
+        create_collection(client, name, partition_key=isolation == "partition_key", dim=args.dim)
+
+    try:
+        print(f"{'tenants':>8} {'rows':>9} {'isolation':>14} {'p50 ms':>8} {'p95 ms':>8}")
+        inserted = 0
+        for tenants in sorted(args.tenants):
+            # Grow both collections to the next number of companies
+            for name in _COLLECTIONS.values():
+                client.release_collection(collection_name=name)
+                insert_tenants(client, name, inserted, tenants - inserted, args.rows_per_tenant, args.dim)
+                client.load_collection(collection_name=name)
+            inserted = tenants
+
+            for isolation, name in _COLLECTIONS.items():
+                p50, p95 = measure(client, name, tenants, args.queries, args.dim, args.limit)
+                print(f"{tenants:>8} {tenants * args.rows_per_tenant:>9} {isolation:>14} {p50:>8.2f} {p95:>8.2f}")
+    finally:
+        for name in _COLLECTIONS.values():
+            client.drop_collection(collection_name=name)
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -12,12 +12,11 @@ environ["ENV"] = "test"
 # We have to update the ENV before importing, so ignore flake8's complaints.
 # See docs for starlette config.
 from app.config import POSTGRES_DB_NAME, POSTGRES_DB_USER, POSTGRES_DB_HOST, POSTGRES_DB_PORT, POSTGRES_DB_PASSWORD  # noqa: E402
-from app.postgresdb.connection import get_connection  # noqa: E402
-from app.postgresdb.manage_db import recreate_tables  # noqa: E402
 
 
-# Create a test database before test suite, tear it down when done
-@pytest_asyncio.fixture(scope="session", autouse=True)
+# Create a test database for the tests that need one, tear it down when done.
+# Not autouse: unit tests (e.g. test_filters.py) run without a Postgres server.
+@pytest_asyncio.fixture(scope="session")
 async def create_db():
     if "test" not in POSTGRES_DB_NAME:
         raise ValueError(
@@ -60,6 +59,9 @@ async def create_db():
 # Drop and recreate tables before and after each test
 @pytest_asyncio.fixture
 async def clean_db(create_db):
+    from app.postgresdb.connection import get_connection
+    from app.postgresdb.manage_db import recreate_tables
+
     async with get_connection() as conn:
         await recreate_tables(connection=conn)
     yield
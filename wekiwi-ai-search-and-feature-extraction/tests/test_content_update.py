@@ -0,0 +1,104 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+from app.api.v1.content.content import update_content
+from app.internal.milvusdb.handle_db_items import diff_content_chunks
+from app.internal.types import ContentOptional
+
+
+def chunk_row(primary_id: int, text: str) -> dict:
+    return {"id": primary_id, "content_id": 1, "title": "Title", "text": text, "circle_ids": [1]}
+
+
+class FakeMilvusDBClient:
+    """Keeps content chunks in memory, vectors are stored next to the scalar fields."""
+
+    def __init__(self, rows: list[dict]):
+        self.rows = {
+            row["id"]: {
+                **row,
+                "title_embedding_dense": [0.1],
+                "text_embedding_dense": [0.2],
+                "text_embedding_sparse": {1: 0.3},
+            }
+            for row in rows
+        }
+        self.next_id = max(self.rows) + 1
+
+    async def get_data(self, filter_expr=None, primary_ids=None, output_fields=None, **kwargs):
+        rows = [row for row in self.rows.values() if primary_ids is None or row["id"] in primary_ids]
+        return [{field: row[field] for field in output_fields if field in row} for row in rows]
+
+    @asynccontextmanager
+    async def content_writes(self, content_ids):
+        yield
+
+    async def insert_data(self, items):
+        for item in items:
+            self.rows[self.next_id] = {**item, "id": self.next_id}
+            self.next_id += 1
+
+    async def delete_data(self, primary_ids):
+        for primary_id in primary_ids:
+            del self.rows[primary_id]
+
+
+def test_diff_content_chunks_unchanged():
+    rows = [chunk_row(1, "a"), chunk_row(2, "b")]
+
+    kept, removed, added = diff_content_chunks(rows, ["a", "b"])
+
+    assert sorted(row["id"] for row in kept) == [1, 2]
+    assert removed == []
+    assert added == []
+
+
+def test_diff_content_chunks_kept_added_removed():
+    rows = [chunk_row(1, "a"), chunk_row(2, "b"), chunk_row(3, "c")]
+
+    kept, removed, added = diff_content_chunks(rows, ["a", "c", "d"])
+
+    assert sorted(row["id"] for row in kept) == [1, 3]
+    assert [row["id"] for row in removed] == [2]
+    assert added == ["d"]
+
+
+def test_diff_content_chunks_duplicates():
+    # Each stored row matches at most one new chunk
+    rows = [chunk_row(1, "a"), chunk_row(2, "a"), chunk_row(3, "b")]
+
+    kept, removed, added = diff_content_chunks(rows, ["a", "a", "a"])
+
+    assert sorted(row["id"] for row in kept) == [1, 2]
+    assert [row["id"] for row in removed] == [3]
+    assert added == ["a"]
+
+
+def test_diff_content_chunks_all_replaced():
+    rows = [chunk_row(1, "a"), chunk_row(2, "b")]
+
+    kept, removed, added = diff_content_chunks(rows, ["x"])
+
+    assert kept == []
+    assert sorted(row["id"] for row in removed) == [1, 2]
+    assert added == ["x"]
+
+
+@pytest.mark.parametrize("text", [None, "", "   "])
+def test_update_content_metadata_keeps_chunk_texts(text):
+    client = FakeMilvusDBClient([chunk_row(1, "a"), chunk_row(2, "b")])
+    request = SimpleNamespace(state=SimpleNamespace(milvusdbclient=client))
+
+    asyncio.run(update_content(request, ContentOptional(content_id=1, text=text), circle_ids=[7]))
+
+    rows = list(client.rows.values())
+    assert sorted(row["text"] for row in rows) == ["a", "b"]
+    assert all(row["circle_ids"] == [7] for row in rows)
+    assert all(row["text_embedding_dense"] == [0.2] for row in rows)
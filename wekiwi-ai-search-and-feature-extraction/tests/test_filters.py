@@ -0,0 +1,70 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+import pytest
+
+from app.internal.errors import InvalidFilter
+from app.internal.milvusdb import filters
+
+
+@pytest.mark.parametrize("expression", [None, "", "   "])
+def test_user_filter_empty(expression):
+    assert filters.user_filter(expression) is None
+
+
+@pytest.mark.parametrize("expression", [
+    "content_id == 5",
+    "content_type == 'text' and date_created >= 1700000000",
+    "ARRAY_CONTAINS_ANY(topics, [\"ai\", \"search\"]) or not (parent_id in [1, 2])",
+    "user_created like \"abc%\"",
+])
+def test_user_filter_accepts_allowed_expressions(expression):
+    assert filters.user_filter(expression) == f"({expression})"
+
+
+@pytest.mark.parametrize("expression", [
+    "company_id == 1",
+    "content_id == 1 or company_id != 1",
+    "text like '%secret%'",
+    "title_embedding_dense == 1",
+    "unknown_field == 1",
+    "json_contains(circle_ids, 1)",
+])
+def test_user_filter_rejects_fields(expression):
+    with pytest.raises(InvalidFilter, match="not allowed"):
+        filters.user_filter(expression)
+
+
+@pytest.mark.parametrize("expression", [
+    "(content_id == 1",
+    "content_id == 1)",
+    "content_id == 1) or (true",
+    "content_id in [1, 2)",
+    "array_contains(topics, 'ai']",
+])
+def test_user_filter_rejects_unbalanced_parentheses(expression):
+    with pytest.raises(InvalidFilter, match="Unbalanced"):
+        filters.user_filter(expression)
+
+
+@pytest.mark.parametrize("expression", [
+    "content_id == 1; drop",
+    "content_id == $1",
+    "content_id == `1`",
+    "content_id == 'unterminated",
+    "content_id == {1}",
+])
+def test_user_filter_rejects_unsupported_tokens(expression):
+    with pytest.raises(InvalidFilter, match="Invalid filter"):
+        filters.user_filter(expression)
+
+
+def test_user_filter_rejects_long_expressions():
+    with pytest.raises(InvalidFilter, match="longer"):
+        filters.user_filter("content_id == 1 or " * 100 + "true")
+
+
+def test_search_filter_keeps_top_level_or_inside_parentheses():
+    expression = filters.tenant(7, filters.search_filter((1, 2), "content_id == 5 or true"))
+    assert expression == "company_id == 7 and (ARRAY_CONTAINS_ANY(circle_ids, [1, 2]) and (content_id == 5 or true))"
@@ -0,0 +1,138 @@
+# Made open source under the GNU Affero General Public License, Version 3 (AGPL-3.0),
+# by digital@work GmbH (2024). This file is part of wekiwi.
+# See the LICENSE file in the project root or https://www.gnu.org/licenses/agpl-3.0.html for details.
+
+import random
+
+import polars as pl
+import pytest
+
+from app.internal.utils.search_postprocessing import calculate_combined_df, build_hierarchy, rank_root_subtrees
+
+
+def build_hierarchy_recursive(df):
+    """
+    Frozen copy of build_hierarchy before it aggregated column-wise (recursive, rows unpacked by position).
+    The reference the current implementation is compared with, do not change.
+    """
+    parent_child_map = {}
+    for row_tuple in df.iter_rows():
+        content_id = row_tuple[0]
+        parent_id = row_tuple[5]
+        score = row_tuple[-1]
+        node_data = {
+            "content_id": content_id,
+            "score": score,
+            "file_id": row_tuple[1],
+            "content_type": row_tuple[2],
+            "title": row_tuple[3],
+            "text": row_tuple[4],
+            "parent_id": parent_id,
+            "date_created": row_tuple[6],
+            "date_updated": row_tuple[7],
+            "interaction_id": row_tuple[8],
+            "user_created": row_tuple[9],
+            "user_updated": row_tuple[10],
+        }
+        parent_child_map.setdefault(parent_id, []).append(node_data)
+
+    def calculate_scores_and_build_subtree(node):
+        node_score = node.get("score")
+        total_score = 0 if node_score is None else node_score
+        total_leafs = 1 if node_score is not None else 0
+        child_ids = []
+
+        for child in parent_child_map.get(node["content_id"], []):
+            child_score, child_leafs, child_tree = calculate_scores_and_build_subtree(child)
+            if child_score is not None:
+                total_score += child_score
+            if child_leafs > 0:
+                total_leafs += child_leafs
+            child_ids.append(child_tree)
+
+        node["avg_leaf_score"] = total_score / total_leafs if total_leafs > 0 else None
+        node["child_id"] = child_ids
+        return total_score, total_leafs, node
+
+    hierarchy = []
+    for root_node in parent_child_map.get(None, []):
+        _, _, root_tree = calculate_scores_and_build_subtree(root_node)
+        hierarchy.append(root_tree)
+
+    hierarchy.sort(key=lambda x: (x.get("score") or 0) + (x.get("avg_leaf_score") or 0), reverse=True)
+    return hierarchy
+
+
+def generate_frame(seed: int, size: int) -> pl.DataFrame:
+    """
+    Random forest of contents combined with chunk scores the way search does it (calculate_combined_df).
+    Parents always come earlier in the tree (no cycles), some parents are missing from the frame (orphans) and
+    contents without hits have no score. Scores are multiples of 1/8 and k_avg is 1, so float sums are exact and
+    ties are ranked the same by both implementations.
+    """
+    rng = random.Random(seed)
+    content_ids = rng.sample(range(1, size * 10), size)
+
+    contents = []
+    for index, content_id in enumerate(content_ids):
+        roll = rng.random()
+        if index == 0 or roll < 0.2:
+            parent_id = None
+        elif roll < 0.25:
+            parent_id = size * 10 + index  # Not part of the frame
+        else:
+            parent_id = content_ids[rng.randrange(index)]
+        contents.append({
+            "content_id": content_id,
+            "file_id": "",
+            "content_type": "text",
+            "title": f"Title {content_id}",
+            "text": f"Text {content_id}",
+            "parent_id": parent_id,
+            "date_created": "2024-01-01T00:00:00.000Z",
+            "date_updated": None,
+            "interaction_id": None,
+            "user_created": {"avatar": None, "username": "user"},
+            "user_updated": None,
+        })
+    rng.shuffle(contents)
+
+    hit_ids = [content_id for content_id in content_ids if rng.random() < 0.7]
+    chunk_ids = [content_id for content_id in hit_ids for _ in range(rng.randint(1, 3))]
+    score_lf = pl.LazyFrame(
+        {"content_id": chunk_ids, "score": [rng.randint(0, 32) / 8 for _ in chunk_ids]},
+        schema={"content_id": pl.Int64, "score": pl.Float64},
+    )
+    return calculate_combined_df(score_lf, contents, k_avg=1)
+
+
+def subtree_ids(node: dict) -> set[int]:
+    return {node["content_id"]}.union(*[subtree_ids(child) for child in node["child_id"]])
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("size", [1, 8, 60, 300])
+def test_build_hierarchy_matches_recursive_version(seed, size):
+    expected = build_hierarchy_recursive(generate_frame(seed, size))
+
+    assert build_hierarchy(generate_frame(seed, size)) == expected
+    for limit in (0, 1, 5):
+        assert build_hierarchy(generate_frame(seed, size), limit) == expected[:limit]
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("size", [1, 8, 60, 300])
+def test_rank_root_subtrees_matches_recursive_version(seed, size):
+    expected = build_hierarchy_recursive(generate_frame(seed, size))
+    subtrees = rank_root_subtrees(generate_frame(seed, size).select("content_id", "parent_id", "score"))
+
+    # Descendants are an unordered set, only the root leads its subtree
+    assert [(subtree[0], set(subtree)) for subtree in subtrees] == [
+        (root["content_id"], subtree_ids(root)) for root in expected
+    ]
+
+
+def test_build_hierarchy_empty_frame():
+    df = generate_frame(0, 5).clear()
+    assert build_hierarchy(df) == []
+    assert rank_root_subtrees(df) == []